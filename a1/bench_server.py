@@ -0,0 +1,216 @@
+# Load generator and latency benchmark for the a1 Server.
+# to run in terminal: python bench_server.py --engines threads selector pool --concurrency 50 --requests 5000
+# Every engine is started on a local port, driven by --concurrency client threads sending a mix of
+# GET (of index.html or of a generated asset of --asset-size bytes) and POST /change_name requests,
+# with or without keep-alive, and its requests/sec and p50/p99/p99.9 latency are reported.
+# --save-baseline stores the results as JSON, --baseline compares against a stored file and exits
+# with status 1 if throughput dropped or p99 latency rose by more than --tolerance.
+import argparse
+import json
+import os
+import random
+import socket
+import sys
+import threading
+import time
+from server import Server, PreforkSupervisor
+
+addr = '127.0.0.1'
+
+
+def read_response(client_socket, buffer):
+    # Reads one response off the socket, returns (status line, leftover bytes)
+    while b"\r\n\r\n" not in buffer:
+        chunk = client_socket.recv(65536)
+        if not chunk:
+            raise ConnectionError("connection closed mid-response")
+        buffer += chunk
+    header_end = buffer.index(b"\r\n\r\n") + 4
+    head = buffer[:header_end].decode('latin-1').split("\r\n")
+    length = 0
+    for line in head[1:]:
+        if line.lower().startswith("content-length:"):
+            length = int(line.split(":", 1)[1])
+    while len(buffer) < header_end + length:
+        chunk = client_socket.recv(65536)
+        if not chunk:
+            raise ConnectionError("connection closed mid-response")
+        buffer += chunk
+    return head[0], buffer[header_end + length:]
+
+
+def build_requests(args, asset_name):
+    # The request mix a client picks from, weighted by --post-ratio
+    connection = "keep-alive" if args.keepalive else "close"
+    get_path = f"/{asset_name}" if asset_name else "/"
+    get = f"GET {get_path} HTTP/1.1\r\nHost: localhost\r\nConnection: {connection}\r\n\r\n".encode()
+    post = (f"POST /change_name HTTP/1.1\r\nHost: localhost\r\nConnection: {connection}\r\n"
+            f"Content-Length: 10\r\n\r\nname=Bench").encode()
+    return get, post
+
+
+def run_client(port, requests, count, args, latencies, errors, lock):
+    # Sends count requests, reusing the connection when keep-alive is on
+    rng = random.Random()
+    get, post = requests
+    client_socket, buffer = None, b""
+    local = []
+    failures = 0
+    for _ in range(count):
+        request = post if rng.random() < args.post_ratio else get
+        start = time.perf_counter()
+        try:
+            if client_socket is None:
+                client_socket = socket.create_connection((addr, port))
+                buffer = b""
+            client_socket.sendall(request)
+            status, buffer = read_response(client_socket, buffer)
+            if not status.startswith("HTTP/1.1 200"):
+                failures += 1
+            if not args.keepalive:
+                client_socket.close()
+                client_socket = None
+        except OSError:
+            failures += 1
+            if client_socket is not None:
+                client_socket.close()
+            client_socket = None
+            continue
+        local.append(time.perf_counter() - start)
+    if client_socket is not None:
+        client_socket.close()
+    with lock:
+        latencies.extend(local)
+        errors[0] += failures
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(int(len(sorted_values) * fraction), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+def run_benchmark(engine, port, args, asset_name):
+    # Starts a server with the given engine, drives it with the configured load and returns the results
+    devnull = open(os.devnull, 'w')
+    stdout, sys.stdout = sys.stdout, devnull    # The server prints every request, keep it out of the report
+    try:
+        if engine == "prefork":
+            server = PreforkSupervisor(addr, port, None, processes=args.processes, backlog=args.backlog)
+            server_thread = threading.Thread(target=server.start)
+        else:
+            server = Server(addr, port, None, engine=engine, backlog=args.backlog)
+            server_thread = threading.Thread(target=server.start_server)
+        server_thread.start()
+        time.sleep(1.5 if engine == "prefork" else 0.2)
+        requests = build_requests(args, asset_name)
+        latencies, errors, lock = [], [0], threading.Lock()
+        per_client = max(args.requests // args.concurrency, 1)
+        clients = [threading.Thread(target=run_client, args=(port, requests, per_client, args, latencies, errors, lock))
+                   for _ in range(args.concurrency)]
+        start = time.perf_counter()
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        elapsed = time.perf_counter() - start
+        if engine == "prefork":
+            server.stop()
+        else:
+            server.stop_server()
+        server_thread.join()
+    finally:
+        sys.stdout = stdout
+        devnull.close()
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": errors[0],
+        "rps": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "p999_ms": percentile(latencies, 0.999) * 1000,
+    }
+
+
+def config_name(engine, args):
+    # Identifies a configuration in the baseline file
+    return (f"{engine}-c{args.concurrency}-{'ka' if args.keepalive else 'close'}"
+            f"-post{args.post_ratio:g}-asset{args.asset_size}")
+
+
+def find_regressions(results, baseline, tolerance):
+    # Compares results against the baseline, returning a description of every regression
+    regressions = []
+    for name, result in results.items():
+        expected = baseline.get(name)
+        if expected is None:
+            continue
+        if result["rps"] < expected["rps"] * (1 - tolerance):
+            regressions.append(f"{name}: {result['rps']:.0f} req/s, baseline {expected['rps']:.0f} req/s")
+        if result["p99_ms"] > expected["p99_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p99 {result['p99_ms']:.2f} ms, baseline {expected['p99_ms']:.2f} ms")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the a1 HTTP server")
+    parser.add_argument('--engines', nargs='+', default=["threads"],
+                        choices=["threads", "selector", "pool", "prefork"], help='Engines to compare')
+    parser.add_argument('--port', type=int, default=8090, help='Port the server under test listens on')
+    parser.add_argument('--concurrency', '-c', type=int, default=20, help='Number of concurrent clients')
+    parser.add_argument('--requests', '-n', type=int, default=2000, help='Total number of requests per engine')
+    parser.add_argument('--keepalive', action=argparse.BooleanOptionalAction, default=True,
+                        help='Reuse connections between requests')
+    parser.add_argument('--post-ratio', type=float, default=0.1, help='Fraction of requests that are POSTs')
+    parser.add_argument('--asset-size', type=int, default=0,
+                        help='GET a generated asset of this many bytes instead of index.html')
+    parser.add_argument('--backlog', type=int, default=128, help='Listen backlog of the server')
+    parser.add_argument('--processes', type=int, default=None, help='Worker processes for the prefork engine')
+    parser.add_argument('--baseline', help='JSON file of earlier results to check for regressions')
+    parser.add_argument('--save-baseline', help='Write the results to this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed relative regression')
+    args = parser.parse_args()
+
+    # The server serves assets relative to the working directory
+    baseline_path = os.path.abspath(args.baseline) if args.baseline else None
+    save_path = os.path.abspath(args.save_baseline) if args.save_baseline else None
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    asset_name = None
+    if args.asset_size:
+        asset_name = f"bench_{args.asset_size}.bin"
+        with open(os.path.join("assets", asset_name), 'wb') as f:
+            f.write(os.urandom(args.asset_size))
+    results = {}
+    try:
+        for engine in args.engines:
+            result = run_benchmark(engine, args.port, args, asset_name)
+            results[config_name(engine, args)] = result
+            print(f"{engine:>9}: {result['rps']:8.0f} req/s  p50 {result['p50_ms']:7.2f} ms  "
+                  f"p99 {result['p99_ms']:7.2f} ms  p99.9 {result['p999_ms']:7.2f} ms  "
+                  f"({result['requests']} ok, {result['errors']} errors)")
+    finally:
+        if asset_name:
+            os.remove(os.path.join("assets", asset_name))
+
+    if save_path:
+        stored = {}
+        if os.path.exists(save_path):
+            with open(save_path) as f:
+                stored = json.load(f)
+        stored.update(results)
+        with open(save_path, 'w') as f:
+            json.dump(stored, f, indent=2)
+    if baseline_path:
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+        regressions = find_regressions(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,162 +1,1448 @@
 import socket
+import selectors
+import sys
+import json
 import threading
 import time
 import os
+import mimetypes
+import re
+import stat
+import queue
+import gzip
+import hashlib
+import sqlite3
+import tempfile
+import multiprocessing
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
 from urllib.parse import unquote, parse_qs
 
+try:
+    import brotli    # Optional, enables "Content-Encoding: br"
+except ImportError:
+    brotli = None
+
+SESSION_TTL = 24 * 3600    # Default lifetime of a session, in seconds since it was last set
+SESSION_MAX_SIZE = 10000    # Default number of sessions a server keeps
+
+class Connection:
+    # Wraps an accepted client socket for the lifetime of a (possibly persistent) HTTP connection.
+    # It exposes the socket methods the handlers use (sendall, recv, getpeername) so it can be passed
+    # wherever a client socket is expected, and carries the per-connection state:
+    # the RequestParser holding bytes received but not yet consumed (pipelined requests), whether
+    # the connection stays open after the current response, and how many requests it has served.
+    # A buffered connection (used by the selector engine) never blocks in sendall or sendfile, the
+    # response is queued in outbuf (and outfile) and the event loop writes it out with flush()
+    # when the socket is writable.
+    def __init__(self, sock, buffered=False, parser=None):
+        self.sock = sock
+        self.address = sock.getpeername()
+        self.parser = parser if parser is not None else RequestParser()
+        self.keep_alive = False
+        self.closing = False    # Set once a request was rejected: the connection closes after the error response
+        self.requests_served = 0
+        self.buffered = buffered
+        self.outbuf = bytearray()
+        self.outfile = None    # (file, offset, remaining) still to be sent after outbuf
+        self.status = None    # Status code and size of the last response, for the access log
+        self.response_bytes = 0
+        self.busy = False    # Whether a request is being handled
+        self.timer = None    # Idle timer of the selector engine
+        self.last_active = time.time()
+
+    def getpeername(self):
+        return self.address
+
+    def settimeout(self, timeout):
+        self.sock.settimeout(timeout)
+
+    def recv(self, bufsize):
+        return self.sock.recv(bufsize)
+
+    def sendall(self, data):
+        if self.buffered:
+            self.outbuf += data
+        else:
+            self.sock.sendall(data)
+
+    def sendfile(self, file, offset=0, count=None):
+        # Sends count bytes of file starting at offset, like socket.sendfile(). The file is closed once sent.
+        if count is None:
+            count = os.fstat(file.fileno()).st_size - offset
+        if self.buffered:
+            self.outfile = (file, offset, count)
+            return
+        try:
+            sent = self.sock.sendfile(file, offset, count)
+        finally:
+            file.close()
+        if sent < count:
+            # The file shrank under us, the response is short of its Content-Length
+            self.keep_alive = False
+
+    def flush(self):
+        # Writes as much of the queued output as the non-blocking socket accepts.
+        # Returns True once outbuf and outfile have been sent completely.
+        try:
+            while self.outbuf:
+                sent = self.sock.send(self.outbuf)
+                del self.outbuf[:sent]
+            while self.outfile is not None:
+                file, offset, remaining = self.outfile
+                if hasattr(os, "sendfile"):
+                    sent = os.sendfile(self.sock.fileno(), file.fileno(), offset, remaining) if remaining else 0
+                else:
+                    file.seek(offset)
+                    sent = self.sock.send(file.read(min(remaining, 65536)))
+                if sent == 0 or sent == remaining:
+                    if sent < remaining:
+                        # The file shrank under us, the response is short of its Content-Length
+                        self.keep_alive = False
+                    file.close()
+                    self.outfile = None
+                else:
+                    self.outfile = (file, offset + sent, remaining - sent)
+        except (BlockingIOError, InterruptedError):
+            return False
+        return True
+
+    def shutdown(self, how=socket.SHUT_RDWR):
+        # Shuts the socket down without closing it, waking up a thread blocked reading from it
+        try:
+            self.sock.shutdown(how)
+        except OSError:
+            pass
+
+    def is_idle(self):
+        # Whether the connection has neither a request nor a response in progress
+        return (not self.busy and not self.outbuf and self.outfile is None
+                and not self.parser.has_partial_request())
+
+    def close(self):
+        if self.outfile is not None:
+            self.outfile[0].close()
+            self.outfile = None
+        self.sock.close()
+
+
+def compress(data, encoding):
+    # Compresses data with the given Content-Encoding ("gzip" or "br")
+    if encoding == "br":
+        return brotli.compress(data)
+    return gzip.compress(data, compresslevel=6, mtime=0)
+
+
+def is_compressible(content_type):
+    # Only text-like content benefits from compression, images and archives are already compressed
+    return (content_type.startswith("text/")
+            or content_type in ("application/javascript", "application/json", "application/xml", "image/svg+xml"))
+
+
+def get_header(headers, name, default=None):
+    # HTTP header names are case-insensitive, RequestParser stores them lower-cased.
+    return headers.get(name.lower(), default)
+
+
+class RequestError(Exception):
+    # Raised by RequestParser for a request the server refuses to serve.
+    # status is the status line to answer with before closing the connection.
+    def __init__(self, status):
+        super().__init__(status)
+        self.status = status
+
+
+class RequestParser:
+    # Incremental HTTP request parser working on bytes. Data is fed in as it arrives and complete
+    # requests are taken off the front of the buffer, so pipelined requests simply stay queued.
+    # The search for the blank line ending the headers resumes where the previous one stopped,
+    # so headers that trickle in are never rescanned from the start. Headers larger than
+    # max_header_bytes and bodies larger than max_body_bytes are refused with a RequestError.
+    def __init__(self, max_header_bytes=64 * 1024, max_body_bytes=10 * 1024 * 1024):
+        self.max_header_bytes = max_header_bytes
+        self.max_body_bytes = max_body_bytes
+        self.buffer = bytearray()
+        self.scan_from = 0    # Where the search for the end of the headers resumes
+        self.head = None    # (method, path, version, headers, content_length) once the headers are parsed
+        self.header_end = 0
+
+    def feed(self, data):
+        self.buffer += data
+
+    def has_partial_request(self):
+        return len(self.buffer) > 0
+
+    def discard(self):
+        # Drops everything buffered, e.g. after a request was refused
+        self.buffer.clear()
+        self.scan_from = 0
+        self.head = None
+        self.header_end = 0
+
+    def next_request(self):
+        # Returns the next complete request as (method, path, version, headers, body),
+        # or None if more data is needed. body is the raw bytes of the request body.
+        if self.head is None:
+            # Blank lines before a request line are ignored (some clients send one after a POST body)
+            while self.buffer[:2] == b"\r\n":
+                del self.buffer[:2]
+            end = self.buffer.find(b"\r\n\r\n", self.scan_from)
+            if end == -1:
+                if len(self.buffer) > self.max_header_bytes:
+                    raise RequestError("431 Request Header Fields Too Large")
+                # The terminator may straddle the next chunk, so back up by 3 bytes
+                self.scan_from = max(len(self.buffer) - 3, 0)
+                return None
+            if end + 4 > self.max_header_bytes:
+                raise RequestError("431 Request Header Fields Too Large")
+            self.head = self.parse_head(bytes(self.buffer[:end]))
+            self.header_end = end + 4
+        method, path, version, headers, content_length = self.head
+        request_end = self.header_end + content_length
+        if len(self.buffer) < request_end:
+            return None
+        body = bytes(self.buffer[self.header_end:request_end])
+        del self.buffer[:request_end]
+        self.head = None
+        self.scan_from = 0
+        return method, path, version, headers, body
+
+    def parse_head(self, head):
+        # Parses the request line and headers, with header names lower-cased
+        lines = head.split(b"\r\n")
+        parts = lines[0].split()
+        if len(parts) != 3:
+            raise RequestError("400 Bad Request")
+        method, path, version = (part.decode('utf-8', 'replace') for part in parts)
+        headers = {}
+        for line in lines[1:]:
+            key, sep, value = line.partition(b":")
+            if sep:
+                headers[key.strip().decode('utf-8', 'replace').lower()] = value.strip().decode('utf-8', 'replace')
+        if "transfer-encoding" in headers:
+            # Only Content-Length framed bodies are supported
+            raise RequestError("501 Not Implemented")
+        try:
+            content_length = int(headers.get("content-length", 0))
+        except ValueError:
+            raise RequestError("400 Bad Request")
+        if content_length < 0:
+            raise RequestError("400 Bad Request")
+        if content_length > self.max_body_bytes:
+            raise RequestError("413 Content Too Large")
+        return method, path, version, headers, content_length
+
+
+class WorkerPool:
+    # A fixed number of worker threads serving accepted connections from a bounded queue.
+    # When the queue is full, overload decides what happens to the new connection:
+    # "queue" blocks the accept loop until a worker frees a slot (further clients wait in the
+    # kernel's listen backlog), "reject" answers "503 Service Unavailable" with a Retry-After
+    # header, and "drop" closes the socket straight away.
+    # A worker serves a connection until it has answered every request received so far; an idle keep-alive
+    # connection is then handed back to the accept loop (see Server.park), which queues it again once it
+    # becomes readable, so idle clients never hold a worker.
+    def __init__(self, handler, workers, queue_size, overload="queue"):
+        if overload not in ("queue", "reject", "drop"):
+            raise ValueError(f"Unknown overload behaviour: {overload}")
+        if workers < 1 or queue_size < 1:
+            raise ValueError("WorkerPool needs at least one worker and one queue slot")
+        self.handler = handler
+        self.overload = overload
+        self.work_queue = queue.Queue(maxsize=queue_size)
+        self.lock = threading.Lock()    # To manage access to the counters below
+        self.submitted = 0
+        self.rejected = 0
+        self.dropped = 0
+        self.max_depth = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.stopped = threading.Event()
+        self.threads = []
+        for i in range(workers):
+            worker = threading.Thread(target=self.work, name=f"worker-{i}")
+            worker.daemon = True
+            worker.start()
+            self.threads.append(worker)
+
+    def submit(self, client_socket, timeout=None):
+        # Queues the connection (a new socket or a parked Connection) for a worker, waiting up to timeout seconds for a free slot
+        # (not at all if timeout is None). Returns False if the queue stayed full.
+        try:
+            self.work_queue.put((client_socket, time.time()), block=timeout is not None, timeout=timeout)
+        except queue.Full:
+            return False
+        with self.lock:
+            self.submitted += 1
+            self.max_depth = max(self.max_depth, self.work_queue.qsize())
+        return True
+
+    def work(self):
+        while not self.stopped.is_set():
+            try:
+                client_socket, enqueued_at = self.work_queue.get(timeout=1.0)
+            except queue.Empty:
+                continue
+            wait = time.time() - enqueued_at
+            with self.lock:
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+            self.handler(client_socket)
+
+    def stop(self):
+        # Stops the workers once they finish their current connection and closes any still queued
+        self.stopped.set()
+        while True:
+            try:
+                client_socket, _ = self.work_queue.get_nowait()
+            except queue.Empty:
+                break
+            client_socket.close()
+
+    def stats(self):
+        # Snapshot of the pool's queue depth and wait time metrics
+        with self.lock:
+            return {
+                "workers": len(self.threads),
+                "queue_depth": self.work_queue.qsize(),
+                "max_queue_depth": self.max_depth,
+                "submitted": self.submitted,
+                "rejected": self.rejected,
+                "dropped": self.dropped,
+                "avg_wait": self.total_wait / self.submitted if self.submitted else 0.0,
+                "max_wait": self.max_wait,
+            }
+
+
+class Template:
+    # A file compiled once into its static byte segments and the {{placeholder}} slots between them,
+    # so rendering only encodes the substituted values and joins the pre-encoded chunks.
+    # static always holds one more segment than slots: static[0], slots[0], static[1], ... static[-1].
+    # Placeholders without a value are rendered back as written.
+    PLACEHOLDER = re.compile(rb"\{\{\s*(\w+)\s*\}\}")
+
+    def __init__(self, source):
+        self.source = source
+        self.static = []
+        self.slots = []    # (name, raw placeholder bytes) pairs
+        pos = 0
+        for match in self.PLACEHOLDER.finditer(source):
+            self.static.append(source[pos:match.start()])
+            self.slots.append((match.group(1).decode('ascii'), match.group(0)))
+            pos = match.end()
+        self.static.append(source[pos:])
+        self.placeholders = {name for name, _ in self.slots}
+
+    def render(self, values):
+        if not self.slots:
+            return self.source
+        chunks = [self.static[0]]
+        for (name, raw), segment in zip(self.slots, self.static[1:]):
+            value = values.get(name)
+            chunks.append(raw if value is None else str(value).encode('utf-8'))
+            chunks.append(segment)
+        return b"".join(chunks)
+
+
+class CachedAsset:
+    # One file known to the AssetCache. mtime and size identify the version of the file,
+    # they are None for a path that didn't exist (negative entry). content holds the file's bytes,
+    # or None if the file is too large to keep in memory and has to be read from path when served.
+    # checked is when the entry was last compared against the file on disk.
+    # The compiled Template and compressed variants of content live on the entry,
+    # so they are rebuilt whenever the file is re-read. So do the last MAX_RENDERINGS pages rendered
+    # from the template, each for one set of values and one encoding.
+    MAX_RENDERINGS = 64
+
+    def __init__(self, path, content, mtime, size, checked):
+        self.path = path
+        self.content = content
+        self.mtime = mtime
+        self.size = size
+        self.checked = checked
+        self.template = None
+        self.variants = {}    # Maps a Content-Encoding to the compressed content
+        self.renderings = {}    # Maps (values key, Content-Encoding or None) to a rendered page, oldest first
+        self.lock = threading.Lock()    # To manage access to renderings
+        self.etag = None
+        self.last_modified = None
+        if mtime is not None:
+            self.etag = f'"{int(mtime * 1000000):x}-{size:x}"'
+            self.last_modified = formatdate(mtime, usegmt=True)
+
+    def variant(self, encoding):
+        # Returns content compressed with encoding, compressing it only the first time
+        body = self.variants.get(encoding)
+        if body is None:
+            body = compress(self.content, encoding)
+            self.variants[encoding] = body
+        return body
+
+    def rendering(self, template, values, key, encoding):
+        # Returns the page template renders from values, compressed with encoding unless it is None.
+        # key identifies the values; a page already rendered for the same key and encoding is reused,
+        # unless the file is too large for the cache, in which case neither is the page kept.
+        kept = self.content is not None
+        if kept:
+            with self.lock:
+                body = self.renderings.get((key, encoding))
+            if body is not None:
+                return body
+        body = template.render(values)
+        if encoding is not None:
+            body = compress(body, encoding)
+        if kept:
+            with self.lock:
+                self.renderings[(key, encoding)] = body
+                while len(self.renderings) > self.MAX_RENDERINGS:
+                    del self.renderings[next(iter(self.renderings))]
+        return body
+
+    def compiled(self):
+        # Compiles the file into a Template the first time it is rendered.
+        # Files too large for the cache are read and compiled on every call instead.
+        if self.template is not None:
+            return self.template
+        if self.content is None:
+            with open(self.path, 'rb') as f:
+                return Template(f.read())
+        self.template = Template(self.content)
+        return self.template
+
+
+class AssetCache:
+    # An LRU cache of file contents keyed by path, bounded to max_bytes of content in total and to
+    # max_entries entries, which also bounds the negative and metadata-only entries that hold no content.
+    # An entry is trusted for revalidate seconds, after that the file is stat()ed again and re-read
+    # only if its mtime or size changed. Paths that don't exist are cached as negative entries so
+    # repeated 404s don't hit the filesystem either. Files larger than max_entry_bytes are only
+    # cached as metadata (content None), so they can be streamed from disk without another stat().
+    def __init__(self, max_bytes=16 * 1024 * 1024, max_entry_bytes=None, revalidate=1.0, max_entries=4096):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.max_entry_bytes = max_bytes if max_entry_bytes is None else max_entry_bytes
+        self.revalidate = revalidate
+        self.entries = OrderedDict()    # Maps paths to CachedAsset, least recently used first
+        self.current_bytes = 0
+        self.lock = threading.Lock()    # To manage access to entries and the counters below
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+        self.evictions = 0
+
+    def get(self, path):
+        # Returns the CachedAsset for path, or None if there is no such file
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and now - entry.checked < self.revalidate:
+                self.entries.move_to_end(path)
+                return self.record_hit(entry)
+        # The entry is missing or stale, check the file on disk
+        try:
+            st = os.stat(path)
+            is_file = stat.S_ISREG(st.st_mode)
+        except OSError:
+            is_file = False
+        if not is_file:
+            if entry is not None and entry.mtime is None:
+                # Still missing
+                with self.lock:
+                    entry.checked = now
+                    return self.record_hit(entry)
+            entry = CachedAsset(path, None, None, None, now)
+            with self.lock:
+                self.misses += 1
+                self.store(path, entry)
+            return None
+        if entry is not None and entry.mtime == st.st_mtime and entry.size == st.st_size:
+            # Unchanged since it was read
+            with self.lock:
+                entry.checked = now
+                if path in self.entries:
+                    self.entries.move_to_end(path)
+                return self.record_hit(entry)
+        content = None
+        if st.st_size <= self.max_entry_bytes:
+            with open(path, 'rb') as f:
+                content = f.read()
+        entry = CachedAsset(path, content, st.st_mtime, st.st_size, now)
+        with self.lock:
+            self.misses += 1
+            self.store(path, entry)
+        return entry
+
+    def record_hit(self, entry):
+        # Counts a hit on entry and returns what get() should return for it. Called with the lock held.
+        if entry.mtime is None:
+            self.negative_hits += 1
+            return None
+        self.hits += 1
+        return entry
+
+    def store(self, path, entry):
+        # Inserts entry, evicting least recently used entries to stay within max_bytes and max_entries.
+        # Called with the lock held.
+        old = self.entries.pop(path, None)
+        if old is not None and old.content is not None:
+            self.current_bytes -= len(old.content)
+        size = len(entry.content) if entry.content is not None else 0
+        self.entries[path] = entry
+        self.current_bytes += size
+        while (self.current_bytes > self.max_bytes or len(self.entries) > self.max_entries) and self.entries:
+            _, evicted = self.entries.popitem(last=False)
+            if evicted.content is not None:
+                self.current_bytes -= len(evicted.content)
+            self.evictions += 1
+
+    def invalidate(self, path=None):
+        # Drops the entry for path, or every entry if path is None
+        with self.lock:
+            if path is None:
+                self.entries.clear()
+                self.current_bytes = 0
+            else:
+                entry = self.entries.pop(path, None)
+                if entry is not None and entry.content is not None:
+                    self.current_bytes -= len(entry.content)
+
+    def stats(self):
+        # Snapshot of the cache's size and hit/miss/eviction counters
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "negative_hits": self.negative_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+class SessionStore:
+    # In-memory session store split into stripes, each with its own lock and entries, so writers for
+    # different clients rarely contend. Reads take no lock at all: looking a key up in a dict is atomic,
+    # and an entry is replaced rather than modified. Entries expire ttl seconds after they were last set
+    # (None keeps them forever), and each stripe evicts its least recently set entries beyond its share
+    # of max_size (None for no limit). There are never more stripes than max_size, so each gets a share.
+    def __init__(self, ttl=None, max_size=None, stripes=16):
+        self.ttl = ttl
+        self.max_size = max_size
+        if max_size is not None:
+            stripes = max(min(stripes, max_size), 1)
+        self.stripe_size = None if max_size is None else max(max_size // stripes, 1)
+        self.stripes = [OrderedDict() for _ in range(stripes)]    # Each maps keys to (value, expires)
+        self.locks = [threading.Lock() for _ in range(stripes)]
+
+    def stripe(self, key):
+        return hash(key) % len(self.stripes)
+
+    def get(self, key, default=None):
+        entry = self.stripes[self.stripe(key)].get(key)
+        if entry is None or (entry[1] is not None and entry[1] <= time.time()):
+            return default
+        return entry[0]
+
+    def set(self, key, value):
+        index = self.stripe(key)
+        entries = self.stripes[index]
+        now = time.time()
+        expires = None if self.ttl is None else now + self.ttl
+        with self.locks[index]:
+            entries.pop(key, None)
+            entries[key] = (value, expires)
+            # Entries are kept in the order they were set, so expired and excess ones are at the front
+            while entries:
+                _, (_, oldest_expires) = next(iter(entries.items()))
+                expired = oldest_expires is not None and oldest_expires <= now
+                if not expired and (self.stripe_size is None or len(entries) <= self.stripe_size):
+                    break
+                entries.popitem(last=False)
+
+    def delete(self, key):
+        index = self.stripe(key)
+        with self.locks[index]:
+            self.stripes[index].pop(key, None)
+
+    def __len__(self):
+        return sum(len(entries) for entries in self.stripes)
+
+    def close(self):
+        pass
+
+
+class SQLiteSessionStore:
+    # Session store kept in an SQLite database at path, so sessions survive restarts and can be
+    # shared by several server processes on the same host. Values are stored as text.
+    # ttl and max_size behave as in SessionStore; expired rows are purged as sessions are set, and the
+    # least recently set ones once a new session takes the store past max_size, both through indexes.
+    def __init__(self, path, ttl=None, max_size=None):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self.lock = threading.Lock()    # The connection is shared by every thread
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=5)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS sessions (key TEXT PRIMARY KEY, value TEXT, updated REAL, expires REAL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS sessions_updated ON sessions (updated)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS sessions_expires ON sessions (expires)")
+
+    def get(self, key, default=None):
+        with self.lock:
+            row = self.db.execute("SELECT value FROM sessions WHERE key = ? AND (expires IS NULL OR expires > ?)",
+                                  (str(key), time.time())).fetchone()
+        return default if row is None else row[0]
+
+    def set(self, key, value):
+        now = time.time()
+        expires = None if self.ttl is None else now + self.ttl
+        with self.lock:
+            new = self.db.execute("SELECT 1 FROM sessions WHERE key = ?", (str(key),)).fetchone() is None
+            self.db.execute("INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?)", (str(key), str(value), now, expires))
+            self.db.execute("DELETE FROM sessions WHERE expires <= ?", (now,))
+            if self.max_size is not None and new:
+                # Only a new key adds a row, so only then can there be rows to evict, the oldest first
+                self.db.execute("DELETE FROM sessions WHERE key IN (SELECT key FROM sessions ORDER BY updated "
+                                "LIMIT max((SELECT COUNT(*) FROM sessions) - ?, 0))", (self.max_size,))
+
+    def delete(self, key):
+        with self.lock:
+            self.db.execute("DELETE FROM sessions WHERE key = ?", (str(key),))
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class AccessLog:
+    # Structured access log written as one JSON object per line. log() only puts the entry on a bounded
+    # queue, a background thread serialises and writes entries in batches, so a slow disk or terminal
+    # never blocks a request. If the queue is full the entry is dropped and counted instead.
+    def __init__(self, path=None, max_queue=10000):
+        self.path = path
+        self.stream = open(path, 'a', buffering=65536) if path else sys.stdout
+        self.entries = queue.Queue(maxsize=max_queue)
+        self.dropped = 0
+        self.writer = threading.Thread(target=self.write_entries, name="access-log")
+        self.writer.daemon = True
+        self.writer.start()
+
+    def log(self, **fields):
+        fields.setdefault("time", time.time())
+        try:
+            self.entries.put_nowait(fields)
+        except queue.Full:
+            self.dropped += 1
+
+    def write_entries(self):
+        while True:
+            entry = self.entries.get()
+            if entry is None:
+                break
+            # Drain whatever else is queued so it goes out in one write
+            lines = [json.dumps(entry)]
+            stop = False
+            while len(lines) < 1000:
+                try:
+                    entry = self.entries.get_nowait()
+                except queue.Empty:
+                    break
+                if entry is None:
+                    stop = True
+                    break
+                lines.append(json.dumps(entry))
+            try:
+                self.stream.write("\n".join(lines) + "\n")
+                self.stream.flush()
+            except (OSError, ValueError):
+                pass
+            if stop:
+                break
+
+    def close(self):
+        # Writes out everything logged so far and stops the writer
+        if not self.writer.is_alive():
+            return
+        self.entries.put(None)
+        self.writer.join()
+        if self.path:
+            self.stream.close()
+
+
+def escape_label(value):
+    # Escapes a metric label value as the Prometheus text format requires: backslash, double quote and newline
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Metrics:
+    # In-process metrics registry: counters, gauges and latency histograms, each identified by a name
+    # and a tuple of (label, value) pairs, rendered in the Prometheus text format for /metrics.
+    # Every distinct label set is a series kept for the life of the process, so callers must only use
+    # label values from a small fixed set (e.g. not a method name taken from the request as is).
+    LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+    COUNT_BUCKETS = (1, 2, 5, 10, 25, 50, 100)
+
+    def __init__(self):
+        self.lock = threading.Lock()    # Updates are a few dict operations, so one lock is enough
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}    # Maps (name, labels) to [bucket counts..., count, sum]
+        self.buckets = {}    # Maps (name, labels) to the upper bounds of its histogram's buckets
+
+    def inc(self, name, labels=(), value=1):
+        with self.lock:
+            key = (name, labels)
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def add(self, name, value, labels=()):
+        with self.lock:
+            key = (name, labels)
+            self.gauges[key] = self.gauges.get(key, 0) + value
+
+    def observe(self, name, value, labels=(), buckets=None):
+        # Adds value to a histogram with the given bucket bounds, LATENCY_BUCKETS by default.
+        # A histogram keeps the buckets of its first observation.
+        with self.lock:
+            key = (name, labels)
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                self.buckets[key] = buckets or self.LATENCY_BUCKETS
+                histogram = [0] * (len(self.buckets[key]) + 2)
+                self.histograms[key] = histogram
+            for i, bound in enumerate(self.buckets[key]):
+                if value <= bound:
+                    histogram[i] += 1
+            histogram[-2] += 1
+            histogram[-1] += value
+
+    def render(self, extra_gauges=None):
+        # Formats every metric, plus extra_gauges ({name: value}) sampled by the caller
+        def series(name, labels, extra=()):
+            pairs = ",".join(f'{key}="{escape_label(value)}"' for key, value in tuple(labels) + tuple(extra))
+            return f"{name}{{{pairs}}}" if pairs else name
+
+        lines = []
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append(f"{series(name, labels)} {value}")
+            for (name, labels), value in sorted(self.gauges.items()):
+                lines.append(f"{series(name, labels)} {value}")
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                for bound, count in zip(self.buckets[(name, labels)], histogram):
+                    lines.append(f"{series(name + '_bucket', labels, (('le', bound),))} {count}")
+                lines.append(f"{series(name + '_bucket', labels, (('le', '+Inf'),))} {histogram[-2]}")
+                lines.append(f"{series(name + '_count', labels)} {histogram[-2]}")
+                lines.append(f"{series(name + '_sum', labels)} {histogram[-1]}")
+        for name, value in sorted((extra_gauges or {}).items()):
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+class Timer:
+    # A callback scheduled on a TimerWheel
+    def __init__(self, expires, callback):
+        self.expires = expires
+        self.callback = callback
+        self.cancelled = False
+
+
+class TimerWheel:
+    # Hashed timing wheel. A timer goes into the bucket of the tick after it expires (modulo the number
+    # of buckets), so scheduling and cancelling are O(1) however many timers there are, and advancing
+    # only looks at the buckets of the ticks that passed. Timers more than one turn of the wheel away
+    # stay in their bucket until their turn comes round. Timers fire up to one tick late.
+    # Not thread-safe: it belongs to the event loop thread that schedules and advances it.
+    def __init__(self, tick=0.05, buckets=1024):
+        self.tick = tick
+        self.buckets = [[] for _ in range(buckets)]
+        self.current = int(time.time() / tick)    # The last tick processed
+        self.pending = 0
+
+    def schedule(self, delay, callback):
+        timer = Timer(time.time() + delay, callback)
+        tick = max(int(timer.expires / self.tick) + 1, self.current + 1)
+        self.buckets[tick % len(self.buckets)].append(timer)
+        self.pending += 1
+        return timer
+
+    def cancel(self, timer):
+        # Cancelled timers are dropped when their bucket is next processed
+        if timer is not None:
+            timer.cancelled = True
+
+    def next_timeout(self):
+        # Seconds until the next tick with timers in its bucket, or None if there are no timers
+        if not self.pending:
+            return None
+        for ahead in range(1, len(self.buckets) + 1):
+            if self.buckets[(self.current + ahead) % len(self.buckets)]:
+                return max((self.current + ahead) * self.tick - time.time(), 0)
+        return None
+
+    def advance(self, now):
+        # Fires every timer that has expired by now
+        target = int(now / self.tick)
+        # After a stall longer than a turn of the wheel, one pass over every bucket covers all ticks
+        self.current = max(self.current, target - len(self.buckets))
+        while self.current < target:
+            self.current += 1
+            index = self.current % len(self.buckets)
+            due, keep = [], []
+            for timer in self.buckets[index]:
+                if timer.cancelled:
+                    self.pending -= 1
+                elif timer.expires <= now:
+                    due.append(timer)
+                else:
+                    keep.append(timer)
+            self.buckets[index] = keep
+            for timer in due:
+                self.pending -= 1
+                timer.callback()
+
+
+def create_listen_socket(addr, port, backlog, reuse_port=False):
+    # Creates a TCP socket listening on addr:port, with SO_REUSEPORT if reuse_port is set
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    try:
+        if reuse_port:
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        server_socket.bind((addr, port))
+        server_socket.listen(backlog)
+        print(f"Server started at {addr}:{port}")
+    except Exception as e:
+        print(f"Failed to bind server on {addr}:{port}: {e}")
+        server_socket.close()
+        raise e
+    return server_socket
+
+
 class Server:
-    def __init__(self, addr, port, timeout):
+    def __init__(self, addr, port, timeout, keepalive_timeout=5, max_keepalive_requests=100, engine="threads",
+                 backlog=5, workers=8, queue_size=64, overload="queue", retry_after=1,
+                 cache_bytes=16 * 1024 * 1024, cache_entries=4096, cache_revalidate=1.0, sendfile_threshold=256 * 1024,
+                 compress_min_bytes=1024, max_header_bytes=64 * 1024, max_body_bytes=10 * 1024 * 1024,
+                 sessions=None, session_ttl=SESSION_TTL, session_max_size=SESSION_MAX_SIZE, reuse_port=False,
+                 listen_socket=None, access_log=None, drain_timeout=5):
         # This constructor initializes the server class with the specified addr, port, and timeout values.
         # It initializes the sessions dictionary to store client sessions. 
         # it also intializes the server_socket object and bind it to the given addr and port to listen on. 
         # You can add any additional instance variables you need for the server's operation.
+        # keepalive_timeout is how long an idle persistent connection waits for its next request,
+        # and max_keepalive_requests caps how many requests are served on a single connection.
+        # engine selects how connections are served: "threads" starts one thread per connection,
+        # "selector" multiplexes every connection in a single non-blocking event loop, and "pool" hands
+        # connections to a fixed pool of workers threads through a queue of queue_size connections.
+        # overload picks what the pool does when that queue is full (see WorkerPool), a rejected
+        # client is told to retry after retry_after seconds. backlog is the listen queue length.
+        # Assets are served from an AssetCache of up to cache_bytes in cache_entries entries, rechecked on disk
+        # every cache_revalidate seconds.
+        # Files larger than sendfile_threshold aren't kept in memory but streamed from disk with sendfile.
+        # Text responses of at least compress_min_bytes are compressed if the client accepts it.
+        # Requests with more than max_header_bytes of headers or max_body_bytes of body are refused.
+        # sessions is the store mapping client addresses to names. By default it is an in-memory SessionStore
+        # keeping at most session_max_size sessions, each for session_ttl seconds after it was last set.
+        # A timeout of None disables the idle shutdown. With reuse_port the socket is bound with SO_REUSEPORT
+        # so several processes can listen on the same port, and listen_socket serves an already listening
+        # socket instead of binding a new one (both are used by PreforkSupervisor).
+        # Requests are logged to the file access_log (stdout if None) and counted in metrics, served at /metrics.
+        # On shutdown, requests in progress get up to drain_timeout seconds to finish.
+        if engine not in ("threads", "selector", "pool"):
+            raise ValueError(f"Unknown engine: {engine}")
         self.addr = addr
         self.port = port
         self.timeout = timeout
-        self.sessions = {}    # Maps client addresses to their names
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        try:
-            self.server_socket.bind((self.addr, self.port))
-            self.server_socket.listen(5)
+        self.keepalive_timeout = keepalive_timeout
+        self.max_keepalive_requests = max_keepalive_requests
+        self.engine = engine
+        self.backlog = backlog
+        self.retry_after = retry_after
+        self.compress_min_bytes = compress_min_bytes
+        self.max_header_bytes = max_header_bytes
+        self.max_body_bytes = max_body_bytes
+        if sessions is None:
+            sessions = SessionStore(ttl=session_ttl, max_size=session_max_size)
+        self.sessions = sessions    # Maps client addresses to their names
+        self.metrics = Metrics()
+        self.access_log = AccessLog(access_log)
+        self.asset_cache = AssetCache(max_bytes=cache_bytes, max_entry_bytes=sendfile_threshold,
+                                      revalidate=cache_revalidate, max_entries=cache_entries)
+        if listen_socket is not None:
+            self.server_socket = listen_socket
             print(f"Server started at {self.addr}:{self.port}")
-        except Exception as e:
-            print(f"Failed to bind server on {self.addr}:{self.port}: {e}")
-            self.server_socket.close()
-            raise e
+        else:
+            self.server_socket = create_listen_socket(self.addr, self.port, self.backlog, reuse_port)
         self.running = False
+        self.draining = False
+        self.drain_timeout = drain_timeout
         self.last_activity = time.time()
-        self.lock = threading.Lock()    # To manage access to sessions
+        self.lock = threading.Lock()    # To manage access to last_activity, in_flight and connections
+        self.drained = threading.Condition(self.lock)    # Notified when in_flight drops to 0
+        self.in_flight = 0
+        self.connections = set()    # Open connections of the threads and pool engines
+        self.parking = []    # Idle keep-alive connections the pool's workers handed back to the accept loop
+        self.timers = TimerWheel()
+        # Writing a byte to wakeup_w wakes the accept or event loop, so stop_server() takes effect at once
+        self.wakeup_r, self.wakeup_w = socket.socketpair()
+        self.wakeup_r.setblocking(False)
+        self.wakeup_w.setblocking(False)
+        self.loop_thread = None
+        self.stopped = False
+        self.loop_done = threading.Event()
+        self.pool = None
+        if engine == "pool":
+            self.pool = WorkerPool(self.handle_request, workers, queue_size, overload)
 
     def start_server(self):
         # The method should run the server indefinitely, accepting incoming connections and handling them in separate threads. 
         # The method should also track the last time a connection was made, 
         # if no new connections are made within the specified timeout period, 
         # the loop stops and the server should close by calling the stop_server() method.
-        self.running = True
+        # The idle timeout is a timer on the loop's TimerWheel rather than an accept timeout, and the
+        # loop also watches the wakeup socket so stop_server() doesn't wait for a timeout to expire.
+        with self.lock:
+            if self.stopped:
+                return
+            self.running = True
+            self.loop_thread = threading.current_thread()
+        try:
+            if self.timeout is not None:
+                self.timers.schedule(self.remaining_time(), self.check_idle_timeout)
+            if self.engine == "selector":
+                self.run_selector_loop()
+            else:
+                self.run_accept_loop()
+        finally:
+            self.finish_shutdown()
+            self.loop_done.set()
+
+    def check_idle_timeout(self):
+        # Timer callback: shuts down if nothing was accepted for timeout seconds, otherwise checks again later
+        remaining_time = self.remaining_time()
+        if remaining_time > 0:
+            self.timers.schedule(remaining_time, self.check_idle_timeout)
+            return
+        print("Server timeout reached. Shutting down.")
+        self.running = False
+
+    def wake(self):
+        try:
+            self.wakeup_w.send(b"x")
+        except (BlockingIOError, OSError):
+            pass    # A wakeup is already pending, or the server is already closed
+
+    def clear_wakeup(self):
+        try:
+            while self.wakeup_r.recv(4096):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+
+    def run_accept_loop(self):
+        # Accept loop of the threads and pool engines: waits for connections or a wakeup,
+        # firing timers in between, and hands every accepted connection to a thread or the pool.
+        # It also watches the pool's parked keep-alive connections, queueing each one for a worker again
+        # once its next request arrives and closing it after keepalive_timeout seconds without one.
+        sel = selectors.DefaultSelector()
+        self.server_socket.setblocking(False)
+        sel.register(self.server_socket, selectors.EVENT_READ)
+        sel.register(self.wakeup_r, selectors.EVENT_READ)
+        parked = set()
+        try:
+            while self.running:
+                for key, _ in sel.select(self.timers.next_timeout()):
+                    if key.fileobj is self.wakeup_r:
+                        self.clear_wakeup()
+                        self.watch_parked(sel, parked)
+                    elif key.fileobj is self.server_socket:
+                        self.accept_blocking()
+                    else:
+                        conn = key.data
+                        self.unpark(sel, conn, parked)
+                        self.dispatch_to_pool(conn)
+                self.timers.advance(time.time())
+        finally:
+            with self.lock:
+                parked.update(self.parking)
+                self.parking = []
+            for conn in parked:
+                self.close_connection(conn)
+            sel.close()
+
+    def park(self, conn):
+        # Called by a pool worker once a keep-alive connection has nothing left to serve: hands it to the
+        # accept loop rather than keeping the worker waiting for the client's next request.
+        # Returns False if the server is shutting down, in which case the worker closes the connection.
+        with self.lock:
+            if not self.running or self.draining:
+                return False
+            conn.last_active = time.time()
+            self.parking.append(conn)
+        self.wake()
+        return True
+
+    def watch_parked(self, sel, parked):
+        # Registers the connections parked since the last wakeup, each with a keep-alive timer
+        with self.lock:
+            parking, self.parking = self.parking, []
+        for conn in parking:
+            parked.add(conn)
+            sel.register(conn.sock, selectors.EVENT_READ, conn)
+            conn.timer = self.timers.schedule(self.keepalive_timeout,
+                                              lambda conn=conn: self.expire_parked(sel, conn, parked))
+
+    def unpark(self, sel, conn, parked):
+        parked.discard(conn)
+        sel.unregister(conn.sock)
+        self.timers.cancel(conn.timer)
+        conn.timer = None
+
+    def expire_parked(self, sel, conn, parked):
+        # Timer callback: closes a parked connection whose client sent nothing within keepalive_timeout
+        if conn in parked:
+            self.unpark(sel, conn, parked)
+            self.close_connection(conn)
+
+    def accept_blocking(self):
+        # Accepts every pending connection, each one to be served by blocking reads and writes
         while self.running:
-            # Set timeout for accept based on remaining time before shutdown
-            time_since_last = time.time() - self.last_activity
-            remaining_time = self.timeout - time_since_last
-            if remaining_time <= 0:
-                print("Server timeout reached. Shutting down.")
-                self.stop_server()
-                break
-            self.server_socket.settimeout(remaining_time)
             try:
                 client_socket, client_address = self.server_socket.accept()
-                with self.lock:
-                    self.last_activity = time.time()
-                print(f"Accepted connection from {client_address}")
-                client_thread = threading.Thread(target=self.handle_request, args=(client_socket,))
-                client_thread.daemon = True
-                client_thread.start()
-            except socket.timeout:
-                # No new connection within the remaining_time
-                continue
-            except Exception as e:
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
                 print(f"Error accepting connections: {e}")
+                return
+            with self.lock:
+                self.last_activity = time.time()
+            client_socket.setblocking(True)
+            if self.pool is not None:
+                self.dispatch_to_pool(client_socket)
                 continue
+            client_thread = threading.Thread(target=self.handle_request, args=(client_socket,))
+            client_thread.daemon = True
+            client_thread.start()
+
+    def remaining_time(self):
+        # Seconds left before the server shuts down for lack of new connections
+        if self.timeout is None:
+            return float("inf")
+        return self.timeout - (time.time() - self.last_activity)
+
+    def dispatch_to_pool(self, client_socket):
+        # Hands the connection to the worker pool, applying its overload behaviour if the queue is full
+        pool = self.pool
+        if pool.overload == "queue":
+            # Wait for a free slot, giving up if the server is stopped meanwhile
+            while self.running:
+                if pool.submit(client_socket, timeout=1.0):
+                    return
+            self.close_client(client_socket)
+            return
+        if pool.submit(client_socket):
+            return
+        if pool.overload == "reject":
+            with pool.lock:
+                pool.rejected += 1
+            try:
+                client_socket.settimeout(1)
+                self.send_response(client_socket, "503 Service Unavailable", b"<h1>503 Service Unavailable</h1>",
+                                   extra_headers={"Retry-After": str(self.retry_after)})
+            except Exception as e:
+                print(f"Error rejecting connection: {e}")
+        else:
+            with pool.lock:
+                pool.dropped += 1
+        self.close_client(client_socket)
+
+    def close_client(self, client_socket):
+        # Closes a connection the pool won't serve, either a new socket or a parked Connection
+        if isinstance(client_socket, Connection):
+            self.close_connection(client_socket)
+        else:
+            client_socket.close()
 
-    def stop_server(self):
+    def run_selector_loop(self):
+        # Serves every client from this one thread. The listening socket and all client sockets are
+        # non-blocking and registered with a selector; complete requests are dispatched to the same
+        # handlers as the threaded engine, whose responses queue up in the connection's outbuf and
+        # are written out as the socket becomes writable. Idle connections are closed by timers.
+        # Once stopped, the loop stops accepting, closes idle connections and keeps serving the rest
+        # until their responses are out or the drain deadline passes.
+        sel = selectors.DefaultSelector()
+        self.server_socket.setblocking(False)
+        sel.register(self.server_socket, selectors.EVENT_READ)
+        sel.register(self.wakeup_r, selectors.EVENT_READ)
+        connections = {}
+        deadline = None
+        try:
+            while True:
+                if not self.running and deadline is None:
+                    deadline = time.time() + self.drain_timeout
+                    self.draining = True
+                    sel.unregister(self.server_socket)
+                    for conn in list(connections.values()):
+                        if conn.is_idle():
+                            self.close_nonblocking(sel, conn, connections)
+                timeout = self.timers.next_timeout()
+                if deadline is not None:
+                    if not connections or time.time() >= deadline:
+                        break
+                    timeout = max(deadline - time.time(), 0) if timeout is None else min(timeout, deadline - time.time())
+                for key, mask in sel.select(timeout):
+                    if key.fileobj is self.wakeup_r:
+                        self.clear_wakeup()
+                        continue
+                    if key.fileobj is self.server_socket:
+                        self.accept_nonblocking(sel, connections)
+                        continue
+                    conn = key.data
+                    if mask & selectors.EVENT_READ:
+                        self.read_nonblocking(sel, conn, connections)
+                    if mask & selectors.EVENT_WRITE and conn.sock.fileno() != -1:
+                        self.write_nonblocking(sel, conn, connections)
+                self.timers.advance(time.time())
+        finally:
+            for conn in list(connections.values()):
+                self.close_nonblocking(sel, conn, connections)
+            sel.close()
+
+    def check_connection_idle(self, sel, conn, connections):
+        # Timer callback: closes the connection if it has been idle past its timeout, otherwise checks again
+        # when it would next time out. Waiting for the first request is limited to 5 seconds.
+        if connections.get(conn.sock.fileno()) is not conn:
+            return
+        idle_limit = self.keepalive_timeout if conn.requests_served else 5
+        idle = time.time() - conn.last_active
+        if not conn.is_idle() or idle < idle_limit:
+            conn.timer = self.timers.schedule(max(idle_limit - idle, self.timers.tick),
+                                              lambda: self.check_connection_idle(sel, conn, connections))
+            return
+        if conn.requests_served == 0:
+            print(f"No data received from {conn.address}")
+        self.close_nonblocking(sel, conn, connections)
+
+    def accept_nonblocking(self, sel, connections):
+        # Accepts every pending connection on the listening socket
+        while True:
+            try:
+                client_socket, client_address = self.server_socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                if self.running:
+                    print(f"Error accepting connections: {e}")
+                return
+            with self.lock:
+                self.last_activity = time.time()
+            client_socket.setblocking(False)
+            conn = Connection(client_socket, buffered=True, parser=self.new_parser())
+            self.metrics.add("http_active_connections", 1)
+            connections[client_socket.fileno()] = conn
+            sel.register(client_socket, selectors.EVENT_READ, conn)
+            conn.timer = self.timers.schedule(5, lambda conn=conn: self.check_connection_idle(sel, conn, connections))
+
+    def read_nonblocking(self, sel, conn, connections):
+        # Reads whatever is available and serves every complete request now in the buffer
+        try:
+            chunk = conn.sock.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            chunk = b""
+        if not chunk:
+            if conn.requests_served == 0:
+                print(f"No data received from {conn.address}")
+            self.close_nonblocking(sel, conn, connections)
+            return
+        if conn.closing:
+            return    # Whatever follows a rejected request is ignored while the error response goes out
+        conn.parser.feed(chunk)
+        conn.last_active = time.time()
+        self.serve_buffered_requests(conn)
+        self.write_nonblocking(sel, conn, connections)
+
+    def serve_buffered_requests(self, conn):
+        # Serves every complete request in the connection's buffer. Stops once the client asked to close
+        # (the rest of the buffer is ignored) or a file is being streamed, since the responses that follow
+        # must not overtake it; write_nonblocking() resumes once the file has been sent.
+        while (conn.keep_alive or conn.requests_served == 0) and conn.outfile is None and not conn.closing:
+            try:
+                request = conn.parser.next_request()
+            except RequestError as e:
+                self.reject_request(conn, e)
+                break
+            if request is None:
+                break
+            self.process_request(conn, request)
+
+    def write_nonblocking(self, sel, conn, connections):
+        # Writes as much of the queued output as the socket accepts, and waits for
+        # write readiness if some of it is left over
+        while True:
+            try:
+                done = conn.flush()
+            except OSError as e:
+                print(f"Error sending response to {conn.address}: {e}")
+                self.close_nonblocking(sel, conn, connections)
+                return
+            if not done:
+                sel.modify(conn.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, conn)
+                return
+            if conn.closing or (conn.requests_served and not conn.keep_alive) or (self.draining and conn.is_idle()):
+                self.close_nonblocking(sel, conn, connections)
+                return
+            # Pipelined requests held back behind a streamed file can be served now
+            served = conn.requests_served
+            self.serve_buffered_requests(conn)
+            if conn.requests_served == served:
+                break
+        sel.modify(conn.sock, selectors.EVENT_READ, conn)
+
+    def close_nonblocking(self, sel, conn, connections):
+        if connections.pop(conn.sock.fileno(), None) is None:
+            return
+        try:
+            sel.unregister(conn.sock)
+        except (KeyError, ValueError):
+            pass
+        self.timers.cancel(conn.timer)
+        self.connection_closed(conn)
+        conn.close()
+
+    def stop_server(self, drain_timeout=None):
         # This method should close the server's socket and terminate the server's operation.
+        # The server stops accepting connections at once, requests in progress get up to drain_timeout
+        # seconds (the constructor's drain_timeout by default) to complete, then every connection is closed.
+        # Called from another thread, it returns once the server has shut down.
+        if drain_timeout is not None:
+            self.drain_timeout = drain_timeout
+        with self.lock:
+            self.stopped = True
+            self.running = False
+            started = self.loop_thread is not None
+        self.wake()
+        if not started:
+            self.finish_shutdown()
+        elif threading.current_thread() is not self.loop_thread:
+            self.loop_done.wait()
+
+    def finish_shutdown(self):
+        # Runs once the accept or event loop has exited: drains the remaining connections, then
+        # closes the listening socket, the worker pool and the access log
+        if self.server_socket.fileno() == -1:
+            return
         self.running = False
+        if self.engine != "selector":
+            self.drain_connections()
+        if self.pool is not None:
+            self.pool.stop()
         try:
             self.server_socket.close()
             print("Server socket closed.")
         except Exception as e:
             print(f"Error closing server socket: {e}")
+        self.wakeup_r.close()
+        self.wakeup_w.close()
+        self.access_log.close()
 
-    def parse_request(self, request_data):
-        # Parses raw HTTP request data into request line, headers, and body.
-        # Returns a tuple of (request_line, headers_dict, body).
-        try:
-            # Decode bytes to string
-            request_text = request_data.decode('utf-8')
-            # Split request into lines
-            lines = request_text.split("\r\n")
-            # Extract request line
-            request_line = lines[0]
-            # Initialize headers dictionary
-            headers = {}
-            body = ""
-            # Iterate over headers
-            i = 1
-            while i < len(lines):
-                line = lines[i]
-                if line == "":
-                    # End of headers
-                    i += 1
-                    break
-                parts = line.split(":", 1)
-                if len(parts) == 2:
-                    header_key = parts[0].strip()
-                    header_value = parts[1].strip()
-                    headers[header_key] = header_value
-                i += 1
-            # The rest is body
-            body = "\r\n".join(lines[i:])
-            return request_line, headers, body
-        except Exception as e:
-            print(f"Error parsing request: {e}")
-            return None, {}, ""
+    def drain_connections(self):
+        # Graceful drain of the threads and pool engines. Idle connections are shut down straight away,
+        # which wakes their threads out of recv(). Connections with a request in progress finish it
+        # (they close afterwards since draining is set) unless the deadline passes first.
+        deadline = time.time() + self.drain_timeout
+        with self.lock:
+            self.draining = True
+            for conn in self.connections:
+                if not conn.busy:
+                    conn.shutdown(socket.SHUT_RD)
+            while self.in_flight and time.time() < deadline:
+                self.drained.wait(deadline - time.time())
+            for conn in self.connections:
+                conn.shutdown()
+
+    def new_parser(self):
+        return RequestParser(self.max_header_bytes, self.max_body_bytes)
 
-    def handle_request(self, client_socket):      
+    def read_request(self, conn):
+        # Reads one complete request from the connection.
+        # Anything received past the end of the request stays in the connection's parser, so
+        # pipelined requests are picked up by the next call without touching the socket.
+        # Returns the parsed request, or None if the client closed or went idle.
+        while True:
+            request = conn.parser.next_request()
+            if request is not None:
+                return request
+            try:
+                chunk = conn.recv(65536)
+            except socket.timeout:
+                chunk = b""
+            if not chunk:
+                if conn.parser.has_partial_request():
+                    print(f"Incomplete request from {conn.address}")
+                return None
+            conn.parser.feed(chunk)
+
+    def reject_request(self, conn, error):
+        # Answers a request the parser refused and marks the connection for closing,
+        # since the rest of the stream can't be trusted to start at a request boundary
+        print(f"Rejected request from {conn.address}: {error.status}")
+        conn.keep_alive = False
+        conn.closing = True
+        conn.parser.discard()
+        body = f"<h1>{error.status}</h1>".encode('utf-8')
+        self.send_response(conn, error.status, body)
+
+    def wants_keep_alive(self, version, headers):
+        # HTTP/1.1 connections are persistent unless the client sends "Connection: close",
+        # HTTP/1.0 connections are closed unless the client asks for "Connection: keep-alive".
+        connection = get_header(headers, "Connection", "").lower()
+        if version.upper() == "HTTP/1.1":
+            return connection != "close"
+        return connection == "keep-alive"
+
+    def connection_closed(self, conn):
+        # Records how many requests the connection served
+        self.metrics.add("http_active_connections", -1)
+        self.metrics.observe("http_requests_per_connection", conn.requests_served, buckets=Metrics.COUNT_BUCKETS)
+        if conn.requests_served:
+            self.access_log.log(event="connection_closed", client=conn.address[0], requests=conn.requests_served)
+
+    def process_request(self, conn, request):
+        # Dispatches one parsed request to the matching handler and updates the connection's keep-alive state,
+        # then records the request in the access log and metrics
+        start = time.perf_counter()
+        # extract request details
+        method, path, version, headers, body = request
+        conn.requests_served += 1
+        conn.status, conn.response_bytes = None, 0
+        with self.lock:
+            self.last_activity = time.time()
+            self.in_flight += 1
+            conn.busy = True
+            # A draining server answers the requests it has, but asks clients to reconnect for the next one
+            conn.keep_alive = (self.wants_keep_alive(version, headers) and not self.draining
+                               and conn.requests_served < self.max_keepalive_requests)
+        # If no path is specified, the server defaults to serving index.html.
+        if path == "/":
+            path = "/index.html"
+        # URL decode the path
+        path = unquote(path)
+        # GET /metrics reports the server's metrics rather than a file
+        if method.upper() == "GET" and path == "/metrics":
+            self.handle_metrics_request(conn)
+        # If the method is GET, the method calls handle_get_request() to serve the requested file.
+        elif method.upper() == "GET":
+            self.handle_get_request(conn, path, headers)
+        # If the method is POST, the method calls handle_post_request() to process the form data.
+        elif method.upper() == "POST":
+            self.handle_post_request(conn, path, headers, body)
+        # If the method is neither GET nor POST, the method calls handle_unsupported_method().
+        else:
+            self.handle_unsupported_method(conn, method)
+        with self.lock:
+            self.in_flight -= 1
+            conn.busy = False
+            if self.in_flight == 0:
+                self.drained.notify_all()
+        duration = time.perf_counter() - start
+        status = conn.status or "000"
+        # Methods other than GET and POST share one label, so made-up methods can't add series without bound
+        method_label = method.upper() if method.upper() in ("GET", "POST") else "OTHER"
+        self.metrics.inc("http_requests_total", (("method", method_label), ("status", status)))
+        self.metrics.observe("http_request_duration_seconds", duration)
+        self.access_log.log(client=conn.address[0], method=method, path=path, status=int(status),
+                            bytes=conn.response_bytes, duration_ms=round(duration * 1000, 3))
+
+    def handle_metrics_request(self, client_socket):
+        # Serves the metrics registry plus a snapshot of the cache, pool and session store sizes
+        extra = {f"a1_asset_cache_{key}": value for key, value in self.asset_cache.stats().items()}
+        if self.pool is not None:
+            extra.update({f"a1_pool_{key}": value for key, value in self.pool.stats().items()})
+        extra["a1_sessions"] = len(self.sessions)
+        extra["a1_access_log_dropped"] = self.access_log.dropped
+        body = self.metrics.render(extra).encode('utf-8')
+        self.send_response(client_socket, "200 OK", body, content_type="text/plain; version=0.0.4")
+
+    def handle_request(self, client_socket):
+        # Serves a connection with blocking reads and writes. The pool engine also passes back the
+        # Connection of a parked keep-alive connection once its next request has arrived.
+        if isinstance(client_socket, Connection):
+            conn = client_socket
+            conn.settimeout(self.keepalive_timeout)
+        else:
+            conn = Connection(client_socket, parser=self.new_parser())
+            self.metrics.add("http_active_connections", 1)
+            with self.lock:
+                self.connections.add(conn)
+            client_socket.settimeout(5)    # Timeout for receiving the first request
+        client_address = conn.address
+        parked = False
         try:
-            client_address = client_socket.getpeername()
-            # Receive data from client
-            request_data = b""
-            client_socket.settimeout(5)    # Timeout for receiving data
             while True:
                 try:
-                    chunk = client_socket.recv(1024)
-                    if not chunk:
-                        break
-                    request_data += chunk
-                    if b"\r\n\r\n" in request_data:
-                        # End of headers
-                        break
-                except socket.timeout:
+                    request = self.read_request(conn)
+                except RequestError as e:
+                    self.reject_request(conn, e)
                     break
-            # make sure data includes entire request
-            if not request_data:
-                print(f"No data received from {client_address}")
-                client_socket.close()
-                return
-            # extract request details
-            request_line, headers, body = self.parse_request(request_data)
-            if not request_line:
-                print(f"Malformed request from {client_address}")
-                client_socket.close()
-                return
-            # Extract method, path, and version
-            parts = request_line.split()
-            if len(parts) != 3:
-                print(f"Invalid request line from {client_address}: {request_line}")
-                client_socket.close()
-                return
-            method, path, version = parts
-            # If no path is specified, the server defaults to serving index.html.
-            if path == "/":
-                path = "/index.html"
-            # URL decode the path
-            path = unquote(path)
-            # If the method is GET, the method calls handle_get_request() to serve the requested file.
-            if method.upper() == "GET":
-                self.handle_get_request(client_socket, path)
-            # If the method is POST, the method calls handle_post_request() to process the form data.
-            elif method.upper() == "POST":
-                self.handle_post_request(client_socket, path, headers, body)
-            # If the method is neither GET nor POST, the method calls handle_unsupported_method().
-            else:
-                self.handle_unsupported_method(client_socket, method)
+                # make sure data includes entire request
+                if request is None:
+                    if conn.requests_served == 0 and not conn.parser.has_partial_request():
+                        print(f"No data received from {client_address}")
+                    break
+                self.process_request(conn, request)
+                if not conn.keep_alive or self.draining:
+                    break
+                # A pool worker doesn't wait for the next request, unless part of it is already buffered
+                if self.pool is not None and not conn.parser.has_partial_request():
+                    parked = self.park(conn)
+                    break
+                # Wait for the next request on the persistent connection
+                conn.settimeout(self.keepalive_timeout)
         except Exception as e:
             print(f"Error handling request from {client_address}: {e}")
         finally:
-            # After processing the request, the method closes the client socket to terminate the connection.
-            client_socket.close()
+            # Once the client closes, goes idle or asks for "Connection: close", the method closes the client socket.
+            if not parked:
+                self.close_connection(conn)
 
-    def handle_get_request(self, client_socket, file_path):
+    def close_connection(self, conn):
+        with self.lock:
+            self.connections.discard(conn)
+        self.connection_closed(conn)
+        conn.close()
+
+    def send_response(self, client_socket, status, body, content_type="text/html", extra_headers=None,
+                      content_length=None):
+        # Builds the status line and headers for body and sends the complete response.
+        # The Connection header tells the client whether the socket stays open afterwards.
+        # content_length overrides len(body) when the body is sent separately (see send_static).
+        # A "304 Not Modified" response has no body, so it doesn't describe one either.
+        keep_alive = getattr(client_socket, "keep_alive", False)
+        if content_length is None:
+            content_length = len(body)
+        if isinstance(client_socket, Connection):
+            client_socket.status = status.split(" ", 1)[0]
+            client_socket.response_bytes = content_length
+        headers = f"HTTP/1.1 {status}\r\n"
+        if not status.startswith("304"):
+            headers += (
+                f"Content-Length: {content_length}\r\n"
+                f"Content-Type: {content_type}\r\n"
+            )
+        for key, value in (extra_headers or {}).items():
+            headers += f"{key}: {value}\r\n"
+        headers += f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+        client_socket.sendall(headers.encode('utf-8') + body)
+
+    def handle_get_request(self, client_socket, file_path, headers=None):
         try:
             client_address = client_socket.getpeername()
 
@@ -164,46 +1450,169 @@ class Server:
             assets_dir = os.path.join(os.getcwd(), "assets")
             full_path = os.path.join(assets_dir, file_path.lstrip("/"))
 
-            # Check if the file exists
-            if not os.path.isfile(full_path):
+            # Look the file up in the asset cache, which only reads it from disk on a miss
+            asset = self.asset_cache.get(full_path)
+            if asset is None:
                 # File not found
-                response_body = "<h1>404 Not Found</h1>".encode('utf-8')
-                response = (
-                    "HTTP/1.1 404 Not Found\r\n"
-                    f"Content-Length: {len(response_body)}\r\n"
-                    "Content-Type: text/html\r\n"
-                    "\r\n"
-                ).encode('utf-8') + response_body
-                client_socket.sendall(response)
+                self.send_response(client_socket, "404 Not Found", b"<h1>404 Not Found</h1>")
                 return
 
-            # Read the file content
-            with open(full_path, 'rb') as f:
-                content = f.read()
-
-            # If it's an HTML file, replace {{name}} with the client's name
+            # If it's an HTML file, render its placeholders, {{name}} being the client's name
             if full_path.endswith(".html"):
-                content = content.decode('utf-8')
-                with self.lock:
-                    # Use client_address[0] as the session key
-                    name = self.sessions.get(client_address[0], "Guest")
-                    # Debug: print retrieved session data
-                    print(f"Retrieved session for {client_address[0]}: {name}")
-                content = content.replace("{{name}}", name)
-                content = content.encode('utf-8')
-
-            # Prepare and send HTTP response
-            response_headers = (
-                "HTTP/1.1 200 OK\r\n"
-                f"Content-Length: {len(content)}\r\n"
-                "Content-Type: text/html\r\n"
-                "\r\n"
-            ).encode('utf-8')
-            client_socket.sendall(response_headers + content)
+                template = asset.compiled()
+                values = self.template_values(client_address, template.placeholders)
+                # The rendered page differs per client, so its ETag is the file's plus a hash of the values
+                # substituted, which costs the same however large the page is, and a 304 renders nothing
+                values_key = hashlib.sha1(repr(sorted(values.items())).encode('utf-8')).hexdigest()[:16]
+                etag = f'{asset.etag[:-1]}-{values_key}"'
+                if self.is_not_modified(headers or {}, etag, None):
+                    self.send_response(client_socket, "304 Not Modified", b"", extra_headers={"ETag": etag})
+                    return
+                # Prepare and send HTTP response
+                response_headers = {}
+                encoding = self.negotiate_encoding(headers or {}, "text/html", asset.size)
+                content = asset.rendering(template, values, values_key, encoding)
+                if encoding is not None:
+                    etag = f'{etag[:-1]}-{encoding}"'
+                    response_headers["Content-Encoding"] = encoding
+                response_headers["ETag"] = etag
+                response_headers["Vary"] = "Accept-Encoding"
+                self.send_response(client_socket, "200 OK", content, extra_headers=response_headers)
+                return
+
+            # Any other file is sent as is, honouring Range requests
+            self.send_static(client_socket, asset, headers or {})
 
         except Exception as e:
             print(f"Error handling GET request for {file_path} from {client_address}: {e}")
 
+    def parse_range(self, range_header, size):
+        # Parses a "Range: bytes=start-end" header against a file of size bytes.
+        # Returns the inclusive (start, end) to send, or None to send the whole file
+        # (no header, a malformed one, or several ranges, which aren't supported).
+        # Raises ValueError if the range lies outside the file.
+        match = re.fullmatch(r"bytes=(\d*)-(\d*)", (range_header or "").strip())
+        if not match or not (match.group(1) or match.group(2)):
+            return None
+        start, end = match.groups()
+        if not start:
+            # Suffix range, the last end bytes
+            length = int(end)
+            if length == 0 or size == 0:
+                raise ValueError("Empty suffix range")
+            return max(size - length, 0), size - 1
+        start = int(start)
+        if start >= size:
+            raise ValueError("Range starts past the end of the file")
+        end = min(int(end), size - 1) if end else size - 1
+        if start > end:
+            return None
+        return start, end
+
+    def negotiate_encoding(self, headers, content_type, size):
+        # Picks the Content-Encoding for a response from the client's Accept-Encoding header,
+        # preferring br (if the brotli module is installed) over gzip. Returns None to send it uncompressed.
+        if size < self.compress_min_bytes or not is_compressible(content_type):
+            return None
+        accepted = {}
+        for item in get_header(headers, "Accept-Encoding", "").split(","):
+            coding, _, params = item.strip().partition(";")
+            quality = 1.0
+            params = params.strip()
+            if params.startswith("q="):
+                try:
+                    quality = float(params[2:])
+                except ValueError:
+                    quality = 0.0
+            accepted[coding.strip().lower()] = quality
+        for encoding in ("br", "gzip"):
+            if encoding == "br" and brotli is None:
+                continue
+            if accepted.get(encoding, accepted.get("*", 0.0)) > 0:
+                return encoding
+        return None
+
+    def is_not_modified(self, headers, etag, last_modified):
+        # Checks the request's validators against the current ETag and Last-Modified.
+        # If-None-Match takes precedence, If-Modified-Since is only used without it.
+        if_none_match = get_header(headers, "If-None-Match")
+        if if_none_match is not None:
+            for tag in if_none_match.split(","):
+                tag = tag.strip()
+                if tag.startswith("W/"):
+                    tag = tag[2:]
+                # A tag of one of the compressed variants matches the resource too
+                if tag == "*" or tag == etag or tag.startswith(etag[:-1] + "-"):
+                    return True
+            return False
+        if_modified_since = get_header(headers, "If-Modified-Since")
+        if if_modified_since is None or last_modified is None:
+            return False
+        try:
+            return int(last_modified) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+
+    def send_static(self, client_socket, asset, headers):
+        # Sends a file without any processing: from memory if the cache holds its content,
+        # otherwise straight from disk with sendfile so it never gets loaded into Python memory.
+        # A single byte range is answered with "206 Partial Content". Whole files carry ETag and
+        # Last-Modified validators, and cached text files are sent precompressed if the client accepts it.
+        content_type = mimetypes.guess_type(asset.path)[0] or "application/octet-stream"
+        response_headers = {"Accept-Ranges": "bytes", "ETag": asset.etag, "Last-Modified": asset.last_modified}
+        if is_compressible(content_type):
+            response_headers["Vary"] = "Accept-Encoding"
+        if self.is_not_modified(headers, asset.etag, asset.mtime):
+            self.send_response(client_socket, "304 Not Modified", b"", extra_headers=response_headers)
+            return
+        try:
+            byte_range = self.parse_range(get_header(headers, "Range"), asset.size)
+        except ValueError:
+            response_headers["Content-Range"] = f"bytes */{asset.size}"
+            self.send_response(client_socket, "416 Range Not Satisfiable", b"", extra_headers=response_headers)
+            return
+        status = "200 OK"
+        start, end = 0, asset.size - 1
+        if byte_range is not None:
+            status = "206 Partial Content"
+            start, end = byte_range
+            response_headers["Content-Range"] = f"bytes {start}-{end}/{asset.size}"
+        count = end - start + 1
+        if asset.content is not None:
+            encoding = None
+            if byte_range is None:
+                encoding = self.negotiate_encoding(headers, content_type, asset.size)
+            if encoding is not None:
+                response_headers["Content-Encoding"] = encoding
+                response_headers["ETag"] = f'{asset.etag[:-1]}-{encoding}"'
+                body = asset.variant(encoding)
+            elif byte_range is None:
+                body = asset.content
+            else:
+                body = asset.content[start:end + 1]
+            self.send_response(client_socket, status, body, content_type, response_headers)
+            return
+        file = open(asset.path, 'rb')
+        try:
+            self.send_response(client_socket, status, b"", content_type, response_headers, content_length=count)
+        except Exception:
+            file.close()
+            raise
+        client_socket.sendfile(file, start, count)
+
+    def template_values(self, client_address, placeholders):
+        # Returns the values for the placeholders an HTML asset uses
+        values = {}
+        if "name" in placeholders:
+            # Use client_address[0] as the session key
+            name = self.sessions.get(client_address[0], "Guest")
+            values["name"] = name
+        if "addr" in placeholders:
+            values["addr"] = client_address[0]
+        if "time" in placeholders:
+            values["time"] = time.strftime("%Y-%m-%d %H:%M:%S")
+        return values
+
     def handle_post_request(self, client_socket, path, headers, body):
         try:
             client_address = client_socket.getpeername()
@@ -211,47 +1620,21 @@ class Server:
             # For any other paths, the method returns a "404 Not Found" status with an appropriate error message.
             if path != "/change_name":
                 # Unsupported POST path
-                response_body = "<h1>404 Not Found</h1>".encode('utf-8')
-                response = (
-                    "HTTP/1.1 404 Not Found\r\n"
-                    f"Content-Length: {len(response_body)}\r\n"
-                    "Content-Type: text/html\r\n"
-                    "\r\n"
-                ).encode('utf-8') + response_body
-                client_socket.sendall(response)
+                self.send_response(client_socket, "404 Not Found", b"<h1>404 Not Found</h1>")
                 return
 
-            # Parse the form data
-            content_length = int(headers.get("Content-Length", 0))
-            while len(body.encode('utf-8')) < content_length:
-                additional_data = client_socket.recv(1024).decode('utf-8')
-                if not additional_data:
-                    break
-                body += additional_data
-
-            form_data = parse_qs(body)
+            # Parse the form data, the parser has already read the whole body
+            form_data = parse_qs(body.decode('utf-8', 'replace'))
             name = form_data.get("name", ["Guest"])[0]
 
-            # updates the client's name in the sessions dictionary with the provided value from the form data. 
-            with self.lock:
-                self.sessions[client_address[0]] = name  # Update session
-
-            # Debug: print session data after update
-            print(f"Updated session: {self.sessions}")
+            # updates the client's name in the session store with the provided value from the form data. 
+            self.sessions.set(client_address[0], name)  # Update session
 
             # The method then prepares a successful HTTP response by responding with a "200 OK" status 
             # and a message like "Name updated" within the response body.
-            response_body = b"Name updated"
-            response = (
-                "HTTP/1.1 200 OK\r\n"
-                f"Content-Length: {len(response_body)}\r\n"
-                "Content-Type: text/plain\r\n"
-                "\r\n"
-            ).encode('utf-8') + response_body
-
             # Finally, the method constructs and sends the complete HTTP response, 
             # including necessary headers like content type and length, back to the client.
-            client_socket.sendall(response)
+            self.send_response(client_socket, "200 OK", b"Name updated", content_type="text/plain")
         except Exception as e:
             print(f"Error handling POST request for {path} from {client_address}: {e}")
 
@@ -260,15 +1643,96 @@ class Server:
         try:
             # The response body contains an HTML message informing the client that the method used is not allowed. 
             response_body = f"<h1>405 Method Not Allowed</h1><p>The method {method} is not allowed.</p>".encode('utf-8')
-            response = (
-                "HTTP/1.1 405 Method Not Allowed\r\n"
-                f"Content-Length: {len(response_body)}\r\n"
-                "Content-Type: text/html\r\n"
-                "Allow: GET, POST\r\n"
-                "\r\n"
-            ).encode('utf-8') + response_body
             # Finally, the method constructs and sends the complete HTTP response, 
             # including necessary headers like content type and length, back to the client.
-            client_socket.sendall(response)
+            self.send_response(client_socket, "405 Method Not Allowed", response_body,
+                               extra_headers={"Allow": "GET, POST"})
         except Exception as e:
             print(f"Error handling unsupported method {method}: {e}")
+
+
+def run_prefork_worker(addr, port, server_kwargs, session_db, listen_socket, activity, slot, stopping):
+    # Entry point of a PreforkSupervisor worker process. The worker never shuts down on its own:
+    # it reports its last activity in its slot of the shared activity array, since the supervisor owns
+    # the idle timeout, and stops once the shared stopping flag is set. Both are plain shared memory
+    # polled without locks, so a worker killed at any point can't leave the others deadlocked.
+    sessions = SQLiteSessionStore(session_db, ttl=server_kwargs.get("session_ttl", SESSION_TTL),
+                                  max_size=server_kwargs.get("session_max_size", SESSION_MAX_SIZE))
+    server = Server(addr, port, None, sessions=sessions, reuse_port=listen_socket is None,
+                    listen_socket=listen_socket, **server_kwargs)
+
+    def report_activity():
+        while not stopping.value:
+            activity[slot] = server.last_activity
+            time.sleep(0.5)
+        server.stop_server()
+
+    monitor = threading.Thread(target=report_activity)
+    monitor.daemon = True
+    monitor.start()
+    server.start_server()
+    sessions.close()
+
+
+class PreforkSupervisor:
+    # Runs the server in processes worker processes, so requests are spread over several cores.
+    # Each worker runs its own Server on the same port: with SO_REUSEPORT the kernel balances new
+    # connections between their sockets, otherwise they all accept from one socket the supervisor
+    # opens and hands down. Workers that die are restarted. The supervisor tracks the most recent
+    # activity of any worker and stops them all once none has accepted a connection for timeout seconds.
+    # Consecutive requests from one client can land on different workers, so sessions live in an
+    # SQLiteSessionStore at session_db that all workers share. Other keyword arguments go to each Server.
+    def __init__(self, addr, port, timeout, processes=None, session_db=None, **server_kwargs):
+        self.addr = addr
+        self.port = port
+        self.timeout = timeout
+        self.processes = processes or os.cpu_count() or 1
+        self.session_db = session_db or os.path.join(tempfile.gettempdir(), f"a1_sessions_{port}.db")
+        self.server_kwargs = server_kwargs
+        self.listen_socket = None
+        if not hasattr(socket, "SO_REUSEPORT"):
+            self.listen_socket = create_listen_socket(addr, port, server_kwargs.get("backlog", 5))
+        self.activity = multiprocessing.RawArray('d', [time.time()] * self.processes)
+        self.stopping = multiprocessing.RawValue('b', 0)
+        self.workers = []
+        self.running = False
+
+    def spawn_worker(self, slot):
+        worker = multiprocessing.Process(
+            target=run_prefork_worker,
+            args=(self.addr, self.port, dict(self.server_kwargs), self.session_db, self.listen_socket,
+                  self.activity, slot, self.stopping),
+        )
+        worker.daemon = True
+        worker.start()
+        return worker
+
+    def last_activity(self):
+        return max(self.activity)
+
+    def start(self):
+        # Starts the workers and supervises them until the idle timeout or stop()
+        self.running = True
+        self.workers = [self.spawn_worker(slot) for slot in range(self.processes)]
+        while self.running:
+            time.sleep(0.5)
+            if self.timeout is not None and time.time() - self.last_activity() > self.timeout:
+                print("Server timeout reached. Shutting down.")
+                break
+            for slot, worker in enumerate(self.workers):
+                if not worker.is_alive() and self.running:
+                    print(f"Worker {worker.pid} exited with code {worker.exitcode}, restarting")
+                    self.workers[slot] = self.spawn_worker(slot)
+        self.stop()
+
+    def stop(self):
+        # Tells the workers to stop, waiting a few seconds for them before killing any that remain
+        self.running = False
+        self.stopping.value = 1
+        for worker in self.workers:
+            worker.join(timeout=5)
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
+        if self.listen_socket is not None:
+            self.listen_socket.close()
@@ -1,5 +1,5 @@
-import socket, threading, time
-from server import Server
+import socket, threading, time, os, tempfile, gzip, json
+from server import Server, AssetCache, Template, RequestParser, RequestError, SessionStore, SQLiteSessionStore, PreforkSupervisor, AccessLog, Metrics
 addr = '127.0.0.1'
 port = 8080
 
@@ -27,7 +27,7 @@ def test_3():# Test 3: Test a request for a nonexistent file
 
 def test_4():# Test 4: Test a simple POST request
     with socket.create_connection((addr, port)) as client_socket:
-        client_socket.sendall(b"POST /change_name HTTP/1.1\r\nHost: localhost\r\nContent-Length: 9\r\n\r\nname=Alice")
+        client_socket.sendall(b"POST /change_name HTTP/1.1\r\nHost: localhost\r\nContent-Length: 10\r\n\r\nname=Alice")
         response = client_socket.recv(4096).decode()
     with socket.create_connection((addr, port)) as client_socket:
         client_socket.sendall(b"GET / HTTP/1.1\r\nHost: localhost\r\n\r\n")
@@ -36,9 +36,352 @@ def test_4():# Test 4: Test a simple POST request
     if cond:print("Test 4 passed")
     else:print("Test 4 failed")
 
-if __name__ == "__main__":
+def recv_response(client_socket, buffer=b""):# Reads exactly one response (headers + Content-Length body) off a persistent connection
+    response, rest = recv_response_bytes(client_socket, buffer)
+    return response.decode(), rest
+
+def recv_response_bytes(client_socket, buffer=b""):
+    while b"\r\n\r\n" not in buffer:
+        buffer += client_socket.recv(4096)
+    header_end = buffer.index(b"\r\n\r\n") + 4
+    length = 0
+    for line in buffer[:header_end].decode().split("\r\n"):
+        if line.lower().startswith("content-length:"):length = int(line.split(":", 1)[1])
+    while len(buffer) < header_end + length:
+        buffer += client_socket.recv(4096)
+    return buffer[:header_end + length], buffer[header_end + length:]
+
+def test_5():# Test 5: Test keep-alive with two pipelined GET requests on one connection
+    with socket.create_connection((addr, port)) as client_socket:
+        client_socket.sendall(b"GET / HTTP/1.1\r\nHost: localhost\r\n\r\nGET /nonexistent.html HTTP/1.1\r\nHost: localhost\r\n\r\n")
+        first, rest = recv_response(client_socket)
+        second, _ = recv_response(client_socket, rest)
+        cond = "200 OK" in first and "Connection: keep-alive" in first and "404 Not Found" in second
+    if cond:print("Test 5 passed")
+    else:print("Test 5 failed")
+
+def test_6():# Test 6: Test that Connection: close makes the server close the socket after the response
+    with socket.create_connection((addr, port)) as client_socket:
+        client_socket.sendall(b"GET / HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n")
+        response, rest = recv_response(client_socket)
+        cond = "Connection: close" in response and rest == b"" and client_socket.recv(4096) == b""
+    if cond:print("Test 6 passed")
+    else:print("Test 6 failed")
+
+def test_7():# Test 7: Test that a full worker pool rejects new connections with 503 and Retry-After
+    server = Server(addr, port + 1, 5, engine="pool", workers=1, queue_size=1, overload="reject", retry_after=2)
+    server_thread = threading.Thread(target=server.start_server)
+    server_thread.start()
+    with socket.create_connection((addr, port + 1)) as busy:
+        time.sleep(0.5)# busy holds the only worker
+        queued = socket.create_connection((addr, port + 1))# queued fills the only queue slot
+        time.sleep(0.5)
+        with socket.create_connection((addr, port + 1)) as client_socket:
+            response, _ = recv_response(client_socket)
+        stats = server.pool.stats()
+        cond = "503 Service Unavailable" in response and "Retry-After: 2" in response and stats["rejected"] == 1
+        queued.close()
+    server.stop_server()
+    server_thread.join()
+    if cond:print("Test 7 passed")
+    else:print("Test 7 failed")
+
+def test_8():# Test 8: Test asset cache hits, revalidation, negative caching and eviction
+    with tempfile.TemporaryDirectory() as tmp:
+        path, missing = os.path.join(tmp, "a.html"), os.path.join(tmp, "missing.html")
+        with open(path, "wb") as f:f.write(b"x" * 10)
+        cache = AssetCache(max_bytes=15, revalidate=0)
+        first, second = cache.get(path), cache.get(path)
+        with open(path, "wb") as f:f.write(b"y" * 12)
+        changed = cache.get(path)
+        cache.get(missing), cache.get(missing)
+        with open(os.path.join(tmp, "b.html"), "wb") as f:f.write(b"z" * 8)
+        cache.get(os.path.join(tmp, "b.html"))# 12 + 8 bytes doesn't fit in 15, a.html is evicted
+        stats = cache.stats()
+        bounded = AssetCache(max_bytes=1000, revalidate=0, max_entries=100)
+        for i in range(1000):bounded.get(os.path.join(tmp, f"missing{i}.html"))# Negative entries hold no bytes but count as entries
+        bounded_stats = bounded.stats()
+        cond = (first.content == second.content == b"x" * 10 and changed.content == b"y" * 12
+                and stats["hits"] == 1 and stats["negative_hits"] == 1 and stats["evictions"] == 1 and stats["bytes"] == 8
+                and bounded_stats["entries"] == 100 and bounded_stats["evictions"] == 900)
+    if cond:print("Test 8 passed")
+    else:print("Test 8 failed")
+
+def test_9():# Test 9: Test that a compiled template fills in every known placeholder and leaves the rest alone
+    template = Template("<p>Hi {{name}} from {{ addr }}, {{unknown}} ünïcode</p>".encode('utf-8'))
+    rendered = template.render({"name": "Zoë", "addr": "10.0.0.1"})
+    cond = rendered.decode('utf-8') == "<p>Hi Zoë from 10.0.0.1, {{unknown}} ünïcode</p>" and template.placeholders == {"name", "addr", "unknown"}
+    if cond:print("Test 9 passed")
+    else:print("Test 9 failed")
+
+def test_10():# Test 10: Test streaming a large file, a Range request and a request pipelined behind them
+    large_path = os.path.join("assets", "large_test.bin")
+    data = bytes(range(256)) * 4096# 1 MiB, above the sendfile threshold
+    with open(large_path, "wb") as f:f.write(data)
+    try:
+        with socket.create_connection((addr, port)) as client_socket:
+            client_socket.sendall(b"GET /large_test.bin HTTP/1.1\r\nHost: localhost\r\n\r\n"
+                                  b"GET /large_test.bin HTTP/1.1\r\nHost: localhost\r\nRange: bytes=1000-1999\r\n\r\n"
+                                  b"GET /large_test.bin HTTP/1.1\r\nHost: localhost\r\nRange: bytes=5000000-\r\n\r\n")
+            full, rest = recv_response_bytes(client_socket)
+            partial, rest = recv_response_bytes(client_socket, rest)
+            unsatisfiable, _ = recv_response_bytes(client_socket, rest)
+        cond = (full.startswith(b"HTTP/1.1 200 OK") and full.endswith(data) and b"Content-Type: application/octet-stream" in full
+                and partial.startswith(b"HTTP/1.1 206 Partial Content") and partial.endswith(data[1000:2000])
+                and b"Content-Range: bytes 1000-1999/1048576" in partial and b"416 Range Not Satisfiable" in unsatisfiable)
+    finally:
+        os.remove(large_path)
+    if cond:print("Test 10 passed")
+    else:print("Test 10 failed")
+
+def test_11():# Test 11: Test gzip compression and 304 responses to If-None-Match and If-Modified-Since, for files and pages
+    css_path = os.path.join("assets", "style_test.css")
+    html_path = os.path.join("assets", "page_test.html")
+    data = b"body { color: black; }\n" * 200
+    with open(css_path, "wb") as f:f.write(data)
     try:
-        server = Server(addr, port, 5)
+        with socket.create_connection((addr, port)) as client_socket:
+            client_socket.sendall(b"GET /style_test.css HTTP/1.1\r\nHost: localhost\r\nAccept-Encoding: gzip, deflate\r\n\r\n")
+            compressed, rest = recv_response_bytes(client_socket)
+            headers = compressed.split(b"\r\n\r\n")[0].decode()
+            etag = [line.split(": ", 1)[1] for line in headers.split("\r\n") if line.startswith("ETag:")][0]
+            modified = [line.split(": ", 1)[1] for line in headers.split("\r\n") if line.startswith("Last-Modified:")][0]
+            client_socket.sendall(f"GET /style_test.css HTTP/1.1\r\nHost: localhost\r\nIf-None-Match: {etag}\r\n\r\n".encode())
+            by_etag, rest = recv_response_bytes(client_socket, rest)
+            client_socket.sendall(f"GET /style_test.css HTTP/1.1\r\nHost: localhost\r\nIf-Modified-Since: {modified}\r\n\r\n".encode())
+            by_date, _ = recv_response_bytes(client_socket, rest)
+        with open(html_path, "wb") as f:f.write(b"<p>Hello {{name}}</p>\n" + b"<p>filler</p>\n" * 200)
+        pages = []
+        with socket.create_connection((addr, port)) as client_socket:
+            rest = b""
+            for i in range(2):# The same values give the same ETag, and a 304 once the client has the page
+                client_socket.sendall(b"GET /page_test.html HTTP/1.1\r\nHost: localhost\r\nAccept-Encoding: gzip\r\n\r\n")
+                page, rest = recv_response_bytes(client_socket, rest)
+                pages.append(page)
+            page_headers = pages[0].split(b"\r\n\r\n")[0].decode()
+            page_etag = [line.split(": ", 1)[1] for line in page_headers.split("\r\n") if line.startswith("ETag:")][0]
+            client_socket.sendall(f"GET /page_test.html HTTP/1.1\r\nHost: localhost\r\nIf-None-Match: {page_etag}\r\n\r\n".encode())
+            page_by_etag, _ = recv_response_bytes(client_socket, rest)
+        asset = AssetCache().get(html_path)
+        template = asset.compiled()
+        rendered = asset.rendering(template, {"name": "Alice"}, "alice", "gzip")
+        reused = asset.rendering(template, {"name": "Alice"}, "alice", "gzip") is rendered
+        cond = ("Content-Encoding: gzip" in headers and gzip.decompress(compressed.split(b"\r\n\r\n", 1)[1]) == data
+                and by_etag.startswith(b"HTTP/1.1 304 Not Modified") and by_date.startswith(b"HTTP/1.1 304 Not Modified")
+                and "Content-Encoding: gzip" in page_headers and pages[0] == pages[1]
+                and gzip.decompress(pages[0].split(b"\r\n\r\n", 1)[1]).startswith(b"<p>Hello ")
+                and page_by_etag.startswith(b"HTTP/1.1 304 Not Modified")
+                and gzip.decompress(rendered).startswith(b"<p>Hello Alice</p>") and reused)
+    finally:
+        os.remove(css_path)
+        if os.path.exists(html_path):os.remove(html_path)
+    if cond:print("Test 11 passed")
+    else:print("Test 11 failed")
+
+def test_12():# Test 12: Test the incremental parser on a request fed byte by byte, pipelining and size limits
+    parser = RequestParser(max_header_bytes=1024, max_body_bytes=16)
+    requests = []
+    for byte in b"POST /change_name HTTP/1.1\r\nContent-Length: 10\r\n\r\nname=AliceGET / HTTP/1.1\r\nHost: x\r\n\r\n":
+        parser.feed(bytes([byte]))
+        request = parser.next_request()
+        if request is not None:requests.append(request)
+    errors = []
+    for data in (b"GET / HTTP/1.1\r\nX-Long: " + b"a" * 2000, b"POST / HTTP/1.1\r\nContent-Length: 17\r\n\r\n"):
+        parser = RequestParser(max_header_bytes=1024, max_body_bytes=16)
+        parser.feed(data)
+        try:parser.next_request()
+        except RequestError as e:errors.append(e.status)
+    cond = (len(requests) == 2 and requests[0][:3] == ("POST", "/change_name", "HTTP/1.1") and requests[0][4] == b"name=Alice"
+            and requests[1][3] == {"host": "x"} and errors == ["431 Request Header Fields Too Large", "413 Content Too Large"])
+    if cond:print("Test 12 passed")
+    else:print("Test 12 failed")
+
+def test_13():# Test 13: Test session expiry and size limits, and that SQLite sessions survive a restart
+    store = SessionStore(ttl=0.2, max_size=4, stripes=2)
+    for i in range(10):store.set(f"10.0.0.{i}", f"user{i}")
+    sized = len(store) <= 4 and store.get("10.0.0.9") == "user9"# Which keys survive depends on their stripes
+    small = SessionStore(max_size=4)# Fewer entries than the default 16 stripes
+    for i in range(20):small.set(f"10.0.1.{i}", f"user{i}")
+    sized = sized and len(small) <= 4 and small.get("10.0.1.19") == "user19"
+    time.sleep(0.3)
+    expired = store.get("10.0.0.9", "Guest") == "Guest"
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "sessions.db")
+        first = SQLiteSessionStore(db_path)
+        first.set("127.0.0.1", "Alice")
+        first.close()
+        second = SQLiteSessionStore(db_path, max_size=3)
+        persisted = second.get("127.0.0.1") == "Alice"
+        for i in range(10):second.set(f"10.0.2.{i}", f"user{i}")
+        second.set("10.0.2.9", "renamed")# Setting a key again adds no row
+        sized = sized and len(second) == 3 and second.get("10.0.2.7") == "user7" and second.get("10.0.2.9") == "renamed"
+        second.close()
+    server = Server(addr, port + 6, None)# Sessions are bounded by default, unlike the dict they replaced
+    bounded = server.sessions.ttl is not None and server.sessions.max_size is not None
+    server.stop_server()
+    small_server = Server(addr, port + 6, None, session_ttl=60, session_max_size=2)
+    bounded = bounded and small_server.sessions.ttl == 60 and small_server.sessions.max_size == 2
+    small_server.stop_server()
+    cond = sized and expired and persisted and bounded
+    if cond:print("Test 13 passed")
+    else:print("Test 13 failed")
+
+def test_14():# Test 14: Test that prefork workers share sessions and that a killed worker is replaced
+    with tempfile.TemporaryDirectory() as tmp:
+        supervisor = PreforkSupervisor(addr, port + 2, 10, processes=2, session_db=os.path.join(tmp, "sessions.db"))
+        supervisor_thread = threading.Thread(target=supervisor.start)
+        supervisor_thread.start()
+        time.sleep(1)
+        with socket.create_connection((addr, port + 2)) as client_socket:
+            client_socket.sendall(b"POST /change_name HTTP/1.1\r\nHost: localhost\r\nContent-Length: 8\r\n\r\nname=Bob")
+            recv_response(client_socket)
+        responses = []
+        for _ in range(6):# New connections are spread over both workers
+            with socket.create_connection((addr, port + 2)) as client_socket:
+                client_socket.sendall(b"GET / HTTP/1.1\r\nHost: localhost\r\n\r\n")
+                responses.append(recv_response(client_socket)[0])
+        killed = supervisor.workers[0]
+        killed.kill()
+        time.sleep(1.5)
+        restarted = supervisor.workers[0] is not killed and supervisor.workers[0].is_alive()
+        supervisor.stop()
+        supervisor_thread.join()
+    cond = all("Hello Bob" in response for response in responses) and restarted
+    if cond:print("Test 14 passed")
+    else:print("Test 14 failed")
+
+def test_15():# Test 15: Test that /metrics counts requests and reports cache stats
+    with socket.create_connection((addr, port)) as client_socket:
+        client_socket.sendall(b"BREW / HTTP/1.1\r\nHost: localhost\r\n\r\n")# Unknown methods share the "OTHER" label
+        recv_response(client_socket)
+        client_socket.sendall(b"GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n")
+        response, _ = recv_response(client_socket)
+    metrics = Metrics()
+    for count in (1, 3, 10, 100):metrics.observe("requests", count, buckets=Metrics.COUNT_BUCKETS)
+    metrics.inc("labelled", (("value", 'a"b\\c\nd'),))
+    rendered = metrics.render()
+    cond = ('http_requests_total{method="GET",status="200"}' in response and "http_request_duration_seconds_count" in response
+            and 'http_requests_total{method="OTHER",status="405"}' in response and "BREW" not in response
+            and "a1_asset_cache_hits" in response and "http_active_connections" in response
+            and 'requests_bucket{le="5"} 2' in rendered and 'requests_bucket{le="10"} 3' in rendered
+            and 'requests_bucket{le="100"} 4' in rendered and 'labelled{value="a\\"b\\\\c\\nd"} 1' in rendered)
+    if cond:print("Test 15 passed")
+    else:print("Test 15 failed")
+
+def test_16():# Test 16: Test that the access log writes one JSON object per entry
+    with tempfile.TemporaryDirectory() as tmp:
+        log_path = os.path.join(tmp, "access.log")
+        access_log = AccessLog(log_path)
+        for i in range(100):access_log.log(method="GET", path=f"/{i}", status=200)
+        access_log.close()
+        with open(log_path) as f:entries = [json.loads(line) for line in f]
+    cond = len(entries) == 100 and entries[99]["path"] == "/99" and "time" in entries[0]
+    if cond:print("Test 16 passed")
+    else:print("Test 16 failed")
+
+def test_17(engine):# Test 17: Test that stopping the server closes idle connections and lets a response in progress finish
+    large_path = os.path.join("assets", "drain_test.bin")
+    data = bytes(range(256)) * 32768# 8 MiB, more than the socket buffers hold
+    with open(large_path, "wb") as f:f.write(data)
+    server = Server(addr, port + 3, None, engine=engine, drain_timeout=5)
+    server_thread = threading.Thread(target=server.start_server)
+    server_thread.start()
+    time.sleep(0.5)
+    try:
+        idle = socket.create_connection((addr, port + 3))
+        idle.settimeout(5)
+        idle.sendall(b"GET / HTTP/1.1\r\nHost: localhost\r\n\r\n")
+        recv_response_bytes(idle)# idle is now an idle keep-alive connection
+        slow = socket.create_connection((addr, port + 3))
+        slow.settimeout(5)
+        slow.sendall(b"GET /drain_test.bin HTTP/1.1\r\nHost: localhost\r\n\r\n")
+        time.sleep(0.5)# The server is now blocked writing to slow, which isn't reading
+        start = time.time()
+        stopper = threading.Thread(target=server.stop_server)
+        stopper.start()
+        idle_closed = idle.recv(4096) == b""
+        response = bytearray()
+        chunk = slow.recv(1 << 20)
+        while chunk:# The server closes slow once the response is out
+            response += chunk
+            chunk = slow.recv(1 << 20)
+        stopper.join()
+        stop_time = time.time() - start
+        try:
+            socket.create_connection((addr, port + 3), timeout=1).close()
+            refused = False
+        except OSError:
+            refused = True
+        cond = (idle_closed and response.startswith(b"HTTP/1.1 200 OK") and response.endswith(data)
+                and refused and stop_time < 4)
+        idle.close()
+        slow.close()
+    finally:
+        server.stop_server()
+        server_thread.join()
+        os.remove(large_path)
+    if cond:print("Test 17 passed")
+    else:print("Test 17 failed")
+
+def test_18(engine):# Test 18: Test that a refused first request gets one error response and the connection is closed
+    server = Server(addr, port + 4, None, engine=engine, max_header_bytes=1024)
+    server_thread = threading.Thread(target=server.start_server)
+    server_thread.start()
+    time.sleep(0.5)
+    try:
+        with socket.create_connection((addr, port + 4)) as client_socket:
+            client_socket.settimeout(5)
+            client_socket.sendall(b"GET / HTTP/1.1\r\nX-Long: " + b"a" * 2048 + b"\r\n\r\n")
+            response = bytearray()
+            try:
+                chunk = client_socket.recv(65536)
+                while chunk:
+                    response += chunk
+                    chunk = client_socket.recv(65536)
+                closed = True
+            except socket.timeout:
+                closed = False
+        cond = closed and response.startswith(b"HTTP/1.1 431") and response.count(b"HTTP/1.1 ") == 1
+    finally:
+        server.stop_server()
+        server_thread.join()
+    if cond:print("Test 18 passed")
+    else:print("Test 18 failed")
+
+def test_19():# Test 19: Test that idle keep-alive connections don't hold the pool's workers from new clients
+    server = Server(addr, port + 5, None, engine="pool", workers=2, keepalive_timeout=5)
+    server_thread = threading.Thread(target=server.start_server)
+    server_thread.start()
+    time.sleep(0.5)
+    idle = []
+    try:
+        for i in range(4):# Twice as many idle keep-alive connections as workers; timeouts outlast keepalive_timeout
+            client_socket = socket.create_connection((addr, port + 5))
+            client_socket.settimeout(10)
+            client_socket.sendall(b"GET / HTTP/1.1\r\nHost: localhost\r\n\r\n")
+            recv_response_bytes(client_socket)
+            idle.append(client_socket)
+        start = time.time()
+        with socket.create_connection((addr, port + 5)) as client_socket:
+            client_socket.settimeout(10)
+            client_socket.sendall(b"GET / HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n")
+            response, _ = recv_response(client_socket)
+        wait = time.time() - start
+        resumed = ""
+        if wait < 1:# Otherwise the server has closed the idle connections after keepalive_timeout
+            idle[0].sendall(b"GET / HTTP/1.1\r\nHost: localhost\r\n\r\n")# A parked connection is served again
+            resumed, _ = recv_response(idle[0])
+        cond = "200 OK" in response and wait < 1 and "200 OK" in resumed
+    finally:
+        for client_socket in idle:client_socket.close()
+        server.stop_server()
+        server_thread.join()
+    if cond:print("Test 19 passed")
+    else:print("Test 19 failed")
+
+def run_tests(engine="threads"):# Starts a server with the given engine, runs every test against it and stops it
+    try:
+        server = Server(addr, port, 5, engine=engine)
         server_thread = threading.Thread(target=server.start_server)
         server_thread.start()
         time.sleep(1)
@@ -48,7 +391,31 @@ if __name__ == "__main__":
     test_2()
     test_3()
     test_4()
+    test_5()
+    test_6()
+    test_10()
+    test_11()
+    test_15()
     try:
         server.stop_server()
         server_thread.join()
-    except Exception:pass
\ No newline at end of file
+    except Exception:pass
+
+if __name__ == "__main__":
+    run_tests("threads")
+    run_tests("selector")
+    run_tests("pool")
+    test_7()
+    test_8()
+    test_9()
+    test_12()
+    test_13()
+    test_14()
+    test_16()
+    test_17("threads")
+    test_17("selector")
+    test_17("pool")
+    test_18("threads")
+    test_18("selector")
+    test_18("pool")
+    test_19()
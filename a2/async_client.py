@@ -0,0 +1,235 @@
+# asyncio clients for the a2 chat servers, for bots and bridges that host many chat users in one process.
+# They speak the same protocols as ClientTCP and ClientUDP, but need no threads and print nothing:
+#     client = AsyncClientTCP("bot", 12345)
+#     await client.connect()
+#     await client.send("hello")
+#     async for message in client:
+#         ...
+#     await client.close()
+# Iterating yields every message from the server as a string. It stops when the server shuts down,
+# which also sets the server_shutdown event, or when the connection is lost.
+import asyncio
+import collections
+import socket
+from chatroom import ReliableUDP, FrameDecoder, encode_frame, FRAME_JOIN, FRAME_CHAT, FRAME_EXIT, FRAME_SHUTDOWN, FRAME_WELCOME
+
+
+class AsyncClientTCP:
+    # With framed=False the client speaks the plain-text protocol, where each read is taken as one message
+    def __init__(self, client_name, server_port, server_addr=None, framed=True):
+        self.server_addr = server_addr or socket.gethostbyname(socket.gethostname())
+        self.server_port = server_port
+        self.client_name = client_name
+        self.framed = framed
+        self.decoder = FrameDecoder()
+        self.frames = collections.deque()    # Frames received but not returned yet
+        self.reader = None
+        self.writer = None
+        self.closed = False
+        self.server_shutdown = asyncio.Event()
+
+    async def connect(self):
+        # Joins the chatroom, raising ConnectionError if the server refuses the name
+        self.reader, self.writer = await asyncio.open_connection(self.server_addr, self.server_port)
+        if self.framed:
+            self.writer.write(encode_frame(FRAME_JOIN, self.client_name))
+            frame = await self.receive_frame()
+            joined = frame is not None and frame[0] == FRAME_WELCOME
+            response = frame[1].decode(errors="replace") if frame else ""
+        else:
+            self.writer.write(self.client_name.encode())
+            response = (await self.reader.read(1024)).decode(errors="replace")
+            joined = 'Welcome' in response
+        if not joined:
+            await self.close(notify=False)
+            raise ConnectionError(f"Failed to join the chatroom: {response}")
+
+    async def receive_frame(self):
+        # Returns the next frame from the server, or None once the connection is closed or the server
+        # sent a frame too large to decode, after which the stream can't be read any further
+        while not self.frames:
+            data = await self.reader.read(65536)
+            if not data:
+                return None
+            try:
+                self.frames.extend(self.decoder.feed(data))
+            except ValueError:
+                return None
+        return self.frames.popleft()
+
+    async def send(self, text):
+        if self.framed:
+            self.writer.write(encode_frame(FRAME_EXIT if text == 'exit' else FRAME_CHAT, text))
+        else:
+            self.writer.write(text.encode())
+        await self.writer.drain()
+
+    async def send_many(self, texts):
+        # Sends several chat messages in one write; needs the framed protocol to keep them apart
+        self.writer.write(b"".join(encode_frame(FRAME_CHAT, text) for text in texts))
+        await self.writer.drain()
+
+    async def receive(self):
+        # Returns the next message from the server, or None once it shut down or the connection is lost
+        if self.closed:
+            return None
+        try:
+            if self.framed:
+                frame = await self.receive_frame()
+                if frame is None:
+                    return None
+                if frame[0] == FRAME_SHUTDOWN:
+                    self.server_shutdown.set()
+                    return None
+                return frame[1].decode(errors="replace")
+            data = await self.reader.read(1024)
+        except (ConnectionError, OSError):
+            return None
+        message = data.decode(errors="replace")
+        if message == 'server-shutdown':
+            self.server_shutdown.set()
+            return None
+        return message or None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        message = await self.receive()
+        if message is None:
+            raise StopAsyncIteration
+        return message
+
+    async def close(self, notify=True):
+        # Leaves the chatroom, telling the server unless it is shutting down
+        if self.closed or self.writer is None:
+            return
+        self.closed = True
+        try:
+            if notify and not self.server_shutdown.is_set():
+                await self.send('exit')
+            self.writer.close()
+            await self.writer.wait_closed()
+        except (ConnectionError, OSError):
+            pass
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+
+class ChatDatagramProtocol(asyncio.DatagramProtocol):
+    # Passes the datagrams of an AsyncClientUDP's endpoint on to it
+    def __init__(self, client):
+        self.client = client
+
+    def datagram_received(self, data, addr):
+        self.client.datagram_received(data, addr)
+
+    def error_received(self, exc):
+        pass  # e.g. the server isn't up yet; the reliability layer retransmits
+
+
+class AsyncClientUDP:
+    # With reliable=True messages both ways go through a ReliableUDP, whose retransmissions are
+    # made by a task of the client rather than a thread
+    def __init__(self, client_name, server_port, server_addr=None, reliable=True, join_timeout=5):
+        self.server_addr = server_addr or socket.gethostbyname(socket.gethostname())
+        self.server_port = server_port
+        self.client_name = client_name
+        self.use_reliable = reliable
+        self.join_timeout = join_timeout
+        self.transport = None
+        self.reliable = None
+        self.retransmitter = None
+        self.inbox = asyncio.Queue()    # Messages received, None once there will be no more
+        self.closed = False
+        self.server_shutdown = asyncio.Event()
+
+    async def connect(self):
+        # Joins the chatroom, raising ConnectionError if the server refuses the name or doesn't answer
+        loop = asyncio.get_running_loop()
+        self.transport, _ = await loop.create_datagram_endpoint(lambda: ChatDatagramProtocol(self),
+                                                                local_addr=("0.0.0.0", 0))
+        if self.use_reliable:
+            # The transport has the sendto(data, addr) a ReliableUDP needs from its socket
+            self.reliable = ReliableUDP(self.transport)
+            self.retransmitter = asyncio.create_task(self.retransmit())
+        await self.send(f"join:{self.client_name}")
+        try:
+            response = await asyncio.wait_for(self.inbox.get(), self.join_timeout)
+        except asyncio.TimeoutError:
+            response = None
+        if response is None or 'Welcome' not in response:
+            await self.close(notify=False)
+            raise ConnectionError(f"Failed to join the chatroom: {response or 'no answer'}")
+
+    def datagram_received(self, data, addr):
+        if data[:1] == b"\0" and self.reliable is not None:
+            payloads = self.reliable.receive(data, addr)
+        else:
+            payloads = [data]
+        for payload in payloads:
+            self.inbox.put_nowait(payload.decode(errors="replace"))
+
+    async def retransmit(self):
+        while True:
+            await asyncio.sleep(self.reliable.timeout / 2)
+            if self.reliable.retransmit():
+                self.inbox.put_nowait(None)    # The server stopped acknowledging
+                return
+
+    async def send(self, text):
+        server = (self.server_addr, self.server_port)
+        if self.reliable is not None:
+            self.reliable.send(text.encode(), server)
+        else:
+            self.transport.sendto(text.encode(), server)
+
+    async def receive(self):
+        # Returns the next message from the server, or None once it shut down or the client is closed
+        if self.closed:
+            return None
+        message = await self.inbox.get()
+        if message is None:
+            return None
+        if 'server-shutdown' in message:
+            self.server_shutdown.set()
+            return None
+        return message
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        message = await self.receive()
+        if message is None:
+            raise StopAsyncIteration
+        return message
+
+    async def close(self, notify=True):
+        # Leaves the chatroom, giving the reliability layer up to a second to deliver the exit
+        if self.closed or self.transport is None:
+            return
+        self.closed = True
+        if notify and not self.server_shutdown.is_set():
+            await self.send('exit')
+            if self.reliable is not None:
+                for _ in range(20):
+                    if not self.reliable.in_flight():
+                        break
+                    await asyncio.sleep(0.05)
+        if self.retransmitter is not None:
+            self.retransmitter.cancel()
+        self.transport.close()
+        self.inbox.put_nowait(None)
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
@@ -0,0 +1,256 @@
+# Load simulator and fan-out benchmark for the a2 chat servers.
+# to run in terminal: python bench_chatroom.py --protocols tcp udp --clients 200 --rate 100 --duration 5
+# The server runs in its own process. --clients synthetic clients, speaking the same wire protocols as
+# ClientTCP and ClientUDP but all driven from one thread, join it (spread over --rooms rooms) and
+# --senders of them send --rate messages/sec for --duration seconds. Every message carries its send time,
+# so each delivery gives an end-to-end fan-out latency. Reports delivered and lost messages, latency
+# percentiles and the server process's CPU time and peak memory. Runs headless, without input().
+import argparse
+import json
+import multiprocessing
+import os
+import re
+import resource
+import selectors
+import signal
+import socket
+import sys
+import time
+from chatroom import ServerTCP, ServerUDP, ReliableUDP, FrameDecoder, encode_frame, FRAME_JOIN, FRAME_CHAT, FRAME_WELCOME
+
+MESSAGE = re.compile(rb"m (\d+) (\d+\.\d+)")
+
+
+def run_server(protocol, port):
+    # Entry point of the server process. SIGINT raises KeyboardInterrupt in run(), which shuts the server down.
+    sys.stdout = open(os.devnull, 'w')
+    server = ServerTCP(port) if protocol.startswith("tcp") else ServerUDP(port)
+    server.run()
+
+
+class SimClient:
+    # One synthetic client. send() sends a chat message, read() handles whatever the socket has
+    # and returns the send times of the benchmark messages it completed.
+    def __init__(self, name, protocol, server):
+        self.name = name
+        self.protocol = protocol
+        self.server = server
+        self.joined = False
+        self.room = None
+        self.buffer = b""
+        if protocol.startswith("tcp"):
+            self.sock = socket.create_connection(server)
+            self.decoder = FrameDecoder() if protocol == "tcp" else None
+            self.sock.sendall(encode_frame(FRAME_JOIN, name) if self.decoder else name.encode())
+        else:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.sock.connect(server)
+            self.reliable = ReliableUDP(self.sock) if protocol == "udp" else None
+            self.send(f"join:{name}")
+        self.sock.setblocking(False)
+
+    def send(self, text):
+        if self.protocol == "tcp":
+            self.sock.sendall(encode_frame(FRAME_CHAT, text))
+        elif self.protocol == "tcp-plain":
+            # Plain-text TCP has no message boundaries; the newline ends a benchmark message
+            self.sock.sendall(text.encode() + b"\n")
+        elif self.reliable is not None:
+            self.reliable.send(text.encode(), self.server)
+        else:
+            self.sock.send(text.encode())
+
+    def read(self):
+        try:
+            if self.protocol.startswith("tcp"):
+                data = self.sock.recv(65536)
+            else:
+                data, addr = self.sock.recvfrom(65535)
+        except (BlockingIOError, InterruptedError):
+            return []
+        except OSError:
+            data = b""
+        if not data:
+            raise ConnectionError(f"{self.name} was disconnected")
+        if self.protocol == "tcp":
+            messages = []
+            for frame_type, payload in self.decoder.feed(data):
+                if frame_type == FRAME_WELCOME:
+                    self.joined = True
+                else:
+                    messages.append(payload)
+        elif self.protocol == "tcp-plain":
+            self.buffer += data
+            if not self.joined and self.buffer.startswith(b"Welcome"):
+                self.joined = True
+                self.buffer = self.buffer[7:]
+            # Everything up to the last newline is complete; notices have no newline but never match MESSAGE
+            complete, newline, self.buffer = self.buffer.rpartition(b"\n")
+            messages = [complete + newline]
+        else:
+            messages = self.reliable.receive(data, addr) if self.reliable is not None else [data]
+            if not self.joined and messages and messages[0] == b"Welcome":
+                self.joined = True
+        return [float(match.group(2)) for message in messages for match in MESSAGE.finditer(message)]
+
+    def close(self):
+        self.sock.close()
+
+
+def server_usage(pid):
+    # CPU seconds and peak RSS in MiB of a running process, read from /proc; None where it isn't available
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        cpu = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+        with open(f"/proc/{pid}/status") as f:
+            peak = [line for line in f if line.startswith("VmHWM:")]
+        return cpu, int(peak[0].split()[1]) / 1024 if peak else None
+    except (OSError, ValueError, IndexError):
+        return None, None
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(int(len(sorted_values) * fraction), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+def pump(sel, clients, until, on_message=None):
+    # Reads from every ready client until the time until, retransmitting for reliable UDP clients.
+    # Returns the number of reads.
+    last_retransmit = time.time()
+    reads = 0
+    while time.time() < until:
+        for key, _ in sel.select(max(min(until - time.time(), 0.05), 0)):
+            reads += 1
+            for sent_at in key.data.read():
+                if on_message is not None:
+                    on_message(sent_at)
+        if time.time() - last_retransmit > 0.05:
+            last_retransmit = time.time()
+            for client in clients:
+                if client.protocol == "udp":
+                    client.reliable.retransmit()
+    return reads
+
+
+def wait_for_joins(sel, clients, patience=10):
+    # Pumps until every client has joined, or until none has for patience seconds
+    joined = sum(client.joined for client in clients)
+    deadline = time.time() + patience
+    while joined < len(clients) and time.time() < deadline:
+        pump(sel, clients, time.time() + 0.05)
+        now_joined = sum(client.joined for client in clients)
+        if now_joined > joined:
+            joined, deadline = now_joined, time.time() + patience
+
+
+def run_benchmark(protocol, port, args):
+    # Starts a server, joins the clients, runs the load and returns the results
+    server_addr = (socket.gethostbyname(socket.gethostname()), port)
+    server = multiprocessing.Process(target=run_server, args=(protocol, port))
+    server.start()
+    time.sleep(0.5)
+    sel = selectors.DefaultSelector()
+    clients = []
+    try:
+        # Clients join in batches, each batch waited for, so the joins don't all arrive at once
+        for i in range(args.clients):
+            client = SimClient(f"sim{i}", protocol, server_addr)
+            sel.register(client.sock, selectors.EVENT_READ, client)
+            clients.append(client)
+            if i % 50 == 49 or i == args.clients - 1:
+                wait_for_joins(sel, clients)
+        if not all(client.joined for client in clients):
+            raise RuntimeError(f"Only {sum(client.joined for client in clients)} of {len(clients)} clients could join")
+        room_sizes = {}
+        for i, client in enumerate(clients):
+            client.room = f"room{i % args.rooms}" if args.rooms > 1 else "lobby"
+            room_sizes[client.room] = room_sizes.get(client.room, 0) + 1
+            if args.rooms > 1:
+                client.send(f"/join {client.room}")
+        # Let the join and room notices drain: wait for half a second without traffic, for up to a minute
+        settle_deadline = time.time() + 60
+        while pump(sel, clients, time.time() + 0.5) and time.time() < settle_deadline:
+            pass
+
+        latencies = []
+        on_message = lambda sent_at: latencies.append(time.time() - sent_at)
+        senders = clients[:args.senders or len(clients)]
+        cpu_before, _ = server_usage(server.pid)
+        start = time.time()
+        interval = 1.0 / args.rate
+        sent, expected = 0, 0
+        while time.time() < start + args.duration:
+            sender = senders[sent % len(senders)]
+            sender.send(f"m {sent} {time.time():.6f}")
+            sent += 1
+            expected += room_sizes[sender.room] - 1
+            pump(sel, clients, start + sent * interval, on_message)
+        # Wait for what's still on its way, up to --drain seconds
+        drain_deadline = time.time() + args.drain
+        while len(latencies) < expected and time.time() < drain_deadline:
+            pump(sel, clients, time.time() + 0.05, on_message)
+        elapsed = time.time() - start
+        cpu_after, peak_rss = server_usage(server.pid)
+    finally:
+        for client in clients:
+            client.close()
+        sel.close()
+        os.kill(server.pid, signal.SIGINT)
+        server.join(10)
+        if server.is_alive():
+            server.terminate()
+            server.join()
+    if cpu_after is None:
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        cpu_after, cpu_before, peak_rss = usage.ru_utime + usage.ru_stime, 0.0, usage.ru_maxrss / 1024
+    latencies.sort()
+    return {
+        "clients": len(clients),
+        "sent": sent,
+        "expected": expected,
+        "delivered": len(latencies),
+        "lost": max(expected - len(latencies), 0),
+        "deliveries_per_sec": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "p999_ms": percentile(latencies, 0.999) * 1000,
+        "server_cpu_s": cpu_after - cpu_before,
+        "server_peak_rss_mb": peak_rss,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the a2 chat servers")
+    parser.add_argument('--protocols', nargs='+', default=["tcp"], choices=["tcp", "tcp-plain", "udp", "udp-plain"],
+                        help='Framed TCP, plain-text TCP, reliable UDP or plain UDP')
+    parser.add_argument('--port', type=int, default=12390, help='Port the server under test listens on')
+    parser.add_argument('--clients', '-c', type=int, default=100, help='Number of simulated clients')
+    parser.add_argument('--senders', type=int, default=10, help='Clients that send messages, 0 for all')
+    parser.add_argument('--rooms', type=int, default=1, help='Rooms to spread the clients over')
+    parser.add_argument('--rate', type=float, default=50, help='Messages sent per second, in total')
+    parser.add_argument('--duration', '-d', type=float, default=5, help='Seconds to send for')
+    parser.add_argument('--drain', type=float, default=2, help='Seconds to wait for late deliveries')
+    parser.add_argument('--json', help='Write the results to this JSON file')
+    args = parser.parse_args()
+
+    results = {}
+    for i, protocol in enumerate(args.protocols):
+        result = run_benchmark(protocol, args.port + i, args)
+        results[protocol] = result
+        rss = f"{result['server_peak_rss_mb']:.1f} MiB" if result['server_peak_rss_mb'] is not None else "n/a"
+        print(f"{protocol:>9}: {result['clients']} clients, {result['sent']} sent, "
+              f"{result['delivered']}/{result['expected']} delivered ({result['lost']} lost), "
+              f"{result['deliveries_per_sec']:.0f} deliveries/s  p50 {result['p50_ms']:.2f} ms  "
+              f"p99 {result['p99_ms']:.2f} ms  p99.9 {result['p999_ms']:.2f} ms  "
+              f"server cpu {result['server_cpu_s']:.2f} s, peak rss {rss}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
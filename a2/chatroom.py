@@ -2,138 +2,618 @@ import socket
 import threading
 import sys
 import select
+import selectors
+import collections
+import itertools
+import struct
+import time
+import mmap
+
+# Framed TCP protocol. Every message is a frame: a 4-byte big-endian payload length, a type byte and the
+# UTF-8 payload, so messages can be any size up to MAX_FRAME and several can share one send() or recv().
+# A framed client's first frame is FRAME_JOIN carrying its name. It starts with a zero byte, which no
+# name sent by a plain-text client does, so the server tells the two protocols apart by the first byte.
+FRAME_HEADER = struct.Struct("!IB")
+FRAME_CHAT = 1
+FRAME_JOIN = 2
+FRAME_EXIT = 3
+FRAME_SHUTDOWN = 4
+FRAME_WELCOME = 5
+FRAME_REJECT = 6
+MAX_FRAME = 1 << 20
+
+# Rooms. Clients start out in DEFAULT_ROOM and only receive the messages of the room they are in.
+# "/join <room>" moves a client to another room and "/leave" moves it back to DEFAULT_ROOM.
+DEFAULT_ROOM = "lobby"
+MAX_ROOM_NAME = 64
+
+def parse_room_command(message):
+    # Returns the room a "/join" or "/leave" command moves the client to, or None for an ordinary message
+    if message == "/leave":
+        return DEFAULT_ROOM
+    if message.startswith("/join "):
+        room = message[6:].strip()
+        if room and len(room) <= MAX_ROOM_NAME:
+            return room
+    return None
+
+# Cluster relay (see cluster.py). The ServerTCP nodes of a cluster each keep a Unix socket connection to
+# one relay and exchange frames of these types with it. A node claims a client's name before welcoming the
+# client, and the relay grants it only if no node holds it. The node releases it when the client leaves.
+# Every broadcast is published to the relay, which passes it on to all other nodes. A publish payload is
+# the room, a zero byte, the frame type of the message and its text.
+RELAY_CLAIM = 16
+RELAY_GRANT = 17
+RELAY_DENY = 18
+RELAY_RELEASE = 19
+RELAY_PUBLISH = 20
+MAX_RELAY_FRAME = 2 * MAX_FRAME    # A published message with its room and sender's name
+
+def encode_frame(frame_type, payload):
+    if isinstance(payload, str):
+        payload = payload.encode()
+    return FRAME_HEADER.pack(len(payload), frame_type) + payload
+
+class FrameDecoder:
+    # Streaming decoder: feed() takes whatever recv() returned and returns the frames it completed,
+    # as (type, payload bytes) tuples, keeping any partial frame for the next call
+    def __init__(self, max_frame=MAX_FRAME):
+        self.buffer = bytearray()
+        self.max_frame = max_frame
+
+    def feed(self, data):
+        self.buffer += data
+        frames = []
+        start = 0
+        while len(self.buffer) - start >= FRAME_HEADER.size:
+            length, frame_type = FRAME_HEADER.unpack_from(self.buffer, start)
+            if length > self.max_frame:
+                raise ValueError(f"Frame of {length} bytes is too large")
+            end = start + FRAME_HEADER.size + length
+            if len(self.buffer) < end:
+                break
+            frames.append((frame_type, bytes(self.buffer[start + FRAME_HEADER.size:end])))
+            start = end
+        del self.buffer[:start]
+        return frames
+
+
+class OutputQueue:
+    # Bounded queue of encoded messages waiting to be sent to one client. A broadcast pushes the same
+    # bytes object onto the queue of every recipient, so it is encoded once however big the room is.
+    def __init__(self, max_messages):
+        self.messages = collections.deque()
+        self.offset = 0    # Bytes of the first message already sent
+        self.max_messages = max_messages
+
+    def __len__(self):
+        return len(self.messages)
+
+    def full(self):
+        return len(self.messages) >= self.max_messages
+
+    def push(self, data):
+        self.messages.append(data)
+
+    def drop_oldest(self):
+        # Drops the oldest message that hasn't been partly sent, which would garble the stream
+        if self.offset:
+            if len(self.messages) > 1:
+                del self.messages[1]
+                return True
+            return False
+        if self.messages:
+            self.messages.popleft()
+            return True
+        return False
+
+    def pending_bytes(self):
+        return b"".join(self.messages)[self.offset:]
+
+    def send(self, sock):
+        # Writes as many queued messages as the socket takes, gathered into one sendmsg() call
+        if not self.messages:
+            return
+        if hasattr(sock, "sendmsg"):
+            buffers = list(itertools.islice(self.messages, 64))
+            buffers[0] = memoryview(buffers[0])[self.offset:]
+            sent = sock.sendmsg(buffers)
+        else:
+            sent = sock.send(memoryview(self.messages[0])[self.offset:])
+        while sent:
+            remaining = len(self.messages[0]) - self.offset
+            if sent < remaining:
+                self.offset += sent
+                break
+            self.messages.popleft()
+            self.offset = 0
+            sent -= remaining
+
 
 class ServerTCP:
-    def __init__(self, server_port):
+    # Each client gets an output queue of at most max_queue messages. When a client reads too slowly for
+    # its queue to keep up, overflow decides what happens: "drop_oldest" discards its oldest queued
+    # message to make room, "disconnect" closes the client. On shutdown the clients get whatever is still
+    # queued for them and the shutdown message, within shutdown_timeout seconds for all of them together.
+    # relay_path makes the server a node of a ChatCluster, relaying broadcasts through the relay at relay_path.
+    # The nodes share the port by binding it with reuse_port (SO_REUSEPORT), or else all accept from the
+    # listen_socket the cluster hands down.
+    def __init__(self, server_port, max_queue=1000, overflow="drop_oldest", reuse_port=False, listen_socket=None,
+                 relay_path=None, shutdown_timeout=1.0):
         self.server_port = server_port
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        addr = socket.gethostbyname(socket.gethostname())
-        self.server_socket.bind((addr, self.server_port))
-        self.server_socket.listen()
+        self.shutdown_timeout = shutdown_timeout
+        if listen_socket is None:
+            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            if reuse_port:
+                self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            addr = socket.gethostbyname(socket.gethostname())
+            self.server_socket.bind((addr, self.server_port))
+            self.server_socket.listen()
+        else:
+            self.server_socket = listen_socket
+        self.server_socket.setblocking(False)
 
+        # All sockets are non-blocking and served from the one thread running run().
+        # Data for a client goes into its output queue and is written as the socket becomes writable,
+        # so a client that reads slowly never blocks the others.
         self.clients = {}
+        self.names = {}    # Name -> socket, so checking a name is free doesn't scan every client
+        self.rooms = {}    # Room -> set of the sockets of its members
+        self.client_rooms = {}    # Socket -> the room the client is in
+        self.pending = set()    # Connected sockets whose name hasn't arrived yet
+        self.decoders = {}    # Socket -> FrameDecoder of clients using the framed protocol
+        self.max_queue = max_queue
+        self.overflow = overflow
+        self.outqueues = {}    # Socket -> OutputQueue of messages waiting to be sent
+        self.dirty = set()    # Sockets with new messages in their output queue, flushed at the end of each loop iteration
+        self.slow = set()    # Clients to disconnect because their queue overflowed
+        self.dropped = 0    # Messages dropped from full queues
+        self.disconnected = 0    # Clients disconnected for reading too slowly
+        self.writing = set()    # Sockets registered for write readiness
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.server_socket, selectors.EVENT_READ)
+        # Writing to wakeup_w wakes run() up, so shutdown() from another thread takes effect at once
+        self.wakeup_r, self.wakeup_w = socket.socketpair()
+        self.wakeup_r.setblocking(False)
+        self.wakeup_w.setblocking(False)
+        self.selector.register(self.wakeup_r, selectors.EVENT_READ)
+        self.running = False
+        self.loop_thread = None
+        self.loop_done = threading.Event()
         self.run_event = threading.Event()
         self.handle_event = threading.Event() 
 
+        # A cluster node only welcomes a client once the relay granted its name. Until then the name is
+        # reserved in names and the client waits in claims.
+        self.relay = None
+        self.relay_decoder = FrameDecoder(MAX_RELAY_FRAME)
+        self.claims = {}    # Socket -> name of the clients waiting for the relay to grant their name
+        self.relayed = 0    # Broadcasts delivered for other nodes
+        if relay_path is not None:
+            self.relay = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.relay.connect(relay_path)
+            self.relay.setblocking(False)
+            self.outqueues[self.relay] = OutputQueue(sys.maxsize)    # Relay traffic is never dropped
+            self.selector.register(self.relay, selectors.EVENT_READ)
+
     def accept_client(self):
-        client_socket = self.server_socket.accept()[0]
-        name = client_socket.recv(1024).decode()
+        # Accepts one connection if there is one waiting. The client's name is read by handle_client once it arrives.
+        try:
+            client_socket = self.server_socket.accept()[0]
+        except (BlockingIOError, InterruptedError):
+            return False
+        client_socket.setblocking(False)
+        self.pending.add(client_socket)
+        self.outqueues[client_socket] = OutputQueue(self.max_queue)
+        self.selector.register(client_socket, selectors.EVENT_READ)
+        return True
 
-        if name in self.clients.values():
-            client_socket.send("Name already taken".encode())
-            client_socket.close()
+    def add_client(self, client_socket, name):
+        # Returns whether the client joined. On a cluster node it joins later, once the relay grants the name.
+        if name in self.names:
+            self.reject_client(client_socket)
             return False
-        else:
-            client_socket.send("Welcome".encode())
-            self.clients[client_socket] = name
-            self.broadcast(client_socket, "join")
-            return True
+        if self.relay is not None:
+            self.names[name] = client_socket
+            self.claims[client_socket] = name
+            self.queue(self.relay, encode_frame(RELAY_CLAIM, name))
+            return False
+        self.welcome_client(client_socket, name)
+        return True
+
+    def welcome_client(self, client_socket, name):
+        self.queue(client_socket, self.encode_for(client_socket, FRAME_WELCOME, "Welcome"))
+        self.clients[client_socket] = name
+        self.names[name] = client_socket
+        self.enter_room(client_socket, DEFAULT_ROOM)
+        self.broadcast(client_socket, "join", FRAME_JOIN)
+
+    def reject_client(self, client_socket):
+        try:
+            client_socket.send(self.encode_for(client_socket, FRAME_REJECT, "Name already taken"))
+        except OSError:
+            pass
+        self.drop_connection(client_socket)
+
+    def claim_answered(self, name, granted):
+        # Finishes the join of the client that claimed name, now that the relay answered
+        client_socket = self.names.get(name)
+        if client_socket is not None and self.claims.get(client_socket) == name:
+            del self.claims[client_socket]
+            if granted:
+                self.welcome_client(client_socket, name)
+                return
+            del self.names[name]
+            self.reject_client(client_socket)
+            return
+        # The client left while waiting, so the name it was granted is given back
+        if client_socket is not None and client_socket not in self.clients:
+            del self.names[name]
+        if granted:
+            self.queue(self.relay, encode_frame(RELAY_RELEASE, name))
 
     def close_client(self, client_socket):
         if client_socket in self.clients:
-            self.broadcast(client_socket, "exit")
-            del self.clients[client_socket]
-            client_socket.close()
+            self.broadcast(client_socket, "exit", FRAME_EXIT)
+            self.leave_room(client_socket)
+            name = self.clients.pop(client_socket)
+            del self.names[name]
+            if self.relay is not None:
+                self.queue(self.relay, encode_frame(RELAY_RELEASE, name))
+            self.drop_connection(client_socket)
             return True
+        if client_socket in self.pending or client_socket in self.claims:
+            # A claim in progress keeps its name reserved until claim_answered()
+            self.claims.pop(client_socket, None)
+            self.drop_connection(client_socket)
         return False
 
-    def broadcast(self, client_socket_sent, message):
-        if message == "join":
+    def enter_room(self, client_socket, room):
+        self.rooms.setdefault(room, set()).add(client_socket)
+        self.client_rooms[client_socket] = room
+
+    def leave_room(self, client_socket):
+        room = self.client_rooms.pop(client_socket)
+        members = self.rooms[room]
+        members.discard(client_socket)
+        if not members:
+            del self.rooms[room]
+
+    def change_room(self, client_socket, room):
+        # Moves a client to another room, telling the members of both
+        if room == self.client_rooms[client_socket]:
+            return
+        self.broadcast(client_socket, "exit", FRAME_EXIT)
+        self.leave_room(client_socket)
+        self.enter_room(client_socket, room)
+        self.broadcast(client_socket, "join", FRAME_JOIN)
+        self.queue(client_socket, self.encode_for(client_socket, FRAME_CHAT, f"You are now in room {room}"))
+
+    def drop_connection(self, client_socket):
+        # Unregisters and closes a socket, discarding anything still buffered for it
+        self.pending.discard(client_socket)
+        self.decoders.pop(client_socket, None)
+        self.outqueues.pop(client_socket, None)
+        self.dirty.discard(client_socket)
+        self.slow.discard(client_socket)
+        self.writing.discard(client_socket)
+        try:
+            self.selector.unregister(client_socket)
+        except (KeyError, ValueError):
+            pass
+        client_socket.close()
+
+    def broadcast(self, client_socket_sent, message, frame_type=None):
+        # frame_type tells a chat message apart from the "join" and "exit" notices; framed clients always
+        # pass it, so they can chat "join" or "exit" like any other text
+        if frame_type is None:
+            frame_type = {"join": FRAME_JOIN, "exit": FRAME_EXIT}.get(message, FRAME_CHAT)
+        if frame_type == FRAME_JOIN:
             msg_to_broadcast = f"User {self.clients[client_socket_sent]} joined"
-        elif message == "exit":
+        elif frame_type == FRAME_EXIT:
             msg_to_broadcast = f"User {self.clients[client_socket_sent]} left"
         else:
             msg_to_broadcast = f"{self.clients[client_socket_sent]}: {message}"
 
-        for client_socket in self.clients:
+        room = self.client_rooms[client_socket_sent]
+        plain = msg_to_broadcast.encode()
+        self.deliver(room, frame_type, plain, client_socket_sent)
+        if self.relay is not None:
+            # The room's members on the other nodes get it through the relay
+            self.queue(self.relay, encode_frame(RELAY_PUBLISH, room.encode() + b"\0" + bytes([frame_type]) + plain))
+
+    def deliver(self, room, frame_type, plain, client_socket_sent=None):
+        # Only queues the message, so clients that fail or fall behind are closed later by flush_dirty()
+        # rather than mid-iteration, and the sender never waits for any of them.
+        # The message is encoded once as plain text and once as a frame, whichever recipients need.
+        framed = None
+        for client_socket in self.rooms.get(room, ()):
             if client_socket != client_socket_sent:
-                try:
-                    client_socket.send(msg_to_broadcast.encode())
-                except:
-                    self.close_client(client_socket)
+                if client_socket in self.decoders:
+                    if framed is None:
+                        framed = encode_frame(frame_type, plain)
+                    self.queue(client_socket, framed)
+                else:
+                    self.queue(client_socket, plain)
+
+    def handle_relay(self):
+        # Handles what the relay sent: answers to name claims and the broadcasts of other nodes
+        try:
+            data = self.relay.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self.lose_relay()
+            return
+        try:
+            frames = self.relay_decoder.feed(data)
+        except ValueError as e:
+            print(f"Error handling relay: {e}")
+            self.lose_relay()
+            return
+        for frame_type, payload in frames:
+            if frame_type == RELAY_PUBLISH:
+                room, _, message = payload.partition(b"\0")
+                self.relayed += 1
+                self.deliver(room.decode(errors="replace"), message[0], message[1:])
+            elif frame_type in (RELAY_GRANT, RELAY_DENY):
+                self.claim_answered(payload.decode(errors="replace"), frame_type == RELAY_GRANT)
+
+    def lose_relay(self):
+        # Without the relay names can't be kept unique across the cluster, so the node shuts down
+        if not self.run_event.is_set():
+            print("Lost the cluster relay, shutting down...")
+        self.run_event.set()
+
+    def encode_for(self, client_socket, frame_type, text):
+        # Encodes a message in the protocol the client speaks
+        if client_socket in self.decoders:
+            return encode_frame(frame_type, text)
+        return text.encode()
+
+    def queue(self, client_socket, data):
+        outqueue = self.outqueues[client_socket]
+        if outqueue.full():
+            if self.overflow == "disconnect":
+                self.slow.add(client_socket)
+                return
+            if outqueue.drop_oldest():
+                self.dropped += 1
+        outqueue.push(data)
+        self.dirty.add(client_socket)
+
+    def flush(self, client_socket):
+        # Sends as much of the client's output queue as the socket takes,
+        # watching for write readiness only while some of it is left
+        outqueue = self.outqueues.get(client_socket)
+        if outqueue is None:
+            return
+        try:
+            outqueue.send(client_socket)
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError:
+            if client_socket is self.relay:
+                self.lose_relay()
+            else:
+                self.close_client(client_socket)
+            return
+        if outqueue and client_socket not in self.writing:
+            self.writing.add(client_socket)
+            self.selector.modify(client_socket, selectors.EVENT_READ | selectors.EVENT_WRITE)
+        elif not outqueue and client_socket in self.writing:
+            self.writing.discard(client_socket)
+            self.selector.modify(client_socket, selectors.EVENT_READ)
+
+    def flush_dirty(self):
+        while self.dirty or self.slow:
+            while self.slow:
+                client_socket = self.slow.pop()
+                print(f"Disconnecting slow client {self.clients.get(client_socket)}")
+                self.disconnected += 1
+                self.close_client(client_socket)
+            if self.dirty:
+                self.flush(self.dirty.pop())
 
     def shutdown(self):
-        shutdown_message = "server-shutdown"
-        for client_socket in self.clients:
+        self.run_event.set()
+        self.handle_event.set()
+        if self.running and threading.current_thread() is not self.loop_thread:
+            # run() shuts the server down from its own thread once woken up
             try:
-                client_socket.send(shutdown_message.encode())
-                client_socket.close()
-            except:
+                self.wakeup_w.send(b"x")
+            except OSError:
                 pass
+            self.loop_done.wait()
+            return
+        if self.server_socket.fileno() == -1:
+            return
 
-        self.run_event.set()
-        self.handle_event.set()
+        if self.relay is not None:
+            # The relay releases the names of a node whose connection closes
+            self.drop_connection(self.relay)
+        shutdown_message = "server-shutdown"
+        # Whatever is still queued goes out first. Nothing blocks: the clients are written to as they
+        # become writable, and those that haven't taken it all by the deadline are dropped.
+        self.selector.unregister(self.server_socket)
+        self.selector.unregister(self.wakeup_r)
+        for client_socket in list(self.outqueues):
+            self.outqueues[client_socket].push(self.encode_for(client_socket, FRAME_SHUTDOWN, shutdown_message))
+            self.send_remaining(client_socket)
+        deadline = time.time() + self.shutdown_timeout
+        while self.outqueues and time.time() < deadline:
+            for key, _ in self.selector.select(max(deadline - time.time(), 0)):
+                if key.fileobj in self.outqueues:
+                    self.send_remaining(key.fileobj)
+        for client_socket in list(self.outqueues):
+            self.drop_connection(client_socket)
+
+        self.selector.close()
+        self.wakeup_r.close()
+        self.wakeup_w.close()
         self.server_socket.close()
 
+    def send_remaining(self, client_socket):
+        # Sends what the socket takes of a client's queue during shutdown, dropping the client once
+        # it has all been sent or the socket failed, and otherwise waiting for it to be writable again
+        outqueue = self.outqueues[client_socket]
+        try:
+            outqueue.send(client_socket)
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError:
+            self.drop_connection(client_socket)
+            return
+        if not outqueue:
+            self.drop_connection(client_socket)
+        else:
+            self.selector.modify(client_socket, selectors.EVENT_WRITE)
+
     def get_clients_number(self):
         return len(self.clients)
 
     def handle_client(self, client_socket):
-        while not self.handle_event.is_set():
-            try:
-                # Use select with a timeout of 1 second
-                readable, _, exceptional = select.select([client_socket], [], [client_socket], 1.0)
-                
-                if client_socket in readable:
-                    message = client_socket.recv(1024).decode()
-                    if message == "exit":
-                        self.close_client(client_socket)
-                        break
-                    elif message:  # Only broadcast non-empty messages
-                        self.broadcast(client_socket, message)
-                    else:  # Empty message means client disconnected
-                        self.close_client(client_socket)
-                        break
-                
-                if client_socket in exceptional:
-                    self.close_client(client_socket)
-                    break
-                    
-            except Exception as e:
-                print(f"Error handling client: {e}")
+        # Handles a client socket that is ready to read: its name if it just connected, otherwise messages
+        framed = client_socket in self.decoders
+        try:
+            data = client_socket.recv(65536 if framed else 1024)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            print(f"Error handling client: {e}")
+            data = b""
+
+        if client_socket in self.claims:
+            # Nothing is taken from a client before it is welcomed, but it may leave while it waits
+            if not data:
                 self.close_client(client_socket)
-                break
+            return
+
+        if client_socket in self.pending and not framed:
+            if data[:1] == b"\0":
+                self.decoders[client_socket] = FrameDecoder()
+                framed = True
+            else:
+                self.pending.discard(client_socket)
+                if data:
+                    self.add_client(client_socket, data.decode(errors="replace"))
+                else:
+                    self.drop_connection(client_socket)
+                return
+
+        if framed:
+            self.handle_frames(client_socket, data)
+            return
+
+        message = data.decode(errors="replace")
+        if message == "exit":
+            self.close_client(client_socket)
+        elif parse_room_command(message) is not None:
+            self.change_room(client_socket, parse_room_command(message))
+        elif message:  # Only broadcast non-empty messages
+            self.broadcast(client_socket, message)
+        else:  # Empty message means client disconnected
+            self.close_client(client_socket)
+
+    def handle_frames(self, client_socket, data):
+        # Handles the frames completed by data, in order, for a client using the framed protocol
+        if not data:
+            self.close_client(client_socket)
+            return
+        try:
+            frames = self.decoders[client_socket].feed(data)
+        except ValueError as e:
+            print(f"Error handling client: {e}")
+            self.close_client(client_socket)
+            return
+        for frame_type, payload in frames:
+            text = payload.decode(errors="replace")
+            if client_socket in self.pending:
+                self.pending.discard(client_socket)
+                if frame_type != FRAME_JOIN:
+                    self.drop_connection(client_socket)
+                    return
+                if not self.add_client(client_socket, text):
+                    return
+            elif frame_type == FRAME_CHAT:
+                room = parse_room_command(text)
+                if room is not None:
+                    self.change_room(client_socket, room)
+                else:
+                    self.broadcast(client_socket, text, FRAME_CHAT)
+            elif frame_type == FRAME_EXIT:
+                self.close_client(client_socket)
+                return
 
     def run(self):
         print("Server is running...")
         self.run_event.clear()
         self.handle_event.clear()
+        self.loop_done.clear()
+        self.loop_thread = threading.current_thread()
+        self.running = True
 
         try:
             while not self.run_event.is_set():
-                # Use select to monitor server socket for new connections
-                readable, _, exceptional = select.select([self.server_socket], [], [], 1.0)
-
-                if self.server_socket in readable:
-                    if self.accept_client():
-                        client_socket = list(self.clients.keys())[-1]
-                        # Start a thread for the new client
-                        client_thread = threading.Thread(
-                            target=self.handle_client, 
-                            args=(client_socket,)
-                        )
-                        client_thread.start()
+                # One selector (epoll on Linux) watches the server socket and every client
+                for key, mask in self.selector.select():
+                    sock = key.fileobj
+                    if sock is self.server_socket:
+                        while self.accept_client():
+                            pass
+                    elif sock is self.wakeup_r:
+                        try:
+                            self.wakeup_r.recv(1024)
+                        except OSError:
+                            pass
+                    elif sock is self.relay:
+                        if mask & selectors.EVENT_READ:
+                            self.handle_relay()
+                        if mask & selectors.EVENT_WRITE:
+                            self.flush(sock)
+                    else:
+                        if mask & selectors.EVENT_READ:
+                            self.handle_client(sock)
+                        if mask & selectors.EVENT_WRITE:
+                            self.flush(sock)
+                self.flush_dirty()
 
         except KeyboardInterrupt:
             print("Server shutting down...")
+        finally:
+            self.running = False
             self.shutdown()
+            self.loop_done.set()
 
 class ClientTCP:
-    def __init__(self, client_name, server_port):
+    # With framed=False the client speaks the plain-text protocol, where each recv() is taken as one message
+    def __init__(self, client_name, server_port, framed=True):
         self.server_addr = socket.gethostbyname(socket.gethostname())
         self.server_port = server_port
         self.client_name = client_name
         self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.framed = framed
+        self.decoder = FrameDecoder()
+        self.frames = collections.deque()    # Frames received but not handled yet
         self.exit_run = threading.Event()
         self.exit_receive = threading.Event()
 
     def connect_server(self):
         try:
             self.client_socket.connect((self.server_addr, self.server_port))
-            self.client_socket.send(self.client_name.encode())
-            response = self.client_socket.recv(1024).decode()
+            if self.framed:
+                self.client_socket.send(encode_frame(FRAME_JOIN, self.client_name))
+                frame_type, payload = self.receive_frame()
+                response = payload.decode()
+                joined = frame_type == FRAME_WELCOME
+            else:
+                self.client_socket.send(self.client_name.encode())
+                response = self.client_socket.recv(1024).decode()
+                joined = 'Welcome' in response
 
-            if 'Welcome' in response:
+            if joined:
                 print("Connected to the chatroom.")
                 return True
             else:
@@ -143,17 +623,43 @@ class ClientTCP:
             print(f"Connection error: {e}")
             return False
 
+    def receive_frame(self):
+        # Returns the next frame from the server, as a (type, payload) tuple
+        while not self.frames:
+            data = self.client_socket.recv(65536)
+            if not data:
+                raise ConnectionError("Connection closed by the server")
+            self.frames.extend(self.decoder.feed(data))
+        return self.frames.popleft()
+
     def send(self, text):
         try:
-            self.client_socket.send(text.encode())
+            if self.framed:
+                frame_type = FRAME_EXIT if text == 'exit' else FRAME_CHAT
+                self.client_socket.sendall(encode_frame(frame_type, text))
+            else:
+                self.client_socket.send(text.encode())
+        except Exception as e:
+            print(f"Error sending message: {e}")
+
+    def send_many(self, texts):
+        # Sends several chat messages in one write; needs the framed protocol to keep them apart
+        try:
+            self.client_socket.sendall(b"".join(encode_frame(FRAME_CHAT, text) for text in texts))
         except Exception as e:
             print(f"Error sending message: {e}")
 
     def receive(self):
         while not self.exit_receive.is_set():
             try:
-                message = self.client_socket.recv(1024).decode()
-                if message == 'server-shutdown':
+                if self.framed:
+                    frame_type, payload = self.receive_frame()
+                    message = payload.decode(errors="replace")
+                    shutting_down = frame_type == FRAME_SHUTDOWN
+                else:
+                    message = self.client_socket.recv(1024).decode()
+                    shutting_down = message == 'server-shutdown'
+                if shutting_down:
                     print("Server is shutting down.")
                     self.exit_run.set()
                     self.exit_receive.set()
@@ -188,8 +694,327 @@ class ClientTCP:
         finally:
             self.client_socket.close()
 
+# Reliability layer for the UDP chat. A reliable datagram starts with a zero byte, which no plain-text
+# datagram does, then a kind byte. RELIABLE_DATA carries a 4-byte sequence number and the payload.
+# RELIABLE_ACK carries the next sequence number the receiver expects, everything before it having arrived,
+# and a 32-bit map of which of the following 32 sequence numbers arrived too (a selective ack), so the
+# sender only retransmits what is really missing.
+RELIABLE_DATA = 1
+RELIABLE_ACK = 2
+DATA_HEADER = struct.Struct("!BBI")
+ACK_PACKET = struct.Struct("!BBII")
+
+class ReliablePeer:
+    # Reliability state for one peer: the window of sent datagrams waiting for an ack,
+    # and the datagrams received ahead of the next one expected
+    def __init__(self):
+        self.next_seq = 0
+        self.unacked = collections.OrderedDict()    # Seq -> [datagram, time last sent], in seq order
+        self.next_due = None    # No unacked datagram is overdue before this time
+        self.backoff = 0    # Retransmission rounds since the peer last acked anything new
+        self.backlog = collections.deque()    # Payloads waiting for room in the window
+        self.expected = 0
+        self.out_of_order = {}    # Seq -> payload received ahead of expected
+        self.closing = False    # Forgotten once everything sent has been acked
+        self.stats = {"sent": 0, "retransmitted": 0, "acked": 0, "delivered": 0, "duplicates": 0, "lost": 0}
+
+class ReliableUDP:
+    # Selective-repeat delivery over a UDP socket, like the sliding window of a3's Go-Back-N but resending
+    # only the datagrams that weren't acked. send() numbers payloads and keeps up to window of them in
+    # flight per peer; retransmit() resends those not acked within timeout seconds. Like TCP's, the wait
+    # doubles with every round of retransmissions until the peer acks something new, and the peer is
+    # given up on after max_retries rounds without one. receive() acks every data datagram and returns
+    # the payloads now deliverable in order.
+    # Thread-safe, so a client can send from one thread while another receives.
+    def __init__(self, sock, window=64, timeout=0.2, max_retries=10):
+        self.sock = sock
+        self.window = window
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.peers = {}    # Address -> ReliablePeer
+        self.unacked = 0    # Datagrams in flight over all peers
+        self.ack_pending = set()    # Addresses owed an ack deferred by receive(ack=False)
+        self.lock = threading.Lock()
+
+    def peer(self, addr):
+        peer = self.peers.get(addr)
+        if peer is None:
+            peer = self.peers[addr] = ReliablePeer()
+        peer.closing = False
+        return peer
+
+    def send(self, payload, addr):
+        with self.lock:
+            peer = self.peer(addr)
+            peer.backlog.append(payload)
+            self.fill_window(peer, addr)
+
+    def fill_window(self, peer, addr):
+        while peer.backlog and len(peer.unacked) < self.window:
+            datagram = DATA_HEADER.pack(0, RELIABLE_DATA, peer.next_seq) + peer.backlog.popleft()
+            now = time.time()
+            peer.unacked[peer.next_seq] = [datagram, now]
+            if peer.next_due is None:
+                peer.next_due = now + self.timeout
+            self.unacked += 1
+            peer.next_seq += 1
+            peer.stats["sent"] += 1
+            self.transmit(datagram, addr)
+
+    def transmit(self, datagram, addr):
+        try:
+            self.sock.sendto(datagram, addr)
+        except (BlockingIOError, InterruptedError):
+            pass  # Lost like any other datagram, resent by retransmit()
+        except OSError as e:
+            print(f"Error sending to {addr}: {e}")
+
+    def receive(self, datagram, addr, ack=True):
+        # Handles a reliable datagram from addr, returning the payloads it makes deliverable, in order.
+        # With ack=False the ack is left for flush_acks(), so a batch of datagrams from a peer gets one ack.
+        if len(datagram) < DATA_HEADER.size:
+            return []
+        with self.lock:
+            if datagram[1] == RELIABLE_ACK:
+                peer = self.peers.get(addr)
+                if peer is not None and len(datagram) >= ACK_PACKET.size:
+                    _, _, expected, received = ACK_PACKET.unpack_from(datagram)
+                    self.handle_ack(peer, addr, expected, received)
+                return []
+            if datagram[1] != RELIABLE_DATA:
+                return []
+            peer = self.peer(addr)
+            seq = DATA_HEADER.unpack_from(datagram)[2]
+            delivered = []
+            if seq < peer.expected or seq in peer.out_of_order:
+                peer.stats["duplicates"] += 1
+            elif seq < peer.expected + self.window:
+                peer.out_of_order[seq] = datagram[DATA_HEADER.size:]
+                while peer.expected in peer.out_of_order:
+                    delivered.append(peer.out_of_order.pop(peer.expected))
+                    peer.expected += 1
+                peer.stats["delivered"] += len(delivered)
+            if ack:
+                self.send_ack(peer, addr)
+            else:
+                self.ack_pending.add(addr)
+            return delivered
+
+    def flush_acks(self):
+        with self.lock:
+            for addr in self.ack_pending:
+                peer = self.peers.get(addr)
+                if peer is not None:
+                    self.send_ack(peer, addr)
+            self.ack_pending.clear()
+
+    def send_ack(self, peer, addr):
+        received = 0
+        for seq in peer.out_of_order:
+            offset = seq - peer.expected - 1
+            if offset < 32:
+                received |= 1 << offset
+        self.transmit(ACK_PACKET.pack(0, RELIABLE_ACK, peer.expected, received), addr)
+
+    def handle_ack(self, peer, addr, expected, received):
+        progress = False
+        for seq in list(peer.unacked):
+            if seq > expected + 32:
+                break
+            if seq < expected or (seq > expected and received >> (seq - expected - 1) & 1):
+                del peer.unacked[seq]
+                self.unacked -= 1
+                peer.stats["acked"] += 1
+                progress = True
+        if progress and peer.backoff:
+            peer.backoff = 0
+            peer.next_due = time.time()    # Rescanned by retransmit() with the shorter wait
+        self.fill_window(peer, addr)
+        if peer.closing and not peer.unacked and not peer.backlog:
+            self.drop_peer(addr)
+
+    def retransmit(self):
+        # Resends every datagram whose ack is overdue. Returns the addresses of the peers given up on,
+        # whose unacked datagrams are counted as lost. Peers with nothing overdue (per next_due) aren't scanned.
+        now = time.time()
+        failed = []
+        with self.lock:
+            for addr, peer in self.peers.items():
+                if peer.next_due is None or now < peer.next_due:
+                    continue
+                wait = self.timeout * (1 << min(peer.backoff, 4))
+                resent = False
+                oldest = None
+                for entry in peer.unacked.values():
+                    if now - entry[1] >= wait:
+                        entry[1] = now
+                        peer.stats["retransmitted"] += 1
+                        self.transmit(entry[0], addr)
+                        resent = True
+                    if oldest is None or entry[1] < oldest:
+                        oldest = entry[1]
+                if resent:
+                    peer.backoff += 1
+                    if peer.backoff > self.max_retries:
+                        failed.append(addr)
+                        continue
+                wait = self.timeout * (1 << min(peer.backoff, 4))
+                peer.next_due = oldest + wait if oldest is not None else None
+            for addr in failed:
+                peer = self.peers[addr]
+                peer.stats["lost"] += len(peer.unacked) + len(peer.backlog)
+                self.unacked -= len(peer.unacked)
+                peer.next_due = None
+                peer.backoff = 0
+                peer.unacked.clear()
+                peer.backlog.clear()
+                if peer.closing:
+                    self.drop_peer(addr)
+        return failed
+
+    def in_flight(self):
+        return self.unacked
+
+    def flush(self, timeout):
+        # Keeps receiving acks and retransmitting until everything sent is acked or timeout seconds pass.
+        # Data that arrives meanwhile is acked but discarded.
+        deadline = time.time() + timeout
+        while self.in_flight() and time.time() < deadline:
+            readable, _, _ = select.select([self.sock], [], [], min(self.timeout, max(deadline - time.time(), 0)))
+            if readable:
+                try:
+                    datagram, addr = self.sock.recvfrom(65535)
+                    if datagram[:1] == b"\0":
+                        self.receive(datagram, addr)
+                except (BlockingIOError, InterruptedError, socket.timeout):
+                    pass
+            self.retransmit()
+
+    def forget(self, addr):
+        # Drops the state kept for addr, once whatever was sent to it has been acked
+        with self.lock:
+            peer = self.peers.get(addr)
+            if peer is None:
+                return
+            if peer.unacked or peer.backlog:
+                peer.closing = True
+            else:
+                self.drop_peer(addr)
+
+    def drop_peer(self, addr):
+        # Deletes a peer's state, first sending the ack receive(ack=False) left it owed: without it the
+        # peer would resend its last datagram, typically "exit", and be taken for a new peer
+        if addr in self.ack_pending:
+            self.ack_pending.discard(addr)
+            self.send_ack(self.peers[addr], addr)
+        del self.peers[addr]
+
+    def stats(self, addr):
+        # Delivery counts for one peer, or None for an unknown peer
+        with self.lock:
+            peer = self.peers.get(addr)
+            if peer is None:
+                return None
+            return dict(peer.stats, in_flight=len(peer.unacked), queued=len(peer.backlog))
+
+class MessageHistory:
+    # Fixed-capacity ring buffer of the latest messages, each a (sender address, text, room, kind) tuple,
+    # kind being FRAME_CHAT, FRAME_JOIN or FRAME_EXIT, so a
+    # long-running server holds at most capacity of them. With log_path every message is also appended to
+    # an on-disk log, read back through mmap, so history older than the ring can still be replayed.
+    # Log records are the UTF-8 room, a zero byte, the kind byte and the UTF-8 text, followed by their
+    # 4-byte length, which lets the log be walked backwards from the end. Where the last capacity chat
+    # messages of each room are in the log is kept in memory, so replay reads only the records it returns;
+    # a log left by an earlier run is walked once, when it is opened.
+    RECORD_LENGTH = struct.Struct("!I")
+
+    def __init__(self, capacity=1000, log_path=None):
+        if capacity < 1:
+            raise ValueError("MessageHistory needs a capacity of at least 1")
+        self.entries = [None] * capacity
+        self.start = 0
+        self.count = 0
+        self.logged = {}    # Room -> deque of the (offset, length) of its latest chat records in the log
+        self.log = open(log_path, "ab") if log_path else None
+        if self.log is not None and self.log.tell() > 0:
+            self.index_log()    # Left by an earlier run
+
+    def __len__(self):
+        return self.count
+
+    def append(self, entry):
+        capacity = len(self.entries)
+        self.entries[(self.start + self.count) % capacity] = entry
+        if self.count == capacity:
+            self.start = (self.start + 1) % capacity
+        else:
+            self.count += 1
+        if self.log is not None:
+            record = entry[2].encode() + b"\0" + bytes([entry[3]]) + entry[1].encode()
+            if entry[3] == FRAME_CHAT:
+                offsets = self.logged.setdefault(entry[2], collections.deque(maxlen=capacity))
+                offsets.append((self.log.tell(), len(record)))
+            self.log.write(record + self.RECORD_LENGTH.pack(len(record)))
+
+    def last(self):
+        if not self.count:
+            return None
+        return self.entries[(self.start + self.count - 1) % len(self.entries)]
+
+    def recent(self, n, room):
+        # Texts of the last n chat messages in room, oldest first, leaving out join and leave notices.
+        # n is capped at the capacity. The ring is searched first; the log, if there is one, only when
+        # the ring doesn't hold n of them.
+        if n <= 0:
+            return []
+        n = min(n, len(self.entries))
+        texts = []
+        for i in range(self.count - 1, -1, -1):
+            entry = self.entries[(self.start + i) % len(self.entries)]
+            if entry[2] == room and entry[3] == FRAME_CHAT:
+                texts.append(entry[1])
+                if len(texts) == n:
+                    break
+        if len(texts) < n and len(self.logged.get(room, ())) > len(texts):
+            texts = self.read_log(n, room)
+        texts.reverse()
+        return texts
+
+    def read_log(self, n, room):
+        # Texts of the last n chat messages in room according to the log, newest first
+        self.log.flush()
+        texts = []
+        with open(self.log.name, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as view:
+            for offset, length in itertools.islice(reversed(self.logged[room]), n):
+                text = view[offset:offset + length].partition(b"\0")[2]
+                texts.append(text[1:].decode(errors="replace"))
+        return texts
+
+    def index_log(self):
+        # Finds the latest chat records of every room in the log, walking it backwards from the end
+        capacity = len(self.entries)
+        with open(self.log.name, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as view:
+            end = len(view)
+            while end > 0:
+                length = self.RECORD_LENGTH.unpack_from(view, end - self.RECORD_LENGTH.size)[0]
+                start = end - self.RECORD_LENGTH.size - length
+                room_end = view.find(b"\0", start, start + length)
+                if view[room_end + 1] == FRAME_CHAT:
+                    room = view[start:room_end].decode(errors="replace")
+                    offsets = self.logged.setdefault(room, collections.deque(maxlen=capacity))
+                    if len(offsets) < capacity:
+                        offsets.appendleft((start, length))
+                end = start
+
+    def close(self):
+        if self.log is not None:
+            self.log.close()
+
 class ServerUDP:
-    def __init__(self, server_port):
+    # Clients that use the reliability layer (their datagrams start with a zero byte) are sent every
+    # message through a ReliableUDP with the given window and retransmit_timeout; others get plain datagrams.
+    # The last history messages are kept for "/history [n]" to replay, all of them if history_log is set.
+    def __init__(self, server_port, window=64, retransmit_timeout=0.2, history=1000, history_log=None):
         self.server_port = server_port
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         addr = socket.gethostbyname(socket.gethostname())
@@ -197,62 +1022,147 @@ class ServerUDP:
         self.server_socket.setblocking(False)
 
         self.clients = {}
-        self.messages = []
+        self.names = {}    # Name -> address, so checking a name is free doesn't scan every client
+        self.rooms = {}    # Room -> set of the addresses of its members
+        self.client_rooms = {}    # Address -> the room the client is in
+        self.messages = MessageHistory(history, history_log)
+        self.reliable = ReliableUDP(self.server_socket, window, retransmit_timeout)
         
-    def broadcast(self):
-        if self.messages:
-            sender_addr, message = self.messages[-1]
-            for client_addr in self.clients:
+    def broadcast(self, room=None):
+        # Sends the latest message to the other members of room, by default the room it was sent in.
+        # The message is encoded once for all of them.
+        last = self.messages.last()
+        if last:
+            sender_addr, message, message_room, _ = last
+            if room is None:
+                room = message_room
+            data = message.encode()
+            for client_addr in self.rooms.get(room, ()):
                 if client_addr != sender_addr:
-                    sender = ""
-                    # not exit and not join
-                    # format is 'User x left' and 'User x joined'
-                    # check if first 4 characters are 'User' and last 4 characters are 'left'
-                    # or first 4 characters are 'User' and last 5 characters are 'joined'
-                    if message[:4] == "User" and (message[-4:] == "left" or message[-6:] == "joined"):
-                        sender = ""
-                    else:
-                        sender = f"{self.clients[sender_addr]}: "
-                    
                     try:
-                        self.server_socket.sendto(f"{sender}{message}".encode(), client_addr)
+                        self.send_to(client_addr, data)
                     except Exception as e:
                         print(f"Error broadcasting message: {e}")
+
+    def record(self, client_addr, text, kind=FRAME_CHAT):
+        # Adds a message to the history, as its recipients see it, in the room client_addr is in.
+        # kind tells chat messages (FRAME_CHAT) from join and leave notices (FRAME_JOIN, FRAME_EXIT).
+        self.messages.append((client_addr, text, self.client_rooms[client_addr], kind))
+
+    def replay(self, client_addr, count):
+        # Sends a client the last count messages of its room
+        for text in self.messages.recent(count, self.client_rooms[client_addr]):
+            self.send_to(client_addr, text.encode())
+
+    def send_to(self, client_addr, data):
+        # Sends through the reliability layer to clients that use it, as a plain datagram to the others
+        if client_addr in self.reliable.peers:
+            self.reliable.send(data, client_addr)
+        else:
+            self.server_socket.sendto(data, client_addr)
     
     def accept_client(self, client_addr, message):
         name = message[5:]
-        if name in self.clients.values():
-            self.server_socket.sendto(b"Name already taken", client_addr)
+        if name in self.names:
+            self.send_to(client_addr, b"Name already taken")
+            self.reliable.forget(client_addr)
             return False
         
         self.clients[client_addr] = name
-        self.server_socket.sendto(b"Welcome", client_addr)
-        self.messages.append((client_addr, f"User {name} joined"))
+        self.names[name] = client_addr
+        self.enter_room(client_addr, DEFAULT_ROOM)
+        self.send_to(client_addr, b"Welcome")
+        self.record(client_addr, f"User {name} joined", FRAME_JOIN)
         self.broadcast()
         
         return True
     
     def close_client(self, client_addr):
         if client_addr in self.clients:
-            self.messages.append((client_addr, f"User {self.clients[client_addr]} left"))
-            del self.clients[client_addr]
-            self.broadcast()
+            self.record(client_addr, f"User {self.clients[client_addr]} left", FRAME_EXIT)
+            room = self.leave_room(client_addr)
+            del self.names[self.clients.pop(client_addr)]
+            self.broadcast(room)
+            self.reliable.forget(client_addr)
             return True
         return False
+
+    def enter_room(self, client_addr, room):
+        self.rooms.setdefault(room, set()).add(client_addr)
+        self.client_rooms[client_addr] = room
+
+    def leave_room(self, client_addr):
+        room = self.client_rooms.pop(client_addr)
+        members = self.rooms[room]
+        members.discard(client_addr)
+        if not members:
+            del self.rooms[room]
+        return room
+
+    def change_room(self, client_addr, room):
+        # Moves a client to another room, telling the members of both
+        if room == self.client_rooms[client_addr]:
+            return
+        name = self.clients[client_addr]
+        self.record(client_addr, f"User {name} left", FRAME_EXIT)
+        self.broadcast()
+        self.leave_room(client_addr)
+        self.enter_room(client_addr, room)
+        self.record(client_addr, f"User {name} joined", FRAME_JOIN)
+        self.broadcast()
+        self.send_to(client_addr, f"You are now in room {room}".encode())
     
     def shutdown(self):
         shutdown_message = "server-shutdown"
         for client_addr in self.clients:
-            self.server_socket.sendto(shutdown_message.encode(), client_addr)
+            self.send_to(client_addr, shutdown_message.encode())
         
         clients = list(self.clients.keys())
         for client_addr in clients:
             self.close_client(client_addr)
 
+        # Give reliable clients a moment to ack the shutdown message
+        self.reliable.flush(1.0)
+        self.messages.close()
         self.server_socket.close()
 
     def get_clients_number(self):
         return len(self.clients)
+
+    def receive_batch(self, limit=256):
+        # Handles every datagram waiting on the socket, up to limit, per wakeup rather than one per select().
+        # Acks to reliable clients are coalesced into one per client, sent once the batch is done.
+        for _ in range(limit):
+            try:
+                data, client_addr = self.server_socket.recvfrom(65535)
+            except (BlockingIOError, InterruptedError):
+                break
+            except ConnectionResetError:
+                continue  # An earlier datagram was refused, on platforms that report it here
+            if data[:1] == b"\0":
+                for payload in self.reliable.receive(data, client_addr, ack=False):
+                    self.handle_message(client_addr, payload.decode(errors="replace"))
+            else:
+                self.handle_message(client_addr, data.decode(errors="replace"))
+        self.reliable.flush_acks()
+
+    def handle_message(self, client_addr, message):
+        # Only an address that hasn't joined can join; a joined client's text starting with "join" is chat
+        if message[:4] == "join" and client_addr not in self.clients:
+            self.accept_client(client_addr, message)
+        elif client_addr not in self.clients:
+            # Not joined, there's no one to send it as; nor is there any reason to keep its reliability state
+            self.reliable.forget(client_addr)
+        elif message == "exit":
+            self.close_client(client_addr)
+        elif parse_room_command(message) is not None:
+            self.change_room(client_addr, parse_room_command(message))
+        elif message == "/history" or message.startswith("/history "):
+            count = message[9:].strip()
+            self.replay(client_addr, int(count) if count.isdigit() else 20)
+        else:
+            self.record(client_addr, f"{self.clients[client_addr]}: {message}")
+            self.broadcast()
     
     def run(self):
         try:
@@ -261,44 +1171,41 @@ class ServerUDP:
                 if not self.server_socket or self.server_socket.fileno() == -1:
                     continue
 
-                readable, _, _ = select.select([self.server_socket], [], [], 1.0)
+                # Wake up often enough to retransmit while reliable datagrams wait for their acks
+                timeout = self.reliable.timeout / 2 if self.reliable.in_flight() else 1.0
+                readable, _, _ = select.select([self.server_socket], [], [], timeout)
                 
-                if not readable:
-                    continue
-                
-                try:
-                    message, client_addr = self.server_socket.recvfrom(1024)
-                    message = message.decode()
-                    
-                    if message[:4] == "join":
-                        self.accept_client(client_addr, message)
-                    elif message == "exit":
-                        self.close_client(client_addr)
-                    else:
-                        self.messages.append((client_addr, message))
-                        self.broadcast()
-                except BlockingIOError:
-                    continue
+                if readable:
+                    self.receive_batch()
+
+                for client_addr in self.reliable.retransmit():
+                    print(f"Client {self.clients.get(client_addr)} stopped acknowledging messages")
+                    self.close_client(client_addr)
                 
         except KeyboardInterrupt:
             print("Server shutting down...")
             self.shutdown()
 
 class ClientUDP:
-    def __init__(self, client_name, server_port):
+    # With reliable=True messages both ways go through a ReliableUDP, so none are lost or reordered
+    def __init__(self, client_name, server_port, reliable=True):
         self.server_addr = socket.gethostbyname(socket.gethostname())
         self.server_port = server_port
         self.client_name = client_name
         self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.reliable = ReliableUDP(self.client_socket) if reliable else None
+        self.inbox = collections.deque()    # Messages received but not handled yet
 
         self.exit_run = threading.Event()
         self.exit_receive = threading.Event()
         
     def connect_server(self):
-        self.client_socket.sendto(f"join:{self.client_name}".encode(), (self.server_addr, self.server_port))
+        self.send(f"join:{self.client_name}")
         
         try:
-            response, _ = self.client_socket.recvfrom(1024)
+            response = None
+            while response is None:
+                response = self.receive_message()
             if 'Welcome' in response.decode():
                 print("Connected to the chatroom.")
                 return True
@@ -310,12 +1217,38 @@ class ClientUDP:
             return False
         
     def send(self, text):
-        self.client_socket.sendto(text.encode(), (self.server_addr, self.server_port))
+        if self.reliable is not None:
+            self.reliable.send(text.encode(), (self.server_addr, self.server_port))
+        else:
+            self.client_socket.sendto(text.encode(), (self.server_addr, self.server_port))
+
+    def receive_message(self):
+        # Returns the next message from the server. In reliable mode it waits only briefly, returning None
+        # if nothing arrived, so retransmissions are made in between.
+        if self.inbox:
+            return self.inbox.popleft()
+        if self.reliable is None:
+            data, _ = self.client_socket.recvfrom(65535)
+            return data
+        self.client_socket.settimeout(self.reliable.timeout / 2)
+        try:
+            data, addr = self.client_socket.recvfrom(65535)
+            if data[:1] == b"\0":
+                self.inbox.extend(self.reliable.receive(data, addr))
+            else:
+                self.inbox.append(data)
+        except socket.timeout:
+            pass
+        if self.reliable.retransmit():
+            raise ConnectionError("Server stopped acknowledging messages")
+        return self.inbox.popleft() if self.inbox else None
         
     def receive(self):
         while not self.exit_receive.is_set():
             try:
-                data, _ = self.client_socket.recvfrom(1024)
+                data = self.receive_message()
+                if data is None:
+                    continue
                 message = data.decode()
                 if 'server-shutdown' in message:
                     print("Server is shutting down.")
@@ -348,4 +1281,6 @@ class ClientUDP:
                 self.send('exit')
                 self.exit_receive.set()
             finally:
+                if self.reliable is not None:
+                    self.reliable.flush(1.0)
                 self.client_socket.close()
\ No newline at end of file
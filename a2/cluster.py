@@ -0,0 +1,259 @@
+# Sharded chat cluster: several ServerTCP processes serving one chatroom, so a busy room isn't held to one core.
+# to run in terminal: python cluster.py --nodes 4
+# Every node listens on the port with SO_REUSEPORT, so the kernel spreads the clients over the nodes and each
+# node serves only its own; without SO_REUSEPORT they all accept from one socket the cluster opens and hands
+# down. The nodes are joined by a relay, run by the cluster process on a Unix socket: a node publishes every
+# broadcast to it and it passes the broadcast on to the other nodes, which deliver it to their members of the
+# room. The relay also hands out the clients' names, each to one node at a time, so names stay unique across
+# the cluster. Clients connect exactly as to a single ServerTCP, with either protocol.
+import argparse
+import multiprocessing
+import os
+import selectors
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+from chatroom import ServerTCP, FrameDecoder, OutputQueue, encode_frame, MAX_RELAY_FRAME, \
+    RELAY_CLAIM, RELAY_GRANT, RELAY_DENY, RELAY_RELEASE, RELAY_PUBLISH
+
+
+class ClusterRelay:
+    # The nodes' pub/sub channel. Everything a node publishes is queued once for every other node and
+    # written as its socket takes it; run() serves all the nodes from one thread.
+    def __init__(self, path):
+        self.path = path
+        if os.path.exists(path):
+            os.unlink(path)    # Left over from a cluster that didn't shut down
+        self.listen_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listen_socket.bind(path)
+        self.listen_socket.listen()
+        self.listen_socket.setblocking(False)
+        self.decoders = {}    # Node socket -> FrameDecoder
+        self.outqueues = {}    # Node socket -> OutputQueue of frames waiting to be sent
+        self.writing = set()    # Node sockets registered for write readiness
+        self.owners = {}    # Name -> socket of the node its client is on
+        self.held = {}    # Node socket -> set of the names it holds
+        self.published = 0    # Broadcasts relayed
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.listen_socket, selectors.EVENT_READ)
+        self.wakeup_r, self.wakeup_w = socket.socketpair()
+        self.wakeup_r.setblocking(False)
+        self.selector.register(self.wakeup_r, selectors.EVENT_READ)
+        self.stopping = threading.Event()
+
+    def accept_node(self):
+        try:
+            node = self.listen_socket.accept()[0]
+        except (BlockingIOError, InterruptedError):
+            return False
+        node.setblocking(False)
+        self.decoders[node] = FrameDecoder(MAX_RELAY_FRAME)
+        self.outqueues[node] = OutputQueue(sys.maxsize)
+        self.held[node] = set()
+        self.selector.register(node, selectors.EVENT_READ)
+        return True
+
+    def close_node(self, node):
+        # Releases the names of a node that left, whose clients are gone with it
+        for name in self.held.pop(node):
+            del self.owners[name]
+        del self.decoders[node]
+        del self.outqueues[node]
+        self.writing.discard(node)
+        self.selector.unregister(node)
+        node.close()
+
+    def send(self, node, frame):
+        self.outqueues[node].push(frame)
+        self.flush(node)
+
+    def flush(self, node):
+        outqueue = self.outqueues[node]
+        try:
+            outqueue.send(node)
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError:
+            self.close_node(node)
+            return
+        if outqueue and node not in self.writing:
+            self.writing.add(node)
+            self.selector.modify(node, selectors.EVENT_READ | selectors.EVENT_WRITE)
+        elif not outqueue and node in self.writing:
+            self.writing.discard(node)
+            self.selector.modify(node, selectors.EVENT_READ)
+
+    def handle_node(self, node):
+        try:
+            data = node.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self.close_node(node)
+            return
+        try:
+            frames = self.decoders[node].feed(data)
+        except ValueError as e:
+            print(f"Error handling node: {e}")
+            self.close_node(node)
+            return
+        for frame_type, payload in frames:
+            if frame_type == RELAY_PUBLISH:
+                # Encoded once, the same bytes object queued for every other node
+                self.published += 1
+                frame = encode_frame(RELAY_PUBLISH, payload)
+                for other in list(self.outqueues):
+                    if other is not node:
+                        self.send(other, frame)
+            elif frame_type == RELAY_CLAIM:
+                name = payload.decode(errors="replace")
+                if name in self.owners:
+                    self.send(node, encode_frame(RELAY_DENY, payload))
+                else:
+                    self.owners[name] = node
+                    self.held[node].add(name)
+                    self.send(node, encode_frame(RELAY_GRANT, payload))
+            elif frame_type == RELAY_RELEASE:
+                name = payload.decode(errors="replace")
+                if self.owners.get(name) is node:
+                    del self.owners[name]
+                    self.held[node].discard(name)
+            if node not in self.outqueues:
+                return    # Closed by a failed send
+
+    def get_clients_number(self):
+        return len(self.owners)
+
+    def run(self):
+        try:
+            while not self.stopping.is_set():
+                for key, mask in self.selector.select():
+                    sock = key.fileobj
+                    if sock is self.listen_socket:
+                        while self.accept_node():
+                            pass
+                    elif sock is self.wakeup_r:
+                        self.wakeup_r.recv(1024)
+                    elif sock in self.outqueues:
+                        if mask & selectors.EVENT_READ:
+                            self.handle_node(sock)
+                        if mask & selectors.EVENT_WRITE and sock in self.outqueues:
+                            self.flush(sock)
+        finally:
+            for node in list(self.outqueues):
+                self.close_node(node)
+            self.selector.close()
+            self.listen_socket.close()
+            self.wakeup_r.close()
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+    def stop(self):
+        self.stopping.set()
+        try:
+            self.wakeup_w.send(b"x")
+        except OSError:
+            pass
+
+
+def run_cluster_node(server_port, listen_socket, relay_path, server_kwargs):
+    # Entry point of a node process. SIGINT or SIGTERM raises KeyboardInterrupt in run(), which shuts the
+    # node down; the other signal is ignored from then on, so Ctrl-C reaching the cluster process and its
+    # nodes together can't interrupt a node's shutdown.
+    def stop_node(signum, frame):
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGINT, stop_node)
+    signal.signal(signal.SIGTERM, stop_node)
+    server = ServerTCP(server_port, reuse_port=listen_socket is None, listen_socket=listen_socket,
+                       relay_path=relay_path, **server_kwargs)
+    server.run()
+
+
+class ChatCluster:
+    # Runs nodes ServerTCP processes on server_port, by default one per core, with the relay on a Unix
+    # socket at relay_path. Nodes that die are restarted; their clients are disconnected and their names
+    # freed. Other keyword arguments go to each ServerTCP.
+    def __init__(self, server_port, nodes=None, relay_path=None, **server_kwargs):
+        self.server_port = server_port
+        self.nodes = nodes or os.cpu_count() or 1
+        self.relay_path = relay_path or os.path.join(tempfile.gettempdir(), f"a2_relay_{server_port}.sock")
+        self.server_kwargs = server_kwargs
+        self.listen_socket = None
+        if not hasattr(socket, "SO_REUSEPORT"):
+            self.listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            addr = socket.gethostbyname(socket.gethostname())
+            self.listen_socket.bind((addr, self.server_port))
+            self.listen_socket.listen()
+        self.relay = ClusterRelay(self.relay_path)
+        self.relay_thread = None
+        self.workers = []
+        self.running = False
+        # Nodes are forked, so they inherit any listening socket rather than being sent it
+        self.context = multiprocessing.get_context("fork")
+
+    def spawn_node(self):
+        worker = self.context.Process(
+            target=run_cluster_node,
+            args=(self.server_port, self.listen_socket, self.relay_path, dict(self.server_kwargs)),
+        )
+        worker.daemon = True
+        worker.start()
+        return worker
+
+    def get_clients_number(self):
+        return self.relay.get_clients_number()
+
+    def run(self):
+        print(f"Cluster of {self.nodes} nodes is running...")
+        self.running = True
+        self.relay_thread = threading.Thread(target=self.relay.run)
+        self.relay_thread.daemon = True
+        self.relay_thread.start()
+        try:
+            self.workers = [self.spawn_node() for _ in range(self.nodes)]
+            while self.running:
+                time.sleep(0.5)
+                for slot, worker in enumerate(self.workers):
+                    if not worker.is_alive() and self.running:
+                        print(f"Node {worker.pid} exited with code {worker.exitcode}, restarting")
+                        self.workers[slot] = self.spawn_node()
+        except KeyboardInterrupt:
+            print("Cluster shutting down...")
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        # Tells the nodes to shut down, waiting a few seconds for them before killing any that remain
+        self.running = False
+        for worker in self.workers:
+            if worker.is_alive():
+                try:
+                    os.kill(worker.pid, signal.SIGTERM)
+                except OSError:
+                    pass
+        for worker in self.workers:
+            worker.join(timeout=5)
+            if worker.is_alive():
+                worker.kill()
+                worker.join()
+        self.relay.stop()
+        if self.relay_thread is not None:
+            self.relay_thread.join()
+        if self.listen_socket is not None:
+            self.listen_socket.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the a2 chat server as a cluster of processes")
+    parser.add_argument('--port', type=int, default=12345, help='Port the clients connect to')
+    parser.add_argument('--nodes', '-n', type=int, default=None, help='Server processes, by default one per core')
+    args = parser.parse_args()
+    ChatCluster(args.port, args.nodes).run()
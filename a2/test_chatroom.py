@@ -0,0 +1,428 @@
+import socket, threading, time, os, tempfile, select, asyncio
+from chatroom import (ReliableUDP, ACK_PACKET, RELIABLE_ACK, FrameDecoder, encode_frame, OutputQueue, ServerTCP, ServerUDP,
+                      MessageHistory, FRAME_HEADER, FRAME_CHAT, FRAME_JOIN, FRAME_WELCOME, FRAME_REJECT, MAX_FRAME)
+from cluster import ClusterRelay
+from async_client import AsyncClientTCP, AsyncClientUDP
+port = 12800
+
+class RecordingSocket:# Stands in for a UDP socket, keeping every datagram sent
+    def __init__(self):
+        self.sent = []
+    def sendto(self, data, addr):
+        self.sent.append((data, addr))
+
+class PartialSocket:# Stands in for a TCP socket that takes only a few bytes per send
+    def __init__(self, accept):
+        self.accept = accept
+    def sendmsg(self, buffers):
+        return self.accept
+
+def test_1():# Test 1: Test that ReliableUDP backs its retransmissions off until the peer acks, then resets
+    sock = RecordingSocket()
+    reliable = ReliableUDP(sock, timeout=0.05, max_retries=10)
+    peer = ("127.0.0.1", 5000)
+    reliable.send(b"hello", peer)
+    deadline = time.time() + 0.4
+    while time.time() < deadline:# Without backoff this resends 7 times, with it after 0.05, 0.15 and 0.35 s
+        reliable.retransmit()
+        time.sleep(0.01)
+    retransmitted = len(sock.sent) - 1
+    backed_off = reliable.peers[peer].backoff
+    reliable.receive(ACK_PACKET.pack(0, RELIABLE_ACK, 1, 0), peer)
+    cond = (3 <= retransmitted <= 4 and backed_off == retransmitted and reliable.in_flight() == 0
+            and reliable.peers[peer].backoff == 0)
+    if cond:print("Test 1 passed")
+    else:print("Test 1 failed")
+
+def test_2():# Test 2: Test that OutputQueue never drops a partly sent message and the server's overflow policies
+    outqueue = OutputQueue(2)
+    outqueue.push(b"abc")
+    outqueue.push(b"def")
+    outqueue.send(PartialSocket(2))# "ab" is out, so dropping must take "def" instead
+    partial = outqueue.full() and outqueue.drop_oldest() and outqueue.pending_bytes() == b"c"
+    results = {}
+    for i, overflow in enumerate(("drop_oldest", "disconnect")):
+        server = ServerTCP(port + i, max_queue=2, overflow=overflow)
+        client, other = socket.socketpair()
+        server.outqueues[client] = OutputQueue(server.max_queue)
+        for message in (b"m1", b"m2", b"m3"):server.queue(client, message)
+        results[overflow] = (list(server.outqueues[client].messages), server.dropped, client in server.slow)
+        server.shutdown()
+        client.close()
+        other.close()
+    cond = (partial and results["drop_oldest"] == ([b"m2", b"m3"], 1, False)
+            and results["disconnect"] == ([b"m1", b"m2"], 0, True))
+    if cond:print("Test 2 passed")
+    else:print("Test 2 failed")
+
+def test_3():# Test 3: Test FrameDecoder on frames split across reads, coalesced into one read and too large
+    data = encode_frame(FRAME_JOIN, "alice") + encode_frame(FRAME_CHAT, "hi") + encode_frame(FRAME_CHAT, "ünïcode " * 100)
+    decoder = FrameDecoder()
+    split = []
+    for byte in data:split += decoder.feed(bytes([byte]))
+    coalesced = FrameDecoder().feed(data + data[:7])# Plus the start of another frame, kept for the next read
+    try:
+        FrameDecoder().feed(encode_frame(FRAME_CHAT, b"x" * (MAX_FRAME + 1)))
+        refused = False
+    except ValueError:
+        refused = True
+    expected = [(FRAME_JOIN, b"alice"), (FRAME_CHAT, b"hi"), (FRAME_CHAT, ("ünïcode " * 100).encode())]
+    cond = split == expected and coalesced == expected and refused and decoder.buffer == b""
+    if cond:print("Test 3 passed")
+    else:print("Test 3 failed")
+
+def test_4():# Test 4: Test that ReliableUDP recovers a dropped datagram and delivers everything in order
+    sender_sock, receiver_sock = RecordingSocket(), RecordingSocket()
+    sender, receiver = ReliableUDP(sender_sock, timeout=0.05), ReliableUDP(receiver_sock, timeout=0.05)
+    sender_addr, receiver_addr = ("127.0.0.1", 5001), ("127.0.0.1", 5002)
+    for i in range(5):sender.send(f"message {i}".encode(), receiver_addr)
+    delivered = []
+    for datagram, _ in sender_sock.sent[:1] + sender_sock.sent[2:]:# The second datagram is lost
+        delivered += receiver.receive(datagram, sender_addr)
+    held_back = list(delivered)
+    for ack, _ in receiver_sock.sent:sender.receive(ack, receiver_addr)# Selective acks leave only the lost one
+    in_flight = sender.in_flight()
+    time.sleep(0.06)
+    sent_before = len(sender_sock.sent)
+    sender.retransmit()
+    resent = sender_sock.sent[sent_before:]
+    for datagram, _ in resent:delivered += receiver.receive(datagram, sender_addr)
+    for ack, _ in receiver_sock.sent[-1:]:sender.receive(ack, receiver_addr)
+    cond = (held_back == [b"message 0"] and in_flight == 1 and len(resent) == 1
+            and delivered == [f"message {i}".encode() for i in range(5)] and sender.in_flight() == 0)
+    if cond:print("Test 4 passed")
+    else:print("Test 4 failed")
+
+def test_5():# Test 5: Test that MessageHistory.recent falls back to the log for messages the ring dropped
+    with tempfile.TemporaryDirectory() as tmp:
+        log_path = os.path.join(tmp, "history.log")
+        history = MessageHistory(capacity=4, log_path=log_path)
+        for i in range(10):
+            history.append((None, f"alice: {i}", "lobby" if i % 2 == 0 else "games", FRAME_CHAT))
+            history.append((None, "User bob joined", "lobby", FRAME_JOIN))
+        from_ring = history.recent(1, "lobby")
+        from_log = history.recent(4, "lobby")
+        capped = history.recent(1000, "lobby")# No more than the capacity, however many the log holds
+        none = history.recent(0, "lobby") + history.recent(-1, "lobby")
+        history.close()
+        reopened = MessageHistory(capacity=4, log_path=log_path)# A restarted server replays the earlier run's log
+        earlier = reopened.recent(3, "games")
+        reopened.close()
+    try:
+        MessageHistory(capacity=0)
+        refused = False
+    except ValueError:
+        refused = True
+    cond = (from_ring == ["alice: 8"] and from_log == ["alice: 2", "alice: 4", "alice: 6", "alice: 8"]
+            and capped == from_log and none == [] and earlier == ["alice: 5", "alice: 7", "alice: 9"] and refused)
+    if cond:print("Test 5 passed")
+    else:print("Test 5 failed")
+
+def test_6():# Test 6: Test that a reliable UDP client's exit is acked and the server forgets it
+    server = ServerUDP(port + 2, retransmit_timeout=0.1)
+    server_addr = (socket.gethostbyname(socket.gethostname()), port + 2)
+    client_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    client = ReliableUDP(client_sock, timeout=0.1)
+
+    def exchange():# Runs both ends until neither has anything unacked
+        deadline = time.time() + 2
+        while (client.in_flight() or server.reliable.in_flight()) and time.time() < deadline:
+            readable, _, _ = select.select([server.server_socket, client_sock], [], [], 0.05)
+            if server.server_socket in readable:server.receive_batch()
+            if client_sock in readable:client.receive(*client_sock.recvfrom(65535))
+            client.retransmit()
+            server.reliable.retransmit()
+
+    client.send(b"join:alice", server_addr)
+    client.send(b"joined late, sorry", server_addr)# Chat from a joined client, not a second join
+    exchange()
+    joined = list(server.names) == ["alice"] and list(server.clients.values()) == ["alice"]
+    client.send(b"exit", server_addr)# With nothing left unacked the server forgets the client at once
+    exchange()
+    time.sleep(0.15)
+    exchange()
+    cond = (joined and client.in_flight() == 0 and client.stats(server_addr)["retransmitted"] == 0
+            and server.reliable.peers == {} and server.names == {} and server.clients == {})
+    server.shutdown()
+    client_sock.close()
+    if cond:print("Test 6 passed")
+    else:print("Test 6 failed")
+
+def join(server_port, name):# Joins a server with the framed protocol, returning the socket, its decoder and the answer
+    client_socket = socket.create_connection((socket.gethostbyname(socket.gethostname()), server_port))
+    client_socket.settimeout(5)
+    client_socket.sendall(encode_frame(FRAME_JOIN, name))
+    decoder = FrameDecoder()
+    frames = []
+    while not frames:frames = decoder.feed(client_socket.recv(65536))
+    return client_socket, decoder, frames[0][0]
+
+def listen(server_port):# A listening socket the test can bind again at once, while the last run's connections are in TIME_WAIT
+    listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listen_socket.bind((socket.gethostbyname(socket.gethostname()), server_port))
+    listen_socket.listen()
+    return listen_socket
+
+def test_7():# Test 7: Test that cluster nodes relay broadcasts to each other and keep names unique across them
+    cond = False
+    with tempfile.TemporaryDirectory() as tmp:
+        relay = ClusterRelay(os.path.join(tmp, "relay.sock"))
+        relay_thread = threading.Thread(target=relay.run)
+        relay_thread.start()
+        nodes, node_threads = [], []
+        try:
+            for i in range(2):# Separate ports pick the node a client joins
+                nodes.append(ServerTCP(port + 3 + i, listen_socket=listen(port + 3 + i), relay_path=relay.path))
+                node_threads.append(threading.Thread(target=nodes[-1].run))
+                node_threads[-1].start()
+            alice, _, alice_answer = join(port + 3, "alice")
+            bob, bob_decoder, bob_answer = join(port + 4, "bob")
+            duplicate, _, duplicate_answer = join(port + 4, "alice")
+            duplicate.close()
+            alice.sendall(encode_frame(FRAME_CHAT, "hello from node 1"))
+            received = []
+            while (FRAME_CHAT, b"alice: hello from node 1") not in received:received += bob_decoder.feed(bob.recv(65536))
+            alice.close()
+            deadline = time.time() + 2
+            while relay.get_clients_number() != 1 and time.time() < deadline:time.sleep(0.01)
+            released = relay.get_clients_number() == 1
+            bob.close()
+            cond = alice_answer == bob_answer == FRAME_WELCOME and duplicate_answer == FRAME_REJECT and released
+        finally:
+            for node in nodes:node.shutdown()
+            for node_thread in node_threads:node_thread.join()
+            relay.stop()
+            relay_thread.join()
+    if cond:print("Test 7 passed")
+    else:print("Test 7 failed")
+
+def test_8():# Test 8: Test that the UDP server keeps no reliability state for addresses that never join
+    server = ServerUDP(port + 5)
+    server_addr = (socket.gethostbyname(socket.gethostname()), port + 5)
+    client_socks = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM) for _ in range(4)]
+    clients = [ReliableUDP(client_sock, timeout=0.1) for client_sock in client_socks]
+    for i, client in enumerate(clients):client.send(b"exit" if i % 2 else b"hello", server_addr)
+    deadline = time.time() + 2
+    while any(client.in_flight() for client in clients) and time.time() < deadline:
+        readable, _, _ = select.select([server.server_socket] + client_socks, [], [], 0.05)
+        if server.server_socket in readable:server.receive_batch()
+        for client_sock, client in zip(client_socks, clients):
+            if client_sock in readable:client.receive(*client_sock.recvfrom(65535))
+            client.retransmit()
+    cond = not any(client.in_flight() for client in clients) and server.reliable.peers == {} and server.clients == {}
+    server.shutdown()
+    for client_sock in client_socks:client_sock.close()
+    if cond:print("Test 8 passed")
+    else:print("Test 8 failed")
+
+async def receive_until(client, expected):# Iterates over a client's messages until expected arrives, returning whether it did
+    async for message in client:
+        if message == expected:
+            return True
+    return False
+
+def test_9():# Test 9: Test AsyncClientTCP joining, chatting, leaving and seeing the server shut down
+    server = ServerTCP(port + 6, listen_socket=listen(port + 6))
+    server_thread = threading.Thread(target=server.run)
+    server_thread.start()
+
+    async def chat():
+        alice = AsyncClientTCP("alice", port + 6)
+        await alice.connect()
+        bob = AsyncClientTCP("bob", port + 6)
+        await bob.connect()
+        try:
+            await AsyncClientTCP("alice", port + 6).connect()
+            refused = False
+        except ConnectionError:
+            refused = True
+        await alice.send("hello bob")
+        received = await asyncio.wait_for(receive_until(bob, "alice: hello bob"), 5)
+        await alice.close()
+        left = await asyncio.wait_for(receive_until(bob, "User alice left"), 5)
+        await asyncio.to_thread(server.shutdown)
+        ended = await asyncio.wait_for(receive_until(bob, None), 5) is False and bob.server_shutdown.is_set()
+        await bob.close()
+        return refused and received and left and ended and alice.closed
+
+    async def bad_frame():# A frame too large to decode ends the stream rather than raising
+        async def handle(reader, writer):
+            await reader.read(1024)
+            writer.write(encode_frame(FRAME_WELCOME, "Welcome"))
+            await writer.drain()
+            await asyncio.sleep(0.1)
+            writer.write(FRAME_HEADER.pack(MAX_FRAME + 1, FRAME_CHAT))
+            await writer.drain()
+        fake = await asyncio.start_server(handle, socket.gethostbyname(socket.gethostname()), port + 7, reuse_address=True)
+        async with fake:
+            client = AsyncClientTCP("carol", port + 7)
+            await client.connect()
+            message = await asyncio.wait_for(client.receive(), 5)
+            await client.close()
+        return message is None
+
+    try:
+        cond = asyncio.run(chat()) and asyncio.run(bad_frame())
+    finally:
+        server.shutdown()
+        server_thread.join()
+    if cond:print("Test 9 passed")
+    else:print("Test 9 failed")
+
+def serve_udp(server, stopping):# Runs a ServerUDP like its run() until stopping is set, then shuts it down
+    while not stopping.is_set():
+        readable, _, _ = select.select([server.server_socket], [], [], 0.05)
+        if readable:server.receive_batch()
+        for client_addr in server.reliable.retransmit():server.close_client(client_addr)
+    server.shutdown()
+
+def test_10():# Test 10: Test AsyncClientUDP joining, chatting, leaving and seeing the server shut down
+    server = ServerUDP(port + 8)
+    stopping = threading.Event()
+    server_thread = threading.Thread(target=serve_udp, args=(server, stopping))
+    server_thread.start()
+
+    async def chat():
+        alice = AsyncClientUDP("alice", port + 8)
+        await alice.connect()
+        bob = AsyncClientUDP("bob", port + 8)
+        await bob.connect()
+        try:
+            await AsyncClientUDP("alice", port + 8).connect()
+            refused = False
+        except ConnectionError:
+            refused = True
+        await alice.send("hello bob")
+        received = await asyncio.wait_for(receive_until(bob, "alice: hello bob"), 5)
+        await alice.close()
+        left = await asyncio.wait_for(receive_until(bob, "User alice left"), 5)
+        forgotten = server.get_clients_number() == 1
+        stopping.set()
+        ended = await asyncio.wait_for(receive_until(bob, None), 5) is False and bob.server_shutdown.is_set()
+        await bob.close()
+        return refused and received and left and forgotten and ended and alice.closed
+
+    try:
+        cond = asyncio.run(chat())
+    finally:
+        stopping.set()
+        server_thread.join()
+    if cond:print("Test 10 passed")
+    else:print("Test 10 failed")
+
+def frames_until(client_socket, decoder, expected):# Texts of the frames a client receives up to and including expected
+    texts = []
+    while expected not in texts:
+        texts += [payload.decode() for _, payload in decoder.feed(client_socket.recv(65536))]
+    return texts
+
+def test_11():# Test 11: Test that TCP clients move between rooms and only get the messages of their room
+    server = ServerTCP(port + 9, listen_socket=listen(port + 9))
+    server_thread = threading.Thread(target=server.run)
+    server_thread.start()
+    clients = []
+    cond = False
+    try:
+        for name in ("alice", "bob", "carol"):clients.append(join(port + 9, name))
+        (alice, alice_decoder, _), (bob, bob_decoder, _), (carol, carol_decoder, _) = clients
+        alice.sendall(encode_frame(FRAME_CHAT, "/join games"))
+        moved = "You are now in room games" in frames_until(alice, alice_decoder, "You are now in room games")
+        frames_until(bob, bob_decoder, "User alice left")# The lobby is told alice left
+        bob.sendall(encode_frame(FRAME_CHAT, "/join games"))
+        frames_until(alice, alice_decoder, "User bob joined")
+        alice.sendall(encode_frame(FRAME_CHAT, "hi bob"))
+        frames_until(bob, bob_decoder, "alice: hi bob")
+        bob.sendall(encode_frame(FRAME_CHAT, "/leave"))
+        seen_by_carol = frames_until(carol, carol_decoder, "User bob joined")# Back in the lobby
+        alice.sendall(encode_frame(FRAME_CHAT, "/leave"))
+        frames_until(alice, alice_decoder, "You are now in room lobby")
+        cond = (moved and "alice: hi bob" not in seen_by_carol and "games" not in server.rooms
+                and server.rooms["lobby"] == set(server.clients))
+    finally:
+        for client_socket, _, _ in clients:client_socket.close()
+        server.shutdown()
+        server_thread.join()
+    if cond:print("Test 11 passed")
+    else:print("Test 11 failed")
+
+async def collect_until(client, expected):# Messages a client receives up to and including expected
+    messages = []
+    async for message in client:
+        messages.append(message)
+        if message == expected:
+            break
+    return messages
+
+def test_12():# Test 12: Test that UDP clients move between rooms and only get the messages of their room
+    server = ServerUDP(port + 10)
+    stopping = threading.Event()
+    server_thread = threading.Thread(target=serve_udp, args=(server, stopping))
+    server_thread.start()
+
+    async def chat():
+        alice, bob, carol = (AsyncClientUDP(name, port + 10) for name in ("alice", "bob", "carol"))
+        for client in (alice, bob, carol):await client.connect()
+        await alice.send("/join games")
+        moved = "You are now in room games" in await asyncio.wait_for(collect_until(alice, "You are now in room games"), 5)
+        await asyncio.wait_for(collect_until(bob, "User alice left"), 5)# The lobby is told alice left
+        await bob.send("/join games")
+        await asyncio.wait_for(collect_until(alice, "User bob joined"), 5)
+        await alice.send("hi bob")
+        await asyncio.wait_for(collect_until(bob, "alice: hi bob"), 5)
+        await bob.send("/leave")
+        seen_by_carol = await asyncio.wait_for(collect_until(carol, "User bob joined"), 5)# Back in the lobby
+        await alice.send("/leave")
+        await asyncio.wait_for(collect_until(alice, "You are now in room lobby"), 5)
+        rooms = {room: set(members) for room, members in server.rooms.items()}
+        for client in (alice, bob, carol):await client.close()
+        return moved and "alice: hi bob" not in seen_by_carol and list(rooms) == ["lobby"] and len(rooms["lobby"]) == 3
+
+    try:
+        cond = asyncio.run(chat())
+    finally:
+        stopping.set()
+        server_thread.join()
+    if cond:print("Test 12 passed")
+    else:print("Test 12 failed")
+
+def test_13():# Test 13: Test that shutdown takes one deadline for all slow clients and still reaches the others
+    server = ServerTCP(port + 11, listen_socket=listen(port + 11), shutdown_timeout=0.5)
+    server_thread = threading.Thread(target=server.run)
+    server_thread.start()
+    clients = []
+    try:
+        slow = [join(port + 11, f"slow{i}")[0] for i in range(5)]# They never read, so their buffers fill up
+        reader, reader_decoder, _ = join(port + 11, "reader")
+        talker = join(port + 11, "talker")[0]
+        clients = slow + [reader, talker]
+        reader.sendall(encode_frame(FRAME_CHAT, "/join quiet"))# Away from the flood
+        frames_until(reader, reader_decoder, "You are now in room quiet")
+        for _ in range(200):talker.sendall(encode_frame(FRAME_CHAT, "x" * 60000))
+        time.sleep(1)
+        start = time.time()
+        server.shutdown()
+        stop_time = time.time() - start
+        shutdown_frame = frames_until(reader, reader_decoder, "server-shutdown")[-1] == "server-shutdown"
+        cond = stop_time < 2 and shutdown_frame and server.outqueues == {}
+    finally:
+        for client_socket in clients:client_socket.close()
+        server.shutdown()
+        server_thread.join()
+    if cond:print("Test 13 passed")
+    else:print("Test 13 failed")
+
+if __name__ == "__main__":
+    test_1()
+    test_2()
+    test_3()
+    test_4()
+    test_5()
+    test_6()
+    test_7()
+    test_8()
+    test_9()
+    test_10()
+    test_11()
+    test_12()
+    test_13()
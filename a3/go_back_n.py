@@ -1,8 +1,76 @@
+import mmap
+import os
+import struct
 import time
 from threading import Thread
 
+# a packet is its data bytes followed by a 16-bit big-endian sequence number. packet_len counts bits,
+# sequence number included, so a packet carries (packet_len - 16) // 8 bytes of data
+SEQ_NUM_BITS = 16
+SEQ_NUM = struct.Struct("!H")
+SEQ_NUM_MOD = 1 << SEQ_NUM_BITS
+
+class MappedPackets:
+    # the packets of input_file, built on demand from a memory map of the file, so only the data of
+    # packets being sent is ever read into memory. indexed like the list prepare_packets returns
+    def __init__(self, input_file, data_len):
+        self.file = open(input_file, 'rb')
+        size = os.fstat(self.file.fileno()).st_size
+        # an empty file can't be mapped, and has no packets anyway
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+        self.data_len = data_len
+        self.count = -(-size // data_len)
+        self.released = 0    # bytes at the start of the map given back by release()
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        start = i * self.data_len
+        return self.data[start:start + self.data_len] + SEQ_NUM.pack(i % SEQ_NUM_MOD)
+
+    def release(self, i):
+        # gives back the memory of the data before packet i, a MiB at a time. the pages are clean, so
+        # this only drops them from the process; reading them again would just map them back in
+        end = i * self.data_len // mmap.PAGESIZE * mmap.PAGESIZE
+        if end - self.released >= 1 << 20 and hasattr(mmap, "MADV_DONTNEED"):
+            self.data.madvise(mmap.MADV_DONTNEED, self.released, end - self.released)
+            self.released = end
+
+    def close(self):
+        if self.data:
+            self.data.close()
+        self.file.close()
+
+class WindowState:
+    # per-packet state like a list indexed by packet number, but holding only window_size packets:
+    # packet i lives in slot i % window_size. a packet whose slot a later packet took, or a negative
+    # index, reads as passed, and packets not set yet read as default
+    def __init__(self, window_size, default, passed):
+        self.values = [default] * window_size
+        self.owners = [-1] * window_size
+        self.default = default
+        self.passed = passed
+
+    def __getitem__(self, i):
+        if i < 0:
+            return self.passed
+        slot = i % len(self.values)
+        if self.owners[slot] == i:
+            return self.values[slot]
+        return self.passed if self.owners[slot] > i else self.default
+
+    def __setitem__(self, i, value):
+        slot = i % len(self.values)
+        if i >= 0 and self.owners[slot] <= i:
+            self.owners[slot] = i
+            self.values[slot] = value
+
 class GBN_sender:
-    def __init__(self, input_file, window_size, packet_len, nth_packet, send_queue, ack_queue, timeout_interval, logger):
+    # with streaming=True the input is memory-mapped instead of read, packets are built as they are sent
+    # and the state kept per packet covers only the window, so memory use doesn't grow with the file
+    def __init__(self, input_file, window_size, packet_len, nth_packet, send_queue, ack_queue, timeout_interval, logger,
+                 streaming=False):
         self.input_file = input_file
         self.window_size = window_size
         self.packet_len = packet_len
@@ -12,34 +80,34 @@ class GBN_sender:
         self.timeout_interval = timeout_interval
         self.logger = logger
         
+        self.streaming = streaming
+        self.data_len = (self.packet_len - SEQ_NUM_BITS) // 8
+        if self.data_len < 1:
+            raise ValueError(f"packet_len must be at least {SEQ_NUM_BITS + 8} bits")
+
         # initialize sender state variables
         self.base = 0
-        self.packets = self.prepare_packets()
-        self.acks_list = [False] * len(self.packets)
-        self.packet_timers = [0] * len(self.packets)
-        self.dropped_list = []
+        if streaming:
+            self.packets = MappedPackets(input_file, self.data_len)
+            self.acks_list = WindowState(window_size, False, True)
+            self.packet_timers = WindowState(window_size, 0, 0)
+            self.dropped_list = WindowState(window_size, False, True)
+        else:
+            self.packets = self.prepare_packets()
+            self.acks_list = [False] * len(self.packets)
+            self.packet_timers = [0] * len(self.packets)
+            self.dropped_list = [False] * len(self.packets)
 
     def prepare_packets(self):
-        # read data from input_file and convert to binary representation
-        with open(self.input_file, 'r') as file:
-            data = file.read()
-        
-        # convert data to binary, each char to 8-bit binary
-        binary_data = ''.join(format(ord(char), '08b') for char in data)
-        
-        # create packets with data bits and sequence numbers
+        # read data from input_file as raw bytes
+        with open(self.input_file, 'rb') as file:
+            data = memoryview(file.read())
+
+        # create packets of data bytes and sequence numbers; the last one is shorter instead of padded
         packets = []
-        seq_num = 0
-        seq_num_bits = 16  # sequence number is 16 bits
-        
-        for i in range(0, len(binary_data), self.packet_len - seq_num_bits):
-            data_bits = binary_data[i:i + (self.packet_len - seq_num_bits)]
-            padded_data_bits = data_bits.ljust(self.packet_len - seq_num_bits, '0')  # pad if needed
-            
-            # construct packet with 16-bit sequence number at the end
-            packet = padded_data_bits + format(seq_num, f'0{seq_num_bits}b')
-            packets.append(packet)
-            seq_num += 1
+        for seq_num, i in enumerate(range(0, len(data), self.data_len)):
+            # sequence numbers wrap around at 16 bits, far more than any window
+            packets.append(data[i:i + self.data_len].tobytes() + SEQ_NUM.pack(seq_num % SEQ_NUM_MOD))
 
         return packets
 
@@ -47,8 +115,8 @@ class GBN_sender:
         # send all packets in the current window
         for i in range(self.base, min(self.base + self.window_size, len(self.packets))):
             if not self.acks_list[i]:  # only send unacknowledged packets
-                if (i + 1) % self.nth_packet == 0 and i not in self.dropped_list:
-                    self.dropped_list.append(i)
+                if (i + 1) % self.nth_packet == 0 and not self.dropped_list[i]:
+                    self.dropped_list[i] = True
                     self.logger.info(f"packet {i} dropped")
                 else:
                     self.send_queue.put(self.packets[i])
@@ -58,11 +126,13 @@ class GBN_sender:
     def send_next_packet(self):
         # increment base and send the last packet within the window if available
         self.base += 1
+        if self.streaming:
+            self.packets.release(self.base)
         if self.base + self.window_size - 1 < len(self.packets):
             i = self.base + self.window_size - 1
             if not self.acks_list[i]:
-                if (i + 1) % self.nth_packet == 0 and i not in self.dropped_list:
-                    self.dropped_list.append(i)
+                if (i + 1) % self.nth_packet == 0 and not self.dropped_list[i]:
+                    self.dropped_list[i] = True
                     self.logger.info(f"packet {i} dropped")
                 else:
                     self.send_queue.put(self.packets[i])
@@ -106,6 +176,9 @@ class GBN_sender:
 
         # signal end of transmission
         self.send_queue.put(None)
+        if self.streaming:
+            ack_thread.join()
+            self.packets.close()
 
 
 class GBN_receiver:
@@ -115,20 +188,23 @@ class GBN_receiver:
         self.ack_queue = ack_queue
         self.logger = logger
         
-        # initialize receiver state variables
-        self.packet_list = []
+        # initialize receiver state variables; in-order data is written to output as it arrives
+        self.output = None
         self.expected_seq_num = 0
 
     def process_packet(self, packet):
         # extract sequence number and data from the packet
-        seq_num_bits = 16
-        data_bits = packet[:-seq_num_bits]
-        seq_num = int(packet[-seq_num_bits:], 2)
-
-        # check if the received packet is the expected one
-        if seq_num == self.expected_seq_num:
-            # packet is in order; add data and send acknowledgment
-            self.packet_list.append(data_bits)
+        data = packet[:-SEQ_NUM.size]
+        seq_num = SEQ_NUM.unpack_from(packet, len(packet) - SEQ_NUM.size)[0]
+
+        # check if the received packet is the expected one; sequence numbers wrap, acks are packet indexes
+        if seq_num == self.expected_seq_num % SEQ_NUM_MOD:
+            # packet is in order; write data and send acknowledgment
+            seq_num = self.expected_seq_num
+            if self.output is None:
+                # opened on the first packet, so process_packet works outside run() as well
+                self.output = open(self.output_file, 'wb')
+            self.output.write(data)
             self.ack_queue.put(seq_num)
             self.logger.info(f"packet {seq_num} received")
             
@@ -142,25 +218,21 @@ class GBN_receiver:
             return False
 
     def write_to_file(self):
-        # convert binary data to text and write to output file
-        with open(self.output_file, 'w') as file:
-            for data_bits in self.packet_list:
-                # each 8-bit segment represents a character in ascii
-                for i in range(0, len(data_bits), 8):
-                    char_bits = data_bits[i:i + 8]
-                    if len(char_bits) == 8:  # avoid incomplete byte at the end
-                        char = chr(int(char_bits, 2))
-                        if char != '\x00':  # ignore null characters
-                            file.write(char)
+        # finish the output file: the data is already written as it arrived, so this flushes and closes it,
+        # creating it empty if no packet was received
+        if self.output is None:
+            self.output = open(self.output_file, 'wb')
+        self.output.close()
 
     def run(self):
-        # continuously listen for packets until end of transmission (None received)
+        # continuously listen for packets until end of transmission (None received),
+        # writing the data of each in-order packet to the output file as it arrives
         while True:
             packet = self.send_queue.get()
             if packet is None:
                 # end of transmission signal
                 break
             self.process_packet(packet)
-        
-        # write all received data to the output file after receiving all packets
+
+        # close the output file after receiving all packets
         self.write_to_file()
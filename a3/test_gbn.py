@@ -27,4 +27,26 @@ receiver.run()
 sender_thread.join() 
 
 with open(in_file, 'r') as f1, open(out_file, 'r') as f2: sent, received = f1.read(), f2.read()
-if sent == received: print("Data transmitted successfully!")
\ No newline at end of file
+if sent == received: print("Data transmitted successfully!")
+
+# same transfer with the sender streaming from a memory map
+send_queue, ack_queue = queue.Queue(), queue.Queue()
+sender = GBN_sender(input_file = in_file, window_size = window_size, packet_len = packet_len, nth_packet = nth_packet, send_queue = send_queue, ack_queue = ack_queue, timeout_interval = timeout_interval, logger = logger, streaming = True)
+receiver = GBN_receiver(output_file = out_file, send_queue = send_queue, ack_queue = ack_queue, logger = logger)
+
+sender_thread = threading.Thread(target=sender.run) 
+sender_thread.start() 
+receiver.run() 
+sender_thread.join() 
+
+with open(in_file, 'r') as f1, open(out_file, 'r') as f2: sent, received = f1.read(), f2.read()
+if sent == received: print("Streamed data transmitted successfully!")
+
+# the receiver driven directly, without run(): packets in, then write_to_file to finish the output
+receiver = GBN_receiver(output_file = out_file, send_queue = queue.Queue(), ack_queue = queue.Queue(), logger = logger)
+receiver.process_packet(b"Hello " + (0).to_bytes(2, 'big'))
+receiver.process_packet(b"World" + (1).to_bytes(2, 'big'))
+receiver.write_to_file()
+
+with open(out_file, 'r') as f: received = f.read()
+if received == "Hello World": print("Packets processed directly successfully!")